@@ -0,0 +1,179 @@
+import json
+import uuid
+import asyncio
+import logging
+from aiohttp import web
+from openai import RateLimitError
+from lib.config import config
+from lib.metrics import get_metrics
+from lib.resources import get_registry
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+registry_key = web.AppKey("registry", object)
+limiter_key = web.AppKey("limiter", object)
+
+
+class RequestLimiter:
+    # At most max_concurrency requests are answered at once; a request that cannot get a slot
+    # within queue_timeout is rejected instead of piling up behind slow model calls
+    def __init__(self, max_concurrency=config['api']['max_concurrency'], queue_timeout=config['api']['queue_timeout']):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.queue_timeout = queue_timeout
+
+    async def acquire(self):
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            get_metrics().increment("rag_api_rejected_total")
+            raise web.HTTPServiceUnavailable(text="Too many requests in progress, try again later",
+                                             headers={"Retry-After": str(max(1, int(self.queue_timeout)))})
+
+    def release(self):
+        self.semaphore.release()
+
+
+def document_json(document):
+    return {"page_content": document.page_content,
+            "metadata": json.loads(json.dumps(document.metadata, default=str))}
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode('utf-8')
+
+
+async def read_request(request):
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(text="Body must be JSON")
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text="Body must be a JSON object")
+    question = body.get("input")
+    if not isinstance(question, str) or not question.strip():
+        raise web.HTTPBadRequest(text="'input' must be a non-empty string")
+    return question, body.get("session_id") or uuid.uuid4().hex
+
+
+async def current_registry(request):
+    # Reloads the retriever and chains in a worker thread when ingestion saved a new index version
+    return await asyncio.to_thread(request.app[registry_key].refresh)
+
+
+async def conversational_chain(request):
+    return (await current_registry(request)).conversational_rag_chain
+
+
+async def chat(request):
+    question, session_id = await read_request(request)
+    limiter = request.app[limiter_key]
+    await limiter.acquire()
+    try:
+        chain = await conversational_chain(request)
+        async with asyncio.timeout(config['api']['request_timeout']):
+            result = await chain.ainvoke({"input": question}, config={"configurable": {"session_id": session_id}})
+    except TimeoutError:
+        get_metrics().increment("rag_api_timeouts_total")
+        raise web.HTTPGatewayTimeout(text="The answer took too long")
+    except RateLimitError:
+        raise web.HTTPServiceUnavailable(text="Rate limited by OpenAI, try again later")
+    finally:
+        limiter.release()
+    return web.json_response({"session_id": session_id, "answer": result["answer"], "cached": result["cached"],
+                              "context": [document_json(document) for document in result["context"]]})
+
+
+async def chat_stream(request):
+    # Server-sent events: one "context" event with the retrieved chunks, "token" events with
+    # the answer, then "done" or "error"
+    question, session_id = await read_request(request)
+    limiter = request.app[limiter_key]
+    await limiter.acquire()
+    try:
+        chain = await conversational_chain(request)
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream; charset=utf-8", "Cache-Control": "no-cache",
+                                               "X-Accel-Buffering": "no"})
+        await response.prepare(request)
+        try:
+            async with asyncio.timeout(config['api']['request_timeout']):
+                async for chunk in chain.astream({"input": question},
+                                                 config={"configurable": {"session_id": session_id}}):
+                    if "context" in chunk:
+                        await response.write(sse_event("context", {
+                            "session_id": session_id, "cached": chunk.get("cached", False),
+                            "context": [document_json(document) for document in chunk["context"]]}))
+                    if "answer" in chunk:
+                        await response.write(sse_event("token", {"text": chunk["answer"]}))
+            await response.write(sse_event("done", {"session_id": session_id}))
+        except TimeoutError:
+            get_metrics().increment("rag_api_timeouts_total")
+            await response.write(sse_event("error", {"message": "The answer took too long"}))
+        except RateLimitError:
+            await response.write(sse_event("error", {"message": "Rate limited by OpenAI, try again later"}))
+        except (ConnectionResetError, asyncio.CancelledError):
+            # The client went away, stop generating
+            logging.info(f"Client disconnected from session {session_id}")
+            raise
+        except Exception as e:
+            logging.error(f"Streaming answer for session {session_id} failed: {e}")
+            await response.write(sse_event("error", {"message": "Something went wrong"}))
+        await response.write_eof()
+        return response
+    finally:
+        limiter.release()
+
+
+async def session_messages(request):
+    registry = await current_registry(request)
+    history = registry.history_store.get_session_history(request.match_info["session_id"])
+    messages = await asyncio.to_thread(lambda: history.messages)
+    return web.json_response({"messages": [{"role": message.type, "content": message.content}
+                                           for message in messages]})
+
+
+async def clear_session(request):
+    registry = await current_registry(request)
+    history = registry.history_store.get_session_history(request.match_info["session_id"])
+    await asyncio.to_thread(history.clear)
+    return web.json_response({"cleared": True})
+
+
+async def health(request):
+    registry = request.app[registry_key]
+    return web.json_response({"status": "ok", "index_version": registry.index_version})
+
+
+async def stats(request):
+    return web.json_response(get_metrics().snapshot())
+
+
+async def metrics(request):
+    return web.Response(text=get_metrics().render_prometheus(), content_type="text/plain")
+
+
+def create_app(registry=None, limiter=None):
+    app = web.Application()
+    # One registry per process: a single retriever, chat model and history store for all sessions
+    app[registry_key] = registry or get_registry()
+    app[limiter_key] = limiter or RequestLimiter()
+    app.add_routes([
+        web.post("/chat", chat),
+        web.post("/chat/stream", chat_stream),
+        web.get("/sessions/{session_id}", session_messages),
+        web.delete("/sessions/{session_id}", clear_session),
+        web.get("/health", health),
+        web.get("/stats", stats),
+        web.get("/metrics", metrics),
+    ])
+    return app
+
+
+if __name__ == "__main__":
+    app = create_app()
+    # Load the index before the first request arrives
+    app[registry_key].refresh()
+    web.run_app(app, host=config['api']['host'], port=config['api']['port'])
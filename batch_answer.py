@@ -0,0 +1,27 @@
+import time
+import argparse
+from lib.batch import BatchAnswerer, chunks_path_for, load_questions
+from lib.config import config
+from lib.resources import get_registry
+
+
+def run_batch(questions_path, output_path=None, max_concurrency=None):
+    output_path = output_path or config['batch']['output_path']
+    questions = load_questions(questions_path)
+    registry = get_registry().refresh()
+    answerer = BatchAnswerer(registry.rag_chain, registry.vectorstore,
+                             max_concurrency=max_concurrency or config['batch']['max_concurrency'])
+    start = time.perf_counter()
+    answered, failed = answerer.answer_all(questions, output_path)
+    print(f"Answered {answered} of {len(questions)} questions in {time.perf_counter() - start:.1f}s "
+          f"({failed} failed)")
+    print(f"Answers saved to {output_path}, retrieved chunks to {chunks_path_for(output_path)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Answer a list of questions with the RAG chain")
+    parser.add_argument("questions", help=".txt with one question per line, .jsonl or .json with questions")
+    parser.add_argument("--output", help="JSONL file the answers are appended to")
+    parser.add_argument("--concurrency", type=int, help="answers generated at the same time")
+    args = parser.parse_args()
+    run_batch(args.questions, output_path=args.output, max_concurrency=args.concurrency)
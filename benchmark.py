@@ -0,0 +1,359 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import multiprocessing
+import resource
+import tempfile
+import faiss
+import numpy as np
+from langchain_community.vectorstores.utils import maximal_marginal_relevance as langchain_mmr
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from lib.bm25 import BM25Index, tokenize
+from lib.data_prep import load_and_process_pdfs
+from lib.embeddings import HashEmbeddings
+from lib.indexing import Indexing, SEPARATORS
+from lib.mmr import maximal_marginal_relevance, search_with_vectors
+from lib.retrieval import FAISSRetriever
+from lib.vectorstore import add_embeddings, index_paths, new_vectorstore, save_vectorstore
+from lib.config import config
+
+DOCUMENT_PREFIX = re.compile(r"^Document \d+:\s*")
+
+
+def run_split_benchmark(pdf_folder_path=config['pdf_processing']['pdf_folder_path'], limit=None):
+    documents = load_and_process_pdfs(pdf_folder_path)
+    if limit:
+        documents = documents[:limit]
+    print(f"Benchmarking text splitting on {len(documents)} documents")
+
+    # Baseline: the previous serial loop with the uncached tiktoken splitter
+    baseline_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        separators=SEPARATORS,
+        chunk_size=config['pdf_processing']['chunk_size'],
+        chunk_overlap=config['pdf_processing']['chunk_overlap'],
+    )
+    start = time.perf_counter()
+    baseline_splits = []
+    for document in documents:
+        baseline_splits.extend(baseline_splitter.split_documents([document]))
+    baseline_seconds = time.perf_counter() - start
+
+    # Page by page like the baseline, section-aware splitting produces different chunks by design
+    indexing = Indexing(structure=False)
+    text_splitter = indexing.create_text_splitter()
+    start = time.perf_counter()
+    splits = indexing.split_documents(documents, text_splitter)
+    parallel_seconds = time.perf_counter() - start
+
+    # token_count is added by the new splitting path for the embedding executor
+    identical = ([(s.page_content, {k: v for k, v in s.metadata.items() if k != 'token_count'}) for s in splits]
+                 == [(s.page_content, s.metadata) for s in baseline_splits])
+    print(f"Serial loop:   {len(documents) / baseline_seconds:.1f} docs/sec ({baseline_seconds:.2f}s)")
+    print(f"Process pool:  {len(documents) / parallel_seconds:.1f} docs/sec ({parallel_seconds:.2f}s, {indexing.max_workers} workers)")
+    print(f"Speedup: {baseline_seconds / parallel_seconds:.2f}x, identical output: {identical}")
+    if not identical:
+        sys.exit(1)
+
+
+def load_reference_contexts(eval_dataset_path):
+    with open(eval_dataset_path, 'r', encoding='utf-8') as f:
+        dataset = json.load(f)
+    items = []
+    for data in dataset:
+        for question, contexts in zip(data["question"], data["contexts"]):
+            items.append((question, [DOCUMENT_PREFIX.sub("", context) for context in contexts]))
+    return items
+
+
+def overlaps(chunk, reference, threshold):
+    # The dataset holds context texts, not chunk ids, so chunks are matched by token overlap
+    chunk_tokens, reference_tokens = set(tokenize(chunk)), set(tokenize(reference))
+    if not chunk_tokens or not reference_tokens:
+        return False
+    return len(chunk_tokens & reference_tokens) / len(chunk_tokens | reference_tokens) >= threshold
+
+
+def context_recall(retriever, items, threshold=0.5):
+    recalls = []
+    for question, references in items:
+        chunks = [document.page_content for document in retriever.invoke(question)]
+        found = sum(any(overlaps(chunk, reference, threshold) for chunk in chunks) for reference in references)
+        recalls.append(found / len(references))
+    return sum(recalls) / len(recalls)
+
+
+def run_retrieval_benchmark(eval_dataset_path="data/evaluation/eval_dataset.json", threshold=0.5):
+    items = load_reference_contexts(eval_dataset_path)
+    retriever_instance = FAISSRetriever(db_folder_path=config['ingestion']['db_folder_path'],
+                                        index_name=config['ingestion']['index_name'])
+    dense = retriever_instance.build_retriever(retriever_instance.db, {**config['retrieval'], 'hybrid': False})
+    hybrid = retriever_instance.build_retriever(retriever_instance.db, {**config['retrieval'], 'hybrid': True})
+
+    print(f"Measuring context recall@{config['retrieval']['k']} on {len(items)} questions")
+    results = {}
+    for name, retriever in (("dense", dense), ("hybrid", hybrid)):
+        start = time.perf_counter()
+        results[name] = context_recall(retriever, items, threshold)
+        seconds = time.perf_counter() - start
+        print(f"{name:<7} recall: {results[name]:.3f} ({seconds / len(items) * 1000:.0f} ms/question)")
+    print(f"Recall gain: {results['hybrid'] - results['dense']:+.3f}")
+    return results
+
+
+def run_mmr_benchmark(num_vectors=20000, dim=3072, num_queries=50, ks=(4, 10, 20), fetch_ks=(20, 50, 100),
+                      truncated_dimensions=256, seed=0):
+    # Synthetic clustered vectors so near neighbours are similar to each other, like chunks of one law.
+    # Random vectors have no Matryoshka structure, so only the speed of truncated MMR is measured here.
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_vectors // 50, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, len(centers), num_vectors)] + 0.5 * rng.standard_normal((num_vectors, dim)).astype(np.float32)
+    faiss.normalize_L2(vectors)
+    index = faiss.IndexFlatL2(dim)
+    index.add(vectors)
+    queries = vectors[rng.integers(0, num_vectors, num_queries)] + 0.1 * rng.standard_normal((num_queries, dim)).astype(np.float32)
+
+    print(f"MMR over {num_vectors} x {dim} vectors, {num_queries} queries per setting (ms per query)")
+    print(f"{'k':>4} {'fetch_k':>8} {'langchain':>10} {'numpy':>7} {'mmr only':>9} {'numpy mmr':>10} "
+          f"{f'{truncated_dimensions}d mmr':>9} {'match':>6}")
+    all_match = True
+    for fetch_k in fetch_ks:
+        for k in ks:
+            if k > fetch_k:
+                continue
+            timings = np.zeros(5)
+            matches = 0
+            for query in queries:
+                start = time.perf_counter()
+                _, labels = index.search(query.reshape(1, -1), fetch_k)
+                searched = time.perf_counter()
+                candidates = [index.reconstruct(int(label)) for label in labels[0] if label != -1]
+                baseline = [int(labels[0][i]) for i in langchain_mmr(query.reshape(1, -1), candidates, k=k)]
+                done = time.perf_counter()
+                timings[0] += done - start
+                timings[2] += done - searched
+
+                start = time.perf_counter()
+                _, found, candidate_vectors = search_with_vectors(index, query, fetch_k)
+                searched = time.perf_counter()
+                selected = [int(found[i]) for i in maximal_marginal_relevance(query, candidate_vectors, k=k)]
+                done = time.perf_counter()
+                timings[1] += done - start
+                timings[3] += done - searched
+
+                start = time.perf_counter()
+                maximal_marginal_relevance(query, candidate_vectors, k=k, dimensions=truncated_dimensions)
+                timings[4] += time.perf_counter() - start
+                matches += selected == baseline
+            all_match &= matches == num_queries
+            langchain_ms, numpy_ms, langchain_mmr_ms, numpy_mmr_ms, truncated_ms = timings / num_queries * 1000
+            print(f"{k:>4} {fetch_k:>8} {langchain_ms:>10.2f} {numpy_ms:>7.2f} {langchain_mmr_ms:>9.2f} "
+                  f"{numpy_mmr_ms:>10.2f} {truncated_ms:>9.2f} {matches / num_queries:>6.0%}")
+    if not all_match:
+        print("Vectorized MMR selected different results than LangChain")
+        sys.exit(1)
+
+
+def rss_mb():
+    # Current resident set size; falls back to the peak where /proc is not available
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def folder_size_mb(folder):
+    return sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder)) / 1024 / 1024
+
+
+def build_benchmark_corpus(eval_dataset_path, distractors, seed=0):
+    # The eval contexts are the relevant chunks, synthetic chunks drawn from their vocabulary
+    # make the index large enough for latencies to mean something
+    items = load_reference_contexts(eval_dataset_path)
+    texts, relevant = [], []
+    positions = {}
+    for _, references in items:
+        ids = set()
+        for reference in references:
+            if reference not in positions:
+                positions[reference] = len(texts)
+                texts.append(reference)
+            ids.add(f"context-{positions[reference]}")
+        relevant.append(ids)
+    chunk_ids = [f"context-{position}" for position in range(len(texts))]
+
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array(sorted({word for text in texts for word in text.split()}))
+    lengths = [len(text.split()) for text in texts]
+    for position in range(distractors):
+        words = vocabulary[rng.integers(0, len(vocabulary), lengths[position % len(lengths)])]
+        texts.append(" ".join(words))
+        chunk_ids.append(f"distractor-{position}")
+    documents = [Document(page_content=text, metadata={'source': chunk_id, 'chunk_id': chunk_id})
+                 for text, chunk_id in zip(texts, chunk_ids)]
+    return [question for question, _ in items], relevant, documents, chunk_ids
+
+
+def build_benchmark_index(folder, index_name, index_type, index_config, embeddings, documents, chunk_ids, vectors):
+    start = time.perf_counter()
+    db = new_vectorstore(embeddings, vectors, index_type=index_type, index_config=index_config)
+    add_embeddings(db, documents, vectors, chunk_ids)
+    bm25 = BM25Index()
+    bm25.add(chunk_ids, [document.page_content for document in documents])
+    bm25.save(index_paths(folder, index_name)['bm25'])
+    save_vectorstore(db, folder, index_name, index_type=index_type, index_config=index_config)
+    return time.perf_counter() - start
+
+
+def percentile_ms(latencies, q):
+    return float(np.percentile(latencies, q) * 1000)
+
+
+def measure_retriever(retriever, questions, relevant, k, repeats):
+    recalls, reciprocal_ranks, latencies = [], [], []
+    for question, relevant_ids in zip(questions, relevant):
+        retriever.invoke(question)  # warm up caches before timing
+        for _ in range(repeats):
+            start = time.perf_counter()
+            documents = retriever.invoke(question)
+            latencies.append(time.perf_counter() - start)
+        found = [document.metadata.get('chunk_id') for document in documents[:k]]
+        recalls.append(len(relevant_ids.intersection(found)) / len(relevant_ids))
+        ranks = [rank for rank, chunk_id in enumerate(found, start=1) if chunk_id in relevant_ids]
+        reciprocal_ranks.append(1 / ranks[0] if ranks else 0.0)
+    return {
+        'recall': float(np.mean(recalls)),
+        'mrr': float(np.mean(reciprocal_ranks)),
+        'p50_ms': percentile_ms(latencies, 50),
+        'p95_ms': percentile_ms(latencies, 95),
+        'p99_ms': percentile_ms(latencies, 99),
+    }
+
+
+def measure_index(folder, index_name, questions, relevant, benchmark_config):
+    rss_before = rss_mb()
+    embeddings = HashEmbeddings(dim=benchmark_config['embedding_dim'])
+    retriever_instance = FAISSRetriever(db_folder_path=folder, index_name=index_name, embeddings=embeddings)
+    measured = []
+    for mode in benchmark_config['modes']:
+        for k in benchmark_config['ks']:
+            retriever = retriever_instance.build_retriever(
+                retriever_instance.db,
+                {**config['retrieval'], 'k': k, 'hybrid': mode == 'hybrid'},
+                {**config['rerank'], 'enabled': False})
+            measured.append({'mode': mode, 'k': k,
+                             **measure_retriever(retriever, questions, relevant, k, benchmark_config['repeats'])})
+    # Memory of the loaded index, BM25 postings and docstore after all queries ran
+    rss = rss_mb() - rss_before
+    for entry in measured:
+        entry['rss_mb'] = rss
+    retriever_instance.db.docstore.close()
+    return measured
+
+
+def compare_to_baseline(results, baseline, benchmark_config=config['benchmark']):
+    failures = []
+    previous = {(entry['index_type'], entry.get('storage', 'float32'), entry['mode'], entry['k']): entry
+                for entry in baseline['results']}
+    for entry in results:
+        old = previous.get((entry['index_type'], entry['storage'], entry['mode'], entry['k']))
+        if old is None:
+            continue
+        name = f"{entry['index_type']}/{entry['storage']}/{entry['mode']}/k={entry['k']}"
+        latency_limit = max(old['p95_ms'] * (1 + benchmark_config['max_latency_regression']),
+                            old['p95_ms'] + benchmark_config['min_latency_delta_ms'])
+        if entry['p95_ms'] > latency_limit:
+            failures.append(f"{name}: p95 latency {entry['p95_ms']:.2f} ms, baseline {old['p95_ms']:.2f} ms")
+        if entry['recall'] < old['recall'] - benchmark_config['max_recall_drop']:
+            failures.append(f"{name}: recall {entry['recall']:.3f}, baseline {old['recall']:.3f}")
+    return failures
+
+
+def run_benchmark_suite(eval_dataset_path="data/evaluation/eval_dataset.json", benchmark_config=config['benchmark'],
+                        output_path=None, baseline_path=None):
+    output_path = output_path or benchmark_config['output_path']
+    baseline_path = baseline_path or benchmark_config['baseline_path']
+    questions, relevant, documents, chunk_ids = build_benchmark_corpus(eval_dataset_path,
+                                                                       benchmark_config['distractors'])
+    embeddings = HashEmbeddings(dim=benchmark_config['embedding_dim'])
+    start = time.perf_counter()
+    vectors = np.asarray(embeddings.embed_documents([document.page_content for document in documents]),
+                         dtype=np.float32)
+    print(f"Embedded {len(documents)} chunks for {len(questions)} questions in {time.perf_counter() - start:.1f}s")
+    index_config = {**config['index'], 'pq_m': benchmark_config['pq_m']}
+    index_name = config['ingestion']['index_name']
+
+    results = []
+    print(f"{'index':<9} {'storage':<8} {'mode':<7} {'k':>3} {'recall':>7} {'mrr':>6} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'build s':>8} {'index MB':>9} {'disk MB':>8} {'rss MB':>8}")
+    settings = [(index_type, storage) for index_type in benchmark_config['index_types']
+                for storage in benchmark_config['storages'] if index_type != 'ivf_pq' or storage == 'float32']
+    for index_type, storage in settings:
+        folder = tempfile.mkdtemp(prefix=f"benchmark_{index_type}_{storage}_")
+        try:
+            storage_config = {**index_config, 'storage': storage}
+            build_seconds = build_benchmark_index(folder, index_name, index_type, storage_config, embeddings,
+                                                  documents, chunk_ids, vectors)
+            # The FAISS index is what serving keeps in memory, the full vectors of compact indexes stay on disk
+            index_mb = os.path.getsize(index_paths(folder, index_name)['index']) / 1024 / 1024
+            disk_mb = folder_size_mb(folder)
+            # A fresh process per index, so its memory is not mixed with the previous ones
+            with multiprocessing.get_context("spawn").Pool(1) as pool:
+                measured = pool.apply(measure_index, (folder, index_name, questions, relevant, benchmark_config))
+            for entry in measured:
+                entry.update({'index_type': index_type, 'storage': storage, 'build_seconds': build_seconds,
+                              'index_mb': index_mb, 'disk_mb': disk_mb})
+                results.append(entry)
+                print(f"{index_type:<9} {storage:<8} {entry['mode']:<7} {entry['k']:>3} {entry['recall']:>7.3f} "
+                      f"{entry['mrr']:>6.3f} {entry['p50_ms']:>8.2f} {entry['p95_ms']:>8.2f} {entry['p99_ms']:>8.2f} "
+                      f"{build_seconds:>8.2f} {index_mb:>9.1f} {disk_mb:>8.1f} {entry['rss_mb']:>8.1f}")
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    report = {
+        'created_at': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'platform': platform.platform(),
+        'faiss_version': faiss.__version__,
+        'chunks': len(documents),
+        'questions': len(questions),
+        'settings': benchmark_config,
+        'results': results,
+    }
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4)
+    print(f"Results saved to {output_path}")
+
+    if baseline_path:
+        with open(baseline_path, 'r', encoding='utf-8') as f:
+            failures = compare_to_baseline(results, json.load(f), benchmark_config)
+        if failures:
+            print("Regressions against " + baseline_path + ":\n" + "\n".join(failures))
+            sys.exit(1)
+        print(f"No regressions against {baseline_path}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the indexing and retrieval pipeline")
+    parser.add_argument("benchmark", nargs="?", default="split", choices=["split", "retrieval", "mmr", "suite"])
+    parser.add_argument("--output", help="suite: where to write the JSON results")
+    parser.add_argument("--baseline", help="suite: earlier results to check for regressions")
+    args = parser.parse_args()
+    if args.benchmark == "retrieval":
+        run_retrieval_benchmark()
+    elif args.benchmark == "mmr":
+        run_mmr_benchmark()
+    elif args.benchmark == "suite":
+        run_benchmark_suite(output_path=args.output, baseline_path=args.baseline)
+    else:
+        run_split_benchmark()
@@ -1,6 +1,10 @@
-from lib.evaluator import EvaluationPipeline
+from lib.config import config
+from lib.embeddings import HashEmbeddings
+from lib.evaluator import EvaluationPipeline, stub_chat_model
 from lib.retrieval import FAISSRetriever
 from lib.visualizer import MetricsPlotter
+import os
+import sys
 import json
 from tqdm import tqdm
 import random
@@ -17,12 +21,12 @@ def metrics_extractor(eval_result):
     print("Extracting metrics...")
     for data in tqdm(eval_result, desc="Processing results"):
         temp = {
-            'faithfulness': data['faithfulness'],
-            'answer_relevancy': data['answer_relevancy'],
-            'context_precision': data['context_precision'],
-            'context_recall': data['context_recall'],
-            'answer_correctness': data['answer_correctness'],
-            'answer_similarity': data['answer_similarity']
+            'faithfulness': data.get('faithfulness', float('nan')),
+            'answer_relevancy': data.get('answer_relevancy', float('nan')),
+            'context_precision': data.get('context_precision', float('nan')),
+            'context_recall': data.get('context_recall', float('nan')),
+            'answer_correctness': data.get('answer_correctness', float('nan')),
+            'answer_similarity': data.get('answer_similarity', float('nan'))
         }
         metrics.append(temp)
     return metrics
@@ -45,20 +49,31 @@ def plotter(metrics, title, output_filepath):
     print(f"Plot saved to {output_filepath}\n\n")
 
 
-def run_evaluation():
-    retriever_instance = FAISSRetriever(db_folder_path="faiss_vectorstore")
-    retriever = retriever_instance.get_retriever()
+def run_evaluation(offline=False):
+    result_path = config['evaluation']['result_path']
+    if offline:
+        # Stub LLM and hash embeddings: exercises the pipeline without API calls, scores are meaningless
+        eval_pipeline = EvaluationPipeline(metric_llm=stub_chat_model(), metric_embeddings=HashEmbeddings())
+        root, ext = os.path.splitext(result_path)
+        result_path = f"{root}_offline{ext}"
+    else:
+        retriever_instance = FAISSRetriever(db_folder_path="faiss_vectorstore")
+        retriever = retriever_instance.get_retriever()
 
-    eval_pipeline = EvaluationPipeline()
-    eval_pipeline.set_retriever(retriever)
+        eval_pipeline = EvaluationPipeline()
+        eval_pipeline.set_retriever(retriever)
 
-    eval_dataset = eval_pipeline.load_dataset("data/evaluation/eval_dataset.json")
+    eval_dataset = eval_pipeline.load_dataset(config['evaluation']['dataset_path'])
 
-    eval_pipeline.evaluate(eval_dataset)
+    # Scores are checkpointed to result_path while running, an interrupted run resumes from there
+    eval_pipeline.evaluate(eval_dataset, checkpoint_path=result_path)
 
-    eval_pipeline.save_results("data/evaluation/result.json")
+    eval_pipeline.save_results(result_path)
+    if offline:
+        print(f"Offline evaluation results saved to {result_path}")
+        return
 
-    evaluation_results = load_result("data/evaluation/result.json")
+    evaluation_results = load_result(result_path)
 
     total_metrics = metrics_extractor(evaluation_results)
     plotter(metrics=total_metrics,
@@ -74,4 +89,4 @@ def run_evaluation():
 
 
 if __name__ == "__main__":
-    run_evaluation()
\ No newline at end of file
+    run_evaluation(offline="--offline" in sys.argv)
\ No newline at end of file
@@ -0,0 +1,45 @@
+import csv
+import sys
+from langchain_community.document_loaders.csv_loader import CSVLoader
+from lib.scraper import LawScraper
+from lib.ingestion import IncrementalIngestor
+from lib.embeddings import get_embeddings
+from lib.config import config
+from evaluation import run_evaluation
+
+
+def run_ingestion():
+    scraper = LawScraper(
+        url_base=config['scraper']['url_base'],
+        laws_url=config['scraper']['laws_url'],
+        json_filepath=config['scraper']['json_filepath'],
+        pdf_dir=config['scraper']['pdf_dir']
+    )
+
+    scraper.get_laws_list()
+
+    laws_from_json = scraper.load_laws_from_json()
+
+    laws_csv_path = config['application']['laws_csv_path']
+    with open(laws_csv_path, mode='w', newline='', encoding='utf-8') as myFile:
+        writer = csv.DictWriter(myFile, fieldnames=["Law code", "Law Title", "Link", "pdf_url"], extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(laws_from_json)
+
+    loader = CSVLoader(file_path=laws_csv_path, encoding='latin1')
+    laws_list = loader.load()
+
+    embeddings = get_embeddings()
+
+    # Only changed laws are downloaded, parsed and embedded again, see data/ingestion_manifest.json.
+    # PDFs are parsed while downloads are still running and embedded in batches as they are split.
+    # A running Streamlit app picks up the new index version on its next message.
+    ingestor = IncrementalIngestor(embeddings=embeddings)
+    ingestor.ingest(pdf_paths=scraper.iter_download_pdfs(laws_from_json),
+                    extra_sources={laws_csv_path: laws_list})
+
+
+if __name__ == "__main__":
+    run_ingestion()
+    if "--evaluate" in sys.argv:
+        run_evaluation()
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+import faiss
+import numpy as np
+from lib.config import config
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+
+class CachedAnswer:
+    def __init__(self, entry_id, question, chunk_ids, answer, score):
+        self.entry_id = entry_id
+        self.question = question
+        self.chunk_ids = chunk_ids
+        self.answer = answer
+        self.score = score
+
+
+class AnswerCache:
+    # Semantic cache for answers: entries live in SQLite, their standalone question
+    # embeddings in a small in-memory inner-product FAISS index rebuilt on start.
+    def __init__(self, embeddings, path=config['answer_cache']['path'],
+                 similarity_threshold=config['answer_cache']['similarity_threshold'],
+                 max_entries=config['answer_cache']['max_entries'],
+                 ttl_seconds=config['answer_cache']['ttl_seconds']):
+        self.embeddings = embeddings
+        self.path = path
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.index_version = None
+        self.index = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, question TEXT NOT NULL, embedding BLOB NOT NULL, "
+            "chunk_ids TEXT NOT NULL, answer TEXT NOT NULL, index_version TEXT NOT NULL, "
+            "created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def set_index_version(self, index_version):
+        # Answers built on another index version may cite chunks that no longer exist
+        index_version = str(index_version)
+        with self._lock:
+            removed = self._conn.execute("DELETE FROM answers WHERE index_version != ?", (index_version,)).rowcount
+            self._conn.commit()
+            self.index_version = index_version
+            self._rebuild_index()
+        if removed:
+            logging.info(f"Invalidated {removed} cached answers from older index versions")
+
+    def _rebuild_index(self):
+        self.index = None
+        rows = self._conn.execute("SELECT id, embedding FROM answers").fetchall()
+        if not rows:
+            return
+        vectors = np.vstack([np.frombuffer(blob, dtype=np.float32) for _, blob in rows])
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(vectors.shape[1]))
+        self.index.add_with_ids(vectors, np.array([entry_id for entry_id, _ in rows], dtype=np.int64))
+
+    def lookup(self, question):
+        vector = self._normalize(self.embeddings.embed_query(question))
+        with self._lock:
+            if self.index is None or self.index.ntotal == 0:
+                self.misses += 1
+                return None, vector
+            scores, ids = self.index.search(vector, 1)
+            score, entry_id = float(scores[0][0]), int(ids[0][0])
+            if entry_id < 0 or score < self.similarity_threshold:
+                self.misses += 1
+                return None, vector
+            row = self._conn.execute("SELECT question, chunk_ids, answer, created_at FROM answers WHERE id = ?",
+                                     (entry_id,)).fetchone()
+            if row is None or (self.ttl_seconds and time.time() - row[3] > self.ttl_seconds):
+                self._delete([entry_id])
+                self.misses += 1
+                return None, vector
+            self._conn.execute("UPDATE answers SET last_access = ? WHERE id = ?", (time.time(), entry_id))
+            self._conn.commit()
+            self.hits += 1
+        logging.info(f"Answer cache hit (similarity {score:.3f}) for: {question}")
+        return CachedAnswer(entry_id, row[0], json.loads(row[1]), row[2], score), vector
+
+    def store(self, question, chunk_ids, answer, vector=None):
+        if vector is None:
+            vector = self._normalize(self.embeddings.embed_query(question))
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO answers (question, embedding, chunk_ids, answer, index_version, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (question, vector.tobytes(), json.dumps(chunk_ids), answer, str(self.index_version), now, now)
+            )
+            self._conn.commit()
+            if self.index is None:
+                self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(vector.shape[1]))
+            self.index.add_with_ids(vector, np.array([cursor.lastrowid], dtype=np.int64))
+            self._evict()
+
+    def _evict(self):
+        if self.ttl_seconds:
+            expired = [row[0] for row in self._conn.execute(
+                "SELECT id FROM answers WHERE created_at < ?", (time.time() - self.ttl_seconds,))]
+            self._delete(expired)
+        if self.max_entries:
+            count = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+            if count > self.max_entries:
+                oldest = [row[0] for row in self._conn.execute(
+                    "SELECT id FROM answers ORDER BY last_access ASC LIMIT ?", (count - self.max_entries,))]
+                self._delete(oldest)
+
+    def _delete(self, entry_ids):
+        if not entry_ids:
+            return
+        self._conn.executemany("DELETE FROM answers WHERE id = ?", [(entry_id,) for entry_id in entry_ids])
+        self._conn.commit()
+        if self.index is not None:
+            self.index.remove_ids(np.array(entry_ids, dtype=np.int64))
+        self.evictions += len(entry_ids)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': self.index.ntotal if self.index is not None else 0,
+        }
@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+from openai import RateLimitError
+from lib.config import config
+from lib.metrics import get_metrics
+from lib.retrieval import PrefetchedSearch, prefetched
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+
+def load_questions(path):
+    # .txt: one question per line; .jsonl: objects with a "question"; .json: a list of questions,
+    # or of objects whose "question" is a string or a list (the evaluation dataset format)
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith('.txt'):
+            return [line.strip() for line in f if line.strip()]
+        if path.endswith('.jsonl'):
+            items = [json.loads(line) for line in f if line.strip()]
+        else:
+            items = json.load(f)
+    questions = []
+    for item in items:
+        question = item.get('question') if isinstance(item, dict) else item
+        questions.extend(question if isinstance(question, list) else [question])
+    return [question for question in questions if isinstance(question, str) and question.strip()]
+
+
+def chunks_path_for(output_path):
+    root, ext = os.path.splitext(output_path)
+    return f"{root}.chunks{ext}"
+
+
+def read_jsonl(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class BatchAnswerer:
+    # Answers independent questions (no chat history) in windows: the questions of a window are
+    # embedded in one request and searched with one FAISS call, then answered by at most
+    # max_concurrency concurrent chain calls. Answers are appended to a JSONL file as they
+    # complete, with the chunk IDs they used; every distinct chunk is written once to a
+    # second file. Questions already answered in the output are skipped, so a run resumes.
+    def __init__(self, rag_chain, vectorstore, window=config['batch']['window'],
+                 max_concurrency=config['batch']['max_concurrency'],
+                 max_retries=config['batch']['max_retries'],
+                 backoff_base=config['batch']['backoff_base'],
+                 backoff_max=config['batch']['backoff_max']):
+        self.rag_chain = rag_chain
+        self.vectorstore = vectorstore
+        self.window = window
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.metrics = get_metrics()
+
+    def backoff_delay(self, attempt):
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def answer(self, semaphore, position, question):
+        started = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            async with semaphore:
+                try:
+                    result = await self.rag_chain.ainvoke({"input": question})
+                    break
+                except RateLimitError:
+                    if attempt == self.max_retries:
+                        raise
+            delay = self.backoff_delay(attempt)
+            logging.warning(f"Rate limited answering question {position}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        return result, time.perf_counter() - started
+
+    async def aanswer(self, questions, output_path=config['batch']['output_path']):
+        answered = {record['question'] for record in read_jsonl(output_path) if 'answer' in record}
+        written_chunks = {record['chunk_id'] for record in read_jsonl(chunks_path_for(output_path))}
+        pending = [(position, question) for position, question in enumerate(questions) if question not in answered]
+        logging.info(f"Answering {len(pending)} questions, {len(questions) - len(pending)} already answered "
+                     f"in {output_path}")
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        failed = 0
+
+        with open(output_path, 'a', encoding='utf-8') as output, \
+                open(chunks_path_for(output_path), 'a', encoding='utf-8') as chunks:
+            async def run(position, question):
+                nonlocal failed
+                try:
+                    result, seconds = await self.answer(semaphore, position, question)
+                except Exception as e:
+                    logging.error(f"Failed to answer question {position} '{question}': {e}")
+                    failed += 1
+                    record = {"id": position, "question": question, "error": str(e)}
+                else:
+                    record = {"id": position, "question": question, "answer": result["answer"],
+                              "cached": result["cached"], "seconds": round(seconds, 3),
+                              "context": [document.metadata.get('chunk_id') for document in result["context"]]}
+                    for document in result["context"]:
+                        chunk_id = document.metadata.get('chunk_id')
+                        if chunk_id is not None and chunk_id not in written_chunks:
+                            written_chunks.add(chunk_id)
+                            chunks.write(json.dumps({"chunk_id": chunk_id, "page_content": document.page_content,
+                                                     "metadata": document.metadata}, ensure_ascii=False,
+                                                    default=str) + "\n")
+                    chunks.flush()
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+                self.metrics.increment("rag_batch_questions_total", result="error" if "error" in record else "ok")
+
+            # The next window is embedded and searched while the previous one is still being
+            # answered; at most two windows of candidates are held at a time
+            running = []
+            for start in range(0, len(pending), self.window):
+                window = pending[start:start + self.window]
+                search = await asyncio.to_thread(PrefetchedSearch, self.vectorstore,
+                                                 [question for _, question in window])
+                token = prefetched.set(search)
+                try:
+                    # Tasks copy the current context, the window's search stays visible to them
+                    tasks = [asyncio.ensure_future(run(position, question)) for position, question in window]
+                finally:
+                    prefetched.reset(token)
+                await asyncio.gather(*running)
+                running = tasks
+            await asyncio.gather(*running)
+
+        if failed:
+            logging.warning(f"{failed} questions could not be answered, run the batch again to retry them")
+        logging.info(f"Batch answers written to {output_path}")
+        return len(pending) - failed, failed
+
+    def answer_all(self, questions, output_path=config['batch']['output_path']):
+        return asyncio.run(self.aanswer(questions, output_path))
@@ -0,0 +1,152 @@
+import os
+import re
+import logging
+from collections import Counter
+import numpy as np
+from lib.config import config
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+# Section signs and numbers are kept as tokens, "§ 9 BDSG" and "Section 9" have to match literally
+TOKEN_PATTERN = re.compile(r"§|\w+")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    # Okapi BM25 over the chunks of the vector store. Documents are kept as term id / term
+    # frequency arrays so chunks can be added and removed incrementally; the term -> documents
+    # postings used for search are rebuilt lazily after a change.
+    def __init__(self, k1=config['retrieval']['bm25_k1'], b=config['retrieval']['bm25_b']):
+        self.k1 = k1
+        self.b = b
+        self.vocabulary = {}
+        self.chunk_ids = []
+        self.doc_terms = []
+        self.doc_tfs = []
+        self.positions = {}
+        self._postings = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    def term_id(self, term):
+        term_id = self.vocabulary.get(term)
+        if term_id is None:
+            term_id = self.vocabulary[term] = len(self.vocabulary)
+        return term_id
+
+    def add(self, chunk_ids, texts):
+        for chunk_id, text in zip(chunk_ids, texts):
+            if chunk_id in self.positions:
+                self.remove([chunk_id])
+            counts = Counter(self.term_id(term) for term in tokenize(text))
+            self.positions[chunk_id] = len(self.chunk_ids)
+            self.chunk_ids.append(chunk_id)
+            self.doc_terms.append(np.fromiter(counts.keys(), dtype=np.int32, count=len(counts)))
+            self.doc_tfs.append(np.fromiter(counts.values(), dtype=np.int32, count=len(counts)))
+        self._postings = None
+
+    def remove(self, chunk_ids):
+        # Removed documents leave a hole until the index is compacted on save
+        for chunk_id in chunk_ids:
+            position = self.positions.pop(chunk_id, None)
+            if position is not None:
+                self.chunk_ids[position] = None
+                self.doc_terms[position] = np.empty(0, dtype=np.int32)
+                self.doc_tfs[position] = np.empty(0, dtype=np.int32)
+        self._postings = None
+
+    def compact(self):
+        keep = [position for position, chunk_id in enumerate(self.chunk_ids) if chunk_id is not None]
+        self.chunk_ids = [self.chunk_ids[position] for position in keep]
+        self.doc_terms = [self.doc_terms[position] for position in keep]
+        self.doc_tfs = [self.doc_tfs[position] for position in keep]
+        self.positions = {chunk_id: position for position, chunk_id in enumerate(self.chunk_ids)}
+        self._postings = None
+
+    def build_postings(self):
+        lengths = np.array([len(terms) for terms in self.doc_terms], dtype=np.int64)
+        terms = np.concatenate(self.doc_terms) if self.doc_terms else np.empty(0, dtype=np.int32)
+        tfs = np.concatenate(self.doc_tfs) if self.doc_tfs else np.empty(0, dtype=np.int32)
+        docs = np.repeat(np.arange(len(self.doc_terms), dtype=np.int32), lengths)
+        order = np.argsort(terms, kind='stable')
+        offsets = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=len(self.vocabulary)), out=offsets[1:])
+
+        doc_lengths = np.array([tf.sum() for tf in self.doc_tfs], dtype=np.float32)
+        live = doc_lengths[list(self.positions.values())]
+        average_length = float(live.mean()) if len(live) else 1.0
+        # Length normalisation does not depend on the query, precompute it per document
+        norms = self.k1 * (1 - self.b + self.b * doc_lengths / max(average_length, 1e-9))
+        self._postings = (offsets, docs[order], tfs[order].astype(np.float32), norms)
+        return self._postings
+
+    def search(self, query, k, mask=None):
+        # mask: boolean array over positions, documents outside it are not returned
+        if not self.positions:
+            return []
+        offsets, docs, tfs, norms = self._postings if self._postings is not None else self.build_postings()
+        query_terms = Counter(self.vocabulary[term] for term in tokenize(query) if term in self.vocabulary)
+        if not query_terms:
+            return []
+
+        num_docs = len(self.positions)
+        scores = np.zeros(len(self.chunk_ids), dtype=np.float32)
+        for term_id, count in query_terms.items():
+            start, end = offsets[term_id], offsets[term_id + 1]
+            if start == end:
+                continue
+            term_docs, term_tfs = docs[start:end], tfs[start:end]
+            document_frequency = end - start
+            idf = np.log(1 + (num_docs - document_frequency + 0.5) / (document_frequency + 0.5))
+            # Each document appears once per term, so a fancy-index add is safe here
+            scores[term_docs] += count * idf * term_tfs * (self.k1 + 1) / (term_tfs + norms[term_docs])
+
+        if mask is not None:
+            scores[~mask] = 0
+        k = min(k, int(np.count_nonzero(scores)))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(self.chunk_ids[position], float(scores[position])) for position in top]
+
+    def save(self, path):
+        self.compact()
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        lengths = np.array([len(doc_terms) for doc_terms in self.doc_terms], dtype=np.int64)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(
+            tmp_path,
+            chunk_ids=np.array(self.chunk_ids, dtype=str),
+            vocabulary=np.array(terms, dtype=str),
+            offsets=offsets,
+            terms=np.concatenate(self.doc_terms) if self.doc_terms else np.empty(0, dtype=np.int32),
+            tfs=np.concatenate(self.doc_tfs) if self.doc_tfs else np.empty(0, dtype=np.int32),
+        )
+        os.replace(tmp_path, path)
+        logging.info(f"Saved BM25 index with {len(self.chunk_ids)} chunks and {len(terms)} terms to {path}")
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        index = cls(**kwargs)
+        with np.load(path) as data:
+            index.vocabulary = {term: term_id for term_id, term in enumerate(data['vocabulary'].tolist())}
+            index.chunk_ids = data['chunk_ids'].tolist()
+            if index.chunk_ids:
+                offsets = data['offsets']
+                index.doc_terms = np.split(data['terms'], offsets[1:-1])
+                index.doc_tfs = np.split(data['tfs'], offsets[1:-1])
+        index.positions = {chunk_id: position for position, chunk_id in enumerate(index.chunk_ids)}
+        logging.info(f"Loaded BM25 index with {len(index)} chunks from {path}")
+        return index
@@ -0,0 +1,261 @@
+import time
+import asyncio
+import logging
+from langchain.chains.combine_documents import create_stuff_documents_chain
+from langchain_core.documents import Document
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import Runnable
+from langchain_core.runnables.config import ensure_config, merge_configs
+from langchain_core.runnables.utils import AddableDict
+from langchain_core.runnables.history import RunnableWithMessageHistory
+from lib.config import config
+from lib.metrics import get_metrics
+from lib.sections import section_label
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+contextualize_q_system_prompt = """Given a chat history and the latest user question \
+    which might reference context in the chat history, formulate a standalone question \
+    which can be understood without the chat history. Do NOT answer the question, \
+    just reformulate it if needed and otherwise return it as is."""
+
+qa_system_prompt = """
+    You are a professional lawyer. Answer accurately and precisely based only on the provided context. \
+    Always reference the laws and sections exactly as used in your answer. Include the relevant sentence or paragraph. \
+    Do not mention anywhere that you have been provided context' \
+    If the answer is not in the given context or you don't know it, state that you don't know the answer. \
+    Create a scenario to explain the law if necessary. \
+    At the end, only for law and legal related question user asked mention the source by naming the laws and the sections. \
+    Always print the links in listed format.
+    Laws referenced in the question: 
+
+    {laws} 
+
+    Context: 
+
+    {context} 
+    """
+
+contextualize_q_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", contextualize_q_system_prompt),
+        MessagesPlaceholder("chat_history"),
+        ("human", "{input}"),
+    ]
+)
+
+qa_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", qa_system_prompt),
+        MessagesPlaceholder("chat_history"),
+        ("human", "{input}"),
+    ]
+)
+
+
+class ConversationalRAG(Runnable):
+    # Same flow as create_history_aware_retriever + create_retrieval_chain, split into explicit
+    # steps so the standalone question can be looked up in the answer cache before retrieval.
+    def __init__(self, chat_model, retriever, answer_cache=None, law_catalog=None, history_window=None,
+                 callbacks=None):
+        self.retriever = retriever
+        self.answer_cache = answer_cache
+        self.law_catalog = law_catalog
+        self.history_window = history_window
+        # Attached to every call, e.g. the MetricsCallbackHandler
+        self.callbacks = callbacks or []
+        self.metrics = get_metrics()
+        # Run names identify the stages in callbacks and traces
+        self.contextualize_chain = (contextualize_q_prompt | chat_model | StrOutputParser()).with_config(
+            run_name="contextualize_question")
+        self.question_answer_chain = create_stuff_documents_chain(chat_model, qa_prompt).with_config(
+            run_name="generate_answer")
+
+    def with_callbacks(self, config):
+        config = ensure_config(config)
+        return merge_configs(config, {"callbacks": self.callbacks}) if self.callbacks else config
+
+    def standalone_question(self, inputs, config=None):
+        if not inputs.get("chat_history"):
+            return inputs["input"]
+        return self.contextualize_chain.invoke(inputs, config=config)
+
+    def documents_for(self, chunk_ids):
+        docstore = self.retriever.vectorstore.docstore
+        documents = [docstore.search(chunk_id) for chunk_id in chunk_ids]
+        return [document for document in documents if isinstance(document, Document)]
+
+    def prepare(self, input):
+        # Only a token-budgeted window of the history is sent, never the whole laws list
+        if self.history_window is not None:
+            input = {**input, "chat_history": self.history_window.apply(input.get("chat_history"))}
+        return {"chat_history": [], **input}
+
+    def referenced_laws(self, input, question):
+        if self.law_catalog is None:
+            return "None"
+        return self.law_catalog.describe(f"{input['input']}\n{question}")
+
+    def answer_input(self, input, question, context):
+        # Chunks are headed with their law and section, so the answer can cite them exactly
+        cited = [Document(page_content=f"[{label}]\n{document.page_content}", metadata=document.metadata)
+                 if (label := section_label(document.metadata)) else document for document in context]
+        return {**input, "context": cited, "laws": self.referenced_laws(input, question)}
+
+    def chunk_ids_of(self, context):
+        return [document.metadata['chunk_id'] for document in context if 'chunk_id' in document.metadata]
+
+    def retrieve(self, input, config=None):
+        # Everything up to the answer generation: returns the cached answer on a hit, otherwise the context
+        question = self.standalone_question(input, config=config)
+        vector = None
+        if self.answer_cache is not None:
+            cached, vector = self.answer_cache.lookup(question)
+            self.metrics.increment("rag_answer_cache_total", result="hit" if cached is not None else "miss")
+            if cached is not None:
+                return question, vector, cached, self.documents_for(cached.chunk_ids)
+        return question, vector, None, self.retriever.invoke(question, config=config)
+
+    async def aretrieve(self, input, config=None):
+        question = input["input"]
+        if input.get("chat_history"):
+            question = await self.contextualize_chain.ainvoke(input, config=config)
+        vector = None
+        if self.answer_cache is not None:
+            cached, vector = await asyncio.to_thread(self.answer_cache.lookup, question)
+            self.metrics.increment("rag_answer_cache_total", result="hit" if cached is not None else "miss")
+            if cached is not None:
+                return question, vector, cached, self.documents_for(cached.chunk_ids)
+        return question, vector, None, await self.retriever.ainvoke(question, config=config)
+
+    def invoke(self, input, config=None, **kwargs):
+        return self._call_with_config(self._invoke, input, self.with_callbacks(config))
+
+    def _invoke(self, input, config=None):
+        started = time.perf_counter()
+        input = self.prepare(input)
+        question, vector, cached, context = self.retrieve(input, config=config)
+        if cached is not None:
+            self.observe_request(started, cached=True)
+            return {**input, "context": context, "answer": cached.answer, "cached": True}
+
+        answer = self.question_answer_chain.invoke(
+            self.answer_input(input, question, context), config=config)
+
+        if self.answer_cache is not None:
+            self.answer_cache.store(question, self.chunk_ids_of(context), answer, vector=vector)
+        self.observe_request(started)
+        return {**input, "context": context, "answer": answer, "cached": False}
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        # Native async path: cancelling the call (e.g. an API timeout) also cancels the model request
+        return await self._acall_with_config(self._ainvoke, input, self.with_callbacks(config))
+
+    async def _ainvoke(self, input, config=None):
+        started = time.perf_counter()
+        input = await asyncio.to_thread(self.prepare, input)
+        question, vector, cached, context = await self.aretrieve(input, config=config)
+        if cached is not None:
+            self.observe_request(started, cached=True)
+            return {**input, "context": context, "answer": cached.answer, "cached": True}
+
+        answer = await self.question_answer_chain.ainvoke(
+            self.answer_input(input, question, context), config=config)
+
+        if self.answer_cache is not None:
+            await asyncio.to_thread(self.answer_cache.store, question, self.chunk_ids_of(context), answer,
+                                    vector=vector)
+        self.observe_request(started)
+        return {**input, "context": context, "answer": answer, "cached": False}
+
+    def stream(self, input, config=None, **kwargs):
+        # Yields the retrieved context as soon as it is known, then the answer token by token
+        yield from self._transform_stream_with_config(iter([input]), self._stream, self.with_callbacks(config))
+
+    async def astream(self, input, config=None, **kwargs):
+        async def input_aiter():
+            yield input
+
+        async for chunk in self._atransform_stream_with_config(input_aiter(), self._astream,
+                                                               self.with_callbacks(config)):
+            yield chunk
+
+    def _stream(self, inputs, config=None):
+        for input in inputs:
+            started = time.perf_counter()
+            input = self.prepare(input)
+            question, vector, cached, context = self.retrieve(input, config=config)
+            retrieved = time.perf_counter()
+            yield AddableDict({**input, "context": context, "cached": cached is not None})
+            if cached is not None:
+                self.log_timings(started, retrieved, time.perf_counter(), cached=True)
+                yield AddableDict(answer=cached.answer)
+                self.observe_request(started, cached=True)
+                continue
+
+            parts = []
+            first_token = None
+            for token in self.question_answer_chain.stream(
+                    self.answer_input(input, question, context), config=config):
+                if first_token is None:
+                    first_token = time.perf_counter()
+                    self.log_timings(started, retrieved, first_token)
+                parts.append(token)
+                yield AddableDict(answer=token)
+
+            if self.answer_cache is not None:
+                self.answer_cache.store(question, self.chunk_ids_of(context), "".join(parts), vector=vector)
+            self.observe_request(started)
+
+    async def _astream(self, inputs, config=None):
+        async for input in inputs:
+            started = time.perf_counter()
+            # Summarising older turns may call the chat model synchronously, keep it off the event loop
+            input = await asyncio.to_thread(self.prepare, input)
+            question, vector, cached, context = await self.aretrieve(input, config=config)
+            retrieved = time.perf_counter()
+            yield AddableDict({**input, "context": context, "cached": cached is not None})
+            if cached is not None:
+                self.log_timings(started, retrieved, time.perf_counter(), cached=True)
+                yield AddableDict(answer=cached.answer)
+                self.observe_request(started, cached=True)
+                continue
+
+            parts = []
+            first_token = None
+            async for token in self.question_answer_chain.astream(
+                    self.answer_input(input, question, context), config=config):
+                if first_token is None:
+                    first_token = time.perf_counter()
+                    self.log_timings(started, retrieved, first_token)
+                parts.append(token)
+                yield AddableDict(answer=token)
+
+            if self.answer_cache is not None:
+                await asyncio.to_thread(self.answer_cache.store, question, self.chunk_ids_of(context),
+                                        "".join(parts), vector=vector)
+            self.observe_request(started)
+
+    def log_timings(self, started, retrieved, first_token, cached=False):
+        self.metrics.observe("rag_time_to_first_token_seconds", first_token - started)
+        logging.info(f"Time to first token: {first_token - started:.3f}s "
+                     f"(retrieval {retrieved - started:.3f}s{', cached answer' if cached else ''})")
+
+    def observe_request(self, started, cached=False):
+        self.metrics.observe("rag_stage_seconds", time.perf_counter() - started, stage="request")
+        self.metrics.increment("rag_requests_total", cached=str(cached).lower())
+
+
+def build_conversational_chain(rag_chain, history_store):
+    return RunnableWithMessageHistory(
+        rag_chain,
+        history_store.get_session_history,
+        input_messages_key="input",
+        history_messages_key="chat_history",
+        output_messages_key="answer",
+    )
@@ -0,0 +1,111 @@
+import re
+import time
+import logging
+from collections import Counter
+from lib.config import config
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+DEFAULT_SOURCE = "gesetze-im-internet"
+
+_INLINE_FLAGS = {re.IGNORECASE: 'i', re.DOTALL: 's', re.MULTILINE: 'm', re.VERBOSE: 'x'}
+
+
+class CleaningRule:
+    def __init__(self, name, pattern, flags=0, first_page_only=False):
+        self.name = name
+        self.pattern = pattern
+        self.flags = flags
+        self.first_page_only = first_page_only
+
+    def scoped_pattern(self):
+        # Flags are scoped to the rule so several rules can share one compiled pattern
+        inline = "".join(letter for flag, letter in _INLINE_FLAGS.items() if self.flags & flag)
+        return f"(?{inline}:{self.pattern})" if inline else f"(?:{self.pattern})"
+
+
+class CleaningStats:
+    def __init__(self):
+        self.hits = Counter()
+        self.pages = 0
+        self.seconds = 0.0
+
+    def merge(self, other):
+        self.hits.update(other['hits'])
+        self.pages += other['pages']
+        self.seconds += other['seconds']
+
+    def as_dict(self):
+        return {'hits': dict(self.hits), 'pages': self.pages, 'seconds': self.seconds}
+
+    def report(self):
+        rules = ", ".join(f"{name}={count}" for name, count in sorted(self.hits.items()))
+        return f"Cleaned {self.pages} pages in {self.seconds:.3f}s, rule hits: {rules or 'none'}"
+
+
+class TextCleaner:
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.page_pattern = self._combine([rule for rule in self.rules if not rule.first_page_only])
+        self.first_page_patterns = [(rule.name, re.compile(rule.pattern, rule.flags))
+                                    for rule in self.rules if rule.first_page_only]
+        self.stats = CleaningStats()
+
+    @staticmethod
+    def _combine(rules):
+        if not rules:
+            return None
+        return re.compile("|".join(f"(?P<{rule.name}>{rule.scoped_pattern()})" for rule in rules))
+
+    def clean_first_page(self, text, stats=None):
+        stats = stats if stats is not None else self.stats
+        start = time.perf_counter()
+        for name, pattern in self.first_page_patterns:
+            text, count = pattern.subn('', text, count=1)
+            stats.hits[name] += count
+        stats.seconds += time.perf_counter() - start
+        return text
+
+    def clean_page(self, text, stats=None):
+        stats = stats if stats is not None else self.stats
+        start = time.perf_counter()
+        if self.page_pattern is not None:
+            def count_and_drop(match):
+                stats.hits[match.lastgroup] += 1
+                return ''
+            text = self.page_pattern.sub(count_and_drop, text)
+        stats.pages += 1
+        stats.seconds += time.perf_counter() - start
+        return text
+
+
+_rules = {}
+_cleaners = {}
+
+
+def register_rule(source, rule):
+    _rules.setdefault(source, []).append(rule)
+    _cleaners.pop(source, None)
+
+
+def get_cleaner(source=DEFAULT_SOURCE):
+    # Cleaners are compiled once per source and reused for every page of that source
+    if source not in _cleaners:
+        if source not in _rules:
+            raise ValueError(f"No cleaning rules registered for source: {source}")
+        _cleaners[source] = TextCleaner(_rules[source])
+    return _cleaners[source]
+
+
+register_rule(DEFAULT_SOURCE, CleaningRule(
+    "translations_banner", r'^(.*?Translations.*?Translations.*?\n)', flags=re.DOTALL, first_page_only=True))
+register_rule(DEFAULT_SOURCE, CleaningRule(
+    "header", r"Service provided by the Federal Ministry of Justice\s+and the Federal Office of Justice ‒ www\.gesetze\s+-im-internet\.de\s+"))
+register_rule(DEFAULT_SOURCE, CleaningRule(
+    "page_number", r'Page\s+\d+\s+of\s+\d+', flags=re.IGNORECASE | re.DOTALL))
+
+get_cleaner(DEFAULT_SOURCE)
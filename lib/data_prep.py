@@ -1,10 +1,12 @@
 import os
-import re
 import logging
 from langchain_community.document_loaders import PyPDFLoader
+from langchain_core.documents import Document
+from collections import deque
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 from lib.config import config
+from lib.cleaning import DEFAULT_SOURCE, CleaningStats, get_cleaner
 
 # Configure logging
 logging.basicConfig(level=config['logging']['level'],
@@ -14,72 +16,109 @@ logging.basicConfig(level=config['logging']['level'],
                     encoding='utf-8')
 
 class PDFCleaner:
-    def __init__(self, file_path):
+    def __init__(self, file_path, source=DEFAULT_SOURCE):
         self.file_path = file_path
+        self.cleaner = get_cleaner(source)
+        self.stats = CleaningStats()
         self.loader = PyPDFLoader(file_path)
         self.pages = self.loader.load_and_split()
         logging.info(f"Loaded and split PDF: {file_path}")
     
-    def clean_first_page(self, progress_bar):
-        pattern = r'^(.*?Translations.*?Translations.*?\n)'
+    def clean_first_page(self, progress_bar=None):
         first_page = self.pages[0]
-        text_content = first_page.page_content
-        
-        cleaned_text = re.sub(pattern, '', text_content, count=1, flags=re.DOTALL)
-        first_page.page_content = cleaned_text
+        first_page.page_content = self.cleaner.clean_first_page(first_page.page_content, self.stats)
         self.pages[0] = first_page
         
-        progress_bar.update(1)
+        if progress_bar is not None:
+            progress_bar.update(1)
         logging.info(f"Cleaned first page of PDF: {self.file_path}")
 
         return self.pages
     
-    def clean_headers_and_page_numbers(self, progress_bar):
+    def clean_headers_and_page_numbers(self, progress_bar=None):
         logging.info(f"Started cleaning headers and page numbers for PDF: {self.file_path}")
         
-        # Define patterns for header and page number
-        header_pattern = r"Service provided by the Federal Ministry of Justice\s+and the Federal Office of Justice ‒ www\.gesetze\s+-im-internet\.de\s+"
-
-        page_number_pattern = re.compile(r'Page\s+\d+\s+of\s+\d+', re.IGNORECASE | re.DOTALL)
-        
-        # Process each page to remove headers and page numbers
+        # Headers and page numbers are removed in a single pass with the precompiled rule set
         for page in self.pages:
-            page_content = page.page_content
-            
-            # Clean the headers and page numbers from the content
-            cleaned_content = re.sub(header_pattern,'', page_content)
-            cleaned_content = page_number_pattern.sub('', cleaned_content)
-            page.page_content = cleaned_content
+            page.page_content = self.cleaner.clean_page(page.page_content, self.stats)
             
-            progress_bar.update(1)
+            if progress_bar is not None:
+                progress_bar.update(1)
         
         logging.info(f"Finished cleaning headers and page numbers for PDF: {self.file_path}")
         return self.pages
 
 
+def extract_pdf(file_path):
+    # Runs in a worker process. Pages are returned as plain records, which are
+    # much cheaper to pickle back to the parent than Document objects. None instead
+    # of the pages means the PDF could not be read, which an empty PDF is not.
+    try:
+        pdf_cleaner = PDFCleaner(file_path)
+        if not pdf_cleaner.pages:
+            return [], pdf_cleaner.stats.as_dict()
+        pdf_cleaner.clean_first_page()
+        pages = pdf_cleaner.clean_headers_and_page_numbers()
+        return [(page.page_content, page.metadata) for page in pages], pdf_cleaner.stats.as_dict()
+    except Exception as e:
+        logging.error(f"Error processing PDF {file_path}: {e}")
+        return None, CleaningStats().as_dict()
+
+
+def extract_pdfs(file_paths):
+    return [(file_path, *extract_pdf(file_path)) for file_path in file_paths]
+
+
 class PDFProcessor:
-    def __init__(self, file_paths):
+    def __init__(self, file_paths, max_workers=config['pdf_processing']['max_workers'],
+                 task_chunksize=config['pdf_processing']['task_chunksize']):
+        # file_paths may be any iterable, e.g. a generator fed by the downloader
         self.file_paths = file_paths
-    
+        self.max_workers = max_workers or os.cpu_count()
+        self.task_chunksize = task_chunksize
+        self.cleaning_stats = CleaningStats()
+
+    def _task_chunks(self):
+        chunk = []
+        for file_path in self.file_paths:
+            chunk.append(file_path)
+            if len(chunk) == self.task_chunksize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def iter_pdfs(self):
+        # Yields (file_path, cleaned pages) one PDF at a time, in input order, pages None for unreadable PDFs.
+        # Only a bounded number of tasks is in flight, so the input is consumed lazily.
+        total = len(self.file_paths) if hasattr(self.file_paths, '__len__') else None
+        max_in_flight = self.max_workers * 2
+        with tqdm(total=total, desc="Process PDFs: ", unit="pdf") as progress_bar:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                pending = deque()
+                chunks = self._task_chunks()
+                while True:
+                    while len(pending) < max_in_flight:
+                        chunk = next(chunks, None)
+                        if chunk is None:
+                            break
+                        pending.append(executor.submit(extract_pdfs, chunk))
+                    if not pending:
+                        break
+                    for file_path, records, stats in pending.popleft().result():
+                        self.cleaning_stats.merge(stats)
+                        progress_bar.update(1)
+                        yield file_path, ([Document(page_content=content, metadata=metadata)
+                                           for content, metadata in records] if records is not None else None)
+        logging.info(self.cleaning_stats.report())
+
     def process_pdfs(self):
         logging.info("Started processing PDFs")
-        total_steps = sum(len(PyPDFLoader(file_path).load_and_split()) + 1 for file_path in self.file_paths)
         cleaned_pages_list = []
-        
-        with tqdm(total=total_steps, desc="Process PDFs: ") as progress_bar:
-            with ThreadPoolExecutor(max_workers=4) as executor:
-                results = list(executor.map(self._process_single_pdf, [(file_path, progress_bar) for file_path in self.file_paths]))
-                for cleaned_pages in results:
-                    cleaned_pages_list.extend(cleaned_pages)
-        
+        for _, cleaned_pages in self.iter_pdfs():
+            cleaned_pages_list.extend(cleaned_pages or [])
         logging.info("Finished processing all PDFs")
         return cleaned_pages_list
-    
-    def _process_single_pdf(self, args):
-        file_path, progress_bar = args
-        pdf_cleaner = PDFCleaner(file_path)
-        pdf_cleaner.clean_first_page(progress_bar)
-        return pdf_cleaner.clean_headers_and_page_numbers(progress_bar)
 
 def load_and_process_pdfs(pdf_folder_path=config['pdf_processing']['pdf_folder_path']):
     logging.info(f"Loading and processing PDFs from folder: {pdf_folder_path}")
@@ -0,0 +1,166 @@
+import os
+import time
+import random
+import logging
+import threading
+from urllib.parse import urlparse
+from email.utils import formatdate, parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+from lib.config import config
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class RetryableError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class HostRateLimiter:
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self._next_slot = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        if not self.interval:
+            return
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class PDFDownloader:
+    def __init__(self, max_workers=config['scraper']['download']['max_workers'],
+                 requests_per_second=config['scraper']['download']['requests_per_second'],
+                 max_retries=config['scraper']['download']['max_retries'],
+                 backoff_base=config['scraper']['download']['backoff_base'],
+                 backoff_max=config['scraper']['download']['backoff_max'],
+                 timeout=config['scraper']['download']['timeout'],
+                 chunk_size=1 << 16):
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.rate_limiter = HostRateLimiter(requests_per_second)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def backoff_delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def iter_download(self, jobs):
+        # jobs: list of (law, url, path, title); law dicts receive 'etag' and 'last_modified'.
+        # Yields (job, status) as soon as each download finishes.
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.download, *job): job for job in jobs}
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Downloading PDFs"):
+                job = futures[future]
+                try:
+                    status = future.result()
+                except Exception as e:
+                    status = 'failed'
+                    logging.error(f"Failed to download {job[3]}: {e}")
+                    tqdm.write(f"Failed to download {job[3]}: {e}")
+                yield job, status
+
+    def download_all(self, jobs):
+        results = {'downloaded': 0, 'not_modified': 0, 'failed': 0}
+        for _, status in self.iter_download(jobs):
+            results[status] += 1
+        logging.info(f"Download finished: {results}")
+        return results
+
+    def download(self, law, url, path, title):
+        for attempt in range(self.max_retries):
+            try:
+                return self._fetch(law, url, path, title)
+            except RetryableError as e:
+                delay = self.backoff_delay(attempt, e.retry_after)
+            except requests.exceptions.HTTPError:
+                # Client errors such as 404 will not go away by retrying
+                raise
+            except requests.exceptions.RequestException:
+                delay = self.backoff_delay(attempt)
+            logging.error(f"Attempt {attempt + 1} failed for {title}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+        raise Exception(f"Failed to download {title} after {self.max_retries} attempts")
+
+    def conditional_headers(self, law, path):
+        headers = {}
+        if not os.path.exists(path):
+            return headers
+        if law.get('etag'):
+            headers['If-None-Match'] = law['etag']
+        if law.get('last_modified'):
+            headers['If-Modified-Since'] = law['last_modified']
+        elif not law.get('etag'):
+            headers['If-Modified-Since'] = formatdate(os.path.getmtime(path), usegmt=True)
+        return headers
+
+    def _fetch(self, law, url, path, title):
+        part_path = f"{path}.part"
+        headers = self.conditional_headers(law, path)
+        resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if resume_from and law.get('partial_etag'):
+            # Resume an interrupted download, but only if the file did not change meanwhile
+            headers['Range'] = f"bytes={resume_from}-"
+            headers['If-Range'] = law['partial_etag']
+        else:
+            resume_from = 0
+
+        self.rate_limiter.wait(url)
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 304:
+                logging.info(f"Not modified: {title}")
+                return 'not_modified'
+            if response.status_code == 416 and resume_from:
+                # The partial file is already complete or longer than the remote one: start over
+                logging.warning(f"Cannot resume {title} at byte {resume_from}, downloading it again")
+                os.remove(part_path)
+                law.pop('partial_etag', None)
+                raise RetryableError("HTTP 416", retry_after=0)
+            if response.status_code in RETRY_STATUS_CODES:
+                retry_after = response.headers.get('Retry-After')
+                raise RetryableError(f"HTTP {response.status_code}",
+                                     retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None)
+            response.raise_for_status()
+
+            etag = response.headers.get('ETag')
+            law['partial_etag'] = etag
+            mode = 'ab' if response.status_code == 206 and resume_from else 'wb'
+            with open(part_path, mode) as part_file:
+                for block in response.iter_content(chunk_size=self.chunk_size):
+                    part_file.write(block)
+
+            os.replace(part_path, path)
+            law.pop('partial_etag', None)
+            law['etag'] = etag
+            law['last_modified'] = response.headers.get('Last-Modified')
+            if law['last_modified']:
+                timestamp = parsedate_to_datetime(law['last_modified']).timestamp()
+                os.utime(path, (timestamp, timestamp))
+
+        logging.info(f"Downloaded: {title}")
+        return 'downloaded'
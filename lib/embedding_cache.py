@@ -0,0 +1,145 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import unicodedata
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from lib.config import config
+from lib.embedding_executor import EmbeddingExecutor
+from lib.metrics import get_metrics
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+
+def normalize_text(text):
+    return " ".join(unicodedata.normalize('NFC', text).split())
+
+
+def cache_key(model, text):
+    return hashlib.sha256(f"{model}\x00{normalize_text(text)}".encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, path=config['embeddings']['cache']['path'], max_entries=config['embeddings']['cache']['max_entries']):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, model TEXT NOT NULL, dim INTEGER NOT NULL, "
+            "vector BLOB NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings(last_access)")
+        self._conn.commit()
+        logging.info(f"Embedding cache opened at {self.path} with {len(self)} entries")
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def get_many(self, keys):
+        found = {}
+        now = time.time()
+        with self._lock:
+            # SQLite limits the number of host parameters per statement
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+                self._conn.executemany("UPDATE embeddings SET last_access = ? WHERE key = ?",
+                                       [(now, key) for key, _ in rows])
+            self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(set(keys)) - len(found)
+        return found
+
+    def put_many(self, model, items):
+        now = time.time()
+        rows = [(key, model, len(vector), np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in items]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.commit()
+        self.evict()
+
+    def evict(self):
+        if not self.max_entries:
+            return
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            overflow = count - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?)", (overflow,)
+                )
+                self._conn.commit()
+                self.evictions += overflow
+                logging.info(f"Evicted {overflow} embeddings from cache")
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings, model, cache=None):
+        self.embeddings = embeddings
+        self.model = model
+        self.cache = cache if cache is not None else EmbeddingCache()
+
+    def embed_documents(self, texts, token_counts=None):
+        keys = [cache_key(self.model, text) for text in texts]
+        cached = self.cache.get_many(list(set(keys)))
+
+        missing, missing_counts = {}, []
+        for position, (key, text) in enumerate(zip(keys, texts)):
+            if key not in cached and key not in missing:
+                missing[key] = text
+                missing_counts.append(token_counts[position] if token_counts else None)
+        if missing:
+            if isinstance(self.embeddings, EmbeddingExecutor):
+                vectors = self.embeddings.embed_documents(list(missing.values()), token_counts=missing_counts)
+            else:
+                vectors = self.embeddings.embed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(self.model, computed.items())
+            cached.update(computed)
+
+        logging.info(f"Embedded {len(texts)} texts, {len(missing)} cache misses")
+        return [list(cached[key]) for key in keys]
+
+    def embed_query(self, text):
+        key = cache_key(self.model, text)
+        cached = self.cache.get_many([key])
+        get_metrics().increment("rag_embedding_cache_total", result="hit" if key in cached else "miss")
+        if key in cached:
+            return cached[key]
+        vector = self.embeddings.embed_query(text)
+        self.cache.put_many(self.model, [(key, vector)])
+        return vector
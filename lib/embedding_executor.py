@@ -0,0 +1,128 @@
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.embeddings import Embeddings
+from openai import APIConnectionError, BadRequestError, InternalServerError, RateLimitError
+from lib.config import config
+from lib.indexing import token_length
+from lib.metrics import get_metrics, stage_timer
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+# Transient failures worth sending again (APITimeoutError is an APIConnectionError); auth and
+# request errors fail the same way every time
+RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APIConnectionError)
+
+
+class TokenBudget:
+    # Token bucket refilled continuously, allows tokens_per_minute on average
+    def __init__(self, tokens_per_minute):
+        self.tokens_per_minute = tokens_per_minute
+        self.available = float(tokens_per_minute or 0)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens):
+        if not self.tokens_per_minute:
+            return
+        # A request larger than the whole bucket only waits for a full bucket
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.available = min(self.tokens_per_minute,
+                                     self.available + (now - self.updated) * self.tokens_per_minute / 60)
+                self.updated = now
+                if self.available >= tokens:
+                    self.available -= tokens
+                    return
+                wait = (tokens - self.available) * 60 / self.tokens_per_minute
+            time.sleep(wait)
+
+
+def pack(token_counts, max_batch_tokens, max_batch_size):
+    # Consecutive texts are grouped into requests below both limits, returns lists of positions
+    batches, batch, tokens = [], [], 0
+    for position, count in enumerate(token_counts):
+        if batch and (tokens + count > max_batch_tokens or len(batch) >= max_batch_size):
+            batches.append(batch)
+            batch, tokens = [], 0
+        batch.append(position)
+        tokens += count
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class EmbeddingExecutor(Embeddings):
+    # Sends embedding requests packed by token count, several at a time, under a tokens per
+    # minute budget. Works with any Embeddings, e.g. OpenAIEmbeddings pointed at a local server.
+    def __init__(self, embeddings, max_batch_tokens=config['embeddings']['executor']['max_batch_tokens'],
+                 max_batch_size=config['embeddings']['executor']['max_batch_size'],
+                 max_concurrency=config['embeddings']['executor']['max_concurrency'],
+                 tokens_per_minute=config['embeddings']['executor']['tokens_per_minute'],
+                 max_retries=config['embeddings']['executor']['max_retries'],
+                 backoff_base=config['embeddings']['executor']['backoff_base'],
+                 backoff_max=config['embeddings']['executor']['backoff_max']):
+        self.embeddings = embeddings
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.budget = TokenBudget(tokens_per_minute)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="embed")
+
+    def backoff_delay(self, attempt):
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def request(self, func, texts, tokens):
+        for attempt in range(self.max_retries + 1):
+            self.budget.acquire(tokens)
+            try:
+                with stage_timer("embed_request"):
+                    return func(texts)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff_delay(attempt)
+                logging.warning(f"Embedding request of {len(texts)} texts failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+    def embed_batch(self, texts, token_counts):
+        try:
+            return self.request(self.embeddings.embed_documents, texts, sum(token_counts))
+        except BadRequestError as e:
+            if len(texts) == 1:
+                raise
+            # A single bad input fails the whole request, the others should still get through
+            get_metrics().increment("rag_embedding_batch_failures_total")
+            logging.error(f"Embedding batch of {len(texts)} texts failed ({e}), retrying them individually")
+            return [self.request(self.embeddings.embed_documents, [text], count)[0]
+                    for text, count in zip(texts, token_counts)]
+
+    def embed_documents(self, texts, token_counts=None):
+        # token_counts may come from splitting (metadata['token_count']), missing ones are counted here
+        if not texts:
+            return []
+        token_counts = token_counts or [None] * len(texts)
+        token_counts = [count if count is not None else token_length(text) for text, count in zip(texts, token_counts)]
+        batches = pack(token_counts, self.max_batch_tokens, self.max_batch_size)
+        futures = [self._executor.submit(self.embed_batch, [texts[position] for position in batch],
+                                         [token_counts[position] for position in batch])
+                   for batch in batches]
+        vectors = []
+        for future in futures:
+            vectors.extend(future.result())
+        logging.info(f"Embedded {len(texts)} texts ({sum(token_counts)} tokens) in {len(batches)} requests")
+        return vectors
+
+    def embed_query(self, text):
+        return self.request(lambda texts: self.embeddings.embed_query(texts[0]), [text], token_length(text))
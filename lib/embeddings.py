@@ -0,0 +1,58 @@
+import re
+import hashlib
+import logging
+from functools import lru_cache
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from lib.config import config
+from lib.embedding_cache import CachedEmbeddings, EmbeddingCache
+from lib.embedding_executor import EmbeddingExecutor
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+
+class HashEmbeddings(Embeddings):
+    # Deterministic offline embedder: hashed bag of words, L2 normalized.
+    # Texts sharing words get similar vectors, which is enough for tests and benchmarks.
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in re.findall(r"\w+|§", text.lower()):
+            digest = hashlib.md5(token.encode('utf-8')).digest()
+            index = int.from_bytes(digest[:4], 'little') % self.dim
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector.tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+@lru_cache(maxsize=None)
+def get_embeddings(model=config['embeddings']['model']):
+    # One shared client (and cache connection) per model for the whole process
+    if model == 'hash':
+        embeddings = HashEmbeddings()
+    else:
+        from langchain_openai import OpenAIEmbeddings
+        # Requests are packed, retried and rate limited by the executor; chunks are far below the
+        # model context, so texts are sent as they are instead of being tokenized once more
+        embeddings = EmbeddingExecutor(OpenAIEmbeddings(
+            model=model, base_url=config['embeddings']['base_url'], max_retries=0,
+            check_embedding_ctx_length=False, chunk_size=config['embeddings']['executor']['max_batch_size']))
+
+    if config['embeddings']['cache']['enabled']:
+        logging.info(f"Using cached embeddings for model: {model}")
+        return CachedEmbeddings(embeddings, model=model, cache=EmbeddingCache())
+    return embeddings
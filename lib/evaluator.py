@@ -1,12 +1,17 @@
 import os
 import json
+import math
+import random
+import asyncio
 import nest_asyncio
 import openai
 import logging
+from langchain_community.chat_models.fake import FakeListChatModel
 from langchain_openai import ChatOpenAI
 from dotenv import load_dotenv
 from langchain.chains import RetrievalQA
 from ragas.integrations.langchain import EvaluatorChain
+from ragas.run_config import RunConfig
 from ragas.metrics import (
     faithfulness,
     answer_relevancy,
@@ -24,26 +29,58 @@ logging.basicConfig(level=config['logging']['level'],
                     filemode=config['logging']['filemode'],
                     encoding='utf-8')
 
+# One JSON object that parses for the single-object ragas prompts (context precision, answer
+# relevancy and correctness); list-shaped metrics score NaN. Only useful to test the pipeline offline.
+STUB_RESPONSE = json.dumps({"reason": "stub", "verdict": 1, "question": "stub", "noncommittal": 0,
+                            "TP": [], "FP": [], "FN": []})
+
+
+def stub_chat_model():
+    return FakeListChatModel(responses=[STUB_RESPONSE])
+
+
+def is_missing(score):
+    # ragas scores NaN when it cannot parse the model's output, such scores are computed again
+    return score is None or (isinstance(score, float) and math.isnan(score))
+
+
 class EvaluationPipeline:
-    def __init__(self, api_key_env_var='OPENAI_API_KEY', model='gpt-4', temperature=0, max_tokens=None):
+    def __init__(self, api_key_env_var='OPENAI_API_KEY', model='gpt-4', temperature=0, max_tokens=None,
+                 metric_llm=None, metric_embeddings=None,
+                 max_concurrency=config['evaluation']['max_concurrency'],
+                 max_retries=config['evaluation']['max_retries'],
+                 backoff_base=config['evaluation']['backoff_base'],
+                 backoff_max=config['evaluation']['backoff_max'],
+                 timeout=config['evaluation']['timeout']):
         logging.info("Initializing EvaluationPipeline")
         load_dotenv()
         self.api_key = os.environ.get(api_key_env_var)
         openai.api_key = self.api_key
         nest_asyncio.apply()
-        self.llm = ChatOpenAI(
+        # metric_llm / metric_embeddings replace the OpenAI defaults of the metrics, e.g. for offline runs
+        self.llm = metric_llm or ChatOpenAI(
             model=model,
             temperature=temperature,
             max_tokens=max_tokens
         )
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
         self.qa_chain = None
+        # Retries are handled by evaluate_metric, ragas itself tries every call only once
+        metric_kwargs = {'run_config': RunConfig(timeout=timeout, max_retries=1)}
+        if metric_llm is not None:
+            metric_kwargs['llm'] = metric_llm
+        if metric_embeddings is not None:
+            metric_kwargs['embeddings'] = metric_embeddings
         self.metric_chains = {
-            'faithfulness': EvaluatorChain(metric=faithfulness),
-            'answer_relevancy': EvaluatorChain(metric=answer_relevancy),
-            'context_precision': EvaluatorChain(metric=context_precision),
-            'context_recall': EvaluatorChain(metric=context_recall),
-            'answer_correctness': EvaluatorChain(metric=answer_correctness),
-            'answer_similarity': EvaluatorChain(metric=answer_similarity)
+            'faithfulness': EvaluatorChain(metric=faithfulness, **metric_kwargs),
+            'answer_relevancy': EvaluatorChain(metric=answer_relevancy, **metric_kwargs),
+            'context_precision': EvaluatorChain(metric=context_precision, **metric_kwargs),
+            'context_recall': EvaluatorChain(metric=context_recall, **metric_kwargs),
+            'answer_correctness': EvaluatorChain(metric=answer_correctness, **metric_kwargs),
+            'answer_similarity': EvaluatorChain(metric=answer_similarity, **metric_kwargs)
         }
         self.result = []
         logging.info("EvaluationPipeline initialized successfully")
@@ -68,36 +105,100 @@ class EvaluationPipeline:
             logging.error(f"Failed to load dataset: {e}")
             raise
 
-    def evaluate(self, eval_dataset):
-        logging.info("Starting evaluation of the dataset")
-        for data in tqdm(eval_dataset, desc="Evaluating dataset"):
-            inputs = []
+    def samples(self, eval_dataset):
+        samples = []
+        for data in eval_dataset:
             for q, a, c, gt in zip(data["question"], data["answer"], data["contexts"], data["ground_truth"]):
-                inputs.append({
+                samples.append({
                     "question": q,
                     "answer": a,
                     "contexts": c,
                     "ground_truth": gt
                 })
+        return samples
+
+    def load_checkpoint(self, samples, checkpoint_path):
+        # Scores of a previous, possibly interrupted run are reused for the samples that did not change
+        results = [{
+            'question': sample['question'],
+            'answer': sample['answer'],
+            'context': sample['contexts'],
+            'ground_truth': sample['ground_truth']
+        } for sample in samples]
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            with open(checkpoint_path, "r", encoding='utf-8') as file:
+                previous = json.load(file)
+            reused = 0
+            for result, old in zip(results, previous):
+                if all(old.get(key) == result[key] for key in ('question', 'answer', 'context', 'ground_truth')):
+                    for metric_name in self.metric_chains:
+                        if not is_missing(old.get(metric_name)):
+                            result[metric_name] = old[metric_name]
+                            reused += 1
+            logging.info(f"Resuming evaluation from {checkpoint_path} with {reused} scores already computed")
+        return results
 
-            for input_data in inputs:
-                result_template = {
-                    'question': input_data['question'],
-                    'answer': input_data['answer'],
-                    'context': input_data['contexts'],
-                    'ground_truth': input_data['ground_truth']
-                }
-                for metric_name, chain in self.metric_chains.items():
-                    result_template[metric_name] = chain.invoke(input_data)[metric_name]
-                self.result.append(result_template)
+    def backoff_delay(self, attempt):
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def evaluate_metric(self, semaphore, metric_name, input_data):
+        chain = self.metric_chains[metric_name]
+        for attempt in range(self.max_retries + 1):
+            async with semaphore:
+                try:
+                    return (await chain.ainvoke(input_data))[metric_name]
+                except openai.RateLimitError:
+                    if attempt == self.max_retries:
+                        raise
+            delay = self.backoff_delay(attempt)
+            logging.warning(f"Rate limited on {metric_name}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def aevaluate(self, eval_dataset, checkpoint_path=None):
+        # Every sample x metric pair is an independent task, at most max_concurrency of them
+        # talk to the API at the same time
+        logging.info("Starting evaluation of the dataset")
+        samples = self.samples(eval_dataset)
+        self.result = self.load_checkpoint(samples, checkpoint_path)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def run(position, metric_name):
+            try:
+                return position, metric_name, await self.evaluate_metric(semaphore, metric_name, samples[position])
+            except Exception as e:
+                logging.error(f"Failed to compute {metric_name} for '{samples[position]['question']}': {e}")
+                return position, metric_name, None
+
+        tasks = [asyncio.ensure_future(run(position, metric_name))
+                 for position, result in enumerate(self.result)
+                 for metric_name in self.metric_chains if metric_name not in result]
+        failed = 0
+        for task in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Evaluating dataset"):
+            position, metric_name, score = await task
+            if is_missing(score):
+                failed += 1
+                continue
+            self.result[position][metric_name] = score
+            if checkpoint_path:
+                self.save_results(checkpoint_path)
+        if failed:
+            logging.warning(f"{failed} scores could not be computed, run the evaluation again to resume")
         logging.info("Evaluation completed successfully")
+        return self.result
+
+    def evaluate(self, eval_dataset, checkpoint_path=None):
+        return asyncio.run(self.aevaluate(eval_dataset, checkpoint_path))
 
     def save_results(self, filepath):
         logging.info(f"Saving results to {filepath}")
         try:
-            with open(filepath, "w", encoding='utf-8') as file:
+            # Written next to the target and swapped in, an interrupted write never loses the checkpoint
+            tmp_filepath = f"{filepath}.tmp"
+            with open(tmp_filepath, "w", encoding='utf-8') as file:
                 json.dump(self.result, file, indent=4)
+            os.replace(tmp_filepath, filepath)
             logging.info("Results saved successfully")
         except Exception as e:
             logging.error(f"Failed to save results: {e}")
-            raise
\ No newline at end of file
+            raise
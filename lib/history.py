@@ -0,0 +1,92 @@
+import hashlib
+import logging
+from collections import OrderedDict
+from langchain_core.messages import BaseMessage, SystemMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from lib.config import config
+from lib.indexing import token_length
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+summarize_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", "Summarize the following conversation between a user and a legal assistant in at most "
+                   "{max_words} words. Keep the laws, sections and facts the user asked about."),
+        ("human", "{conversation}"),
+    ]
+)
+
+
+def message_role_and_content(message):
+    if isinstance(message, BaseMessage):
+        return message.type, message.content
+    if isinstance(message, dict):
+        return message["role"], message["content"]
+    return message[0], message[1]
+
+
+class HistoryWindow:
+    # Keeps the most recent turns that fit into max_tokens and replaces everything older
+    # with a single summary message, so prompts do not grow with the conversation.
+    def __init__(self, chat_model=None, max_tokens=config['history']['max_tokens'],
+                 summary_max_tokens=config['history']['summary_max_tokens'], cache_size=256):
+        self.max_tokens = max_tokens
+        self.summary_max_tokens = summary_max_tokens
+        self.summarize_chain = summarize_prompt | chat_model | StrOutputParser() if chat_model is not None else None
+        self.cache_size = cache_size
+        self._summaries = OrderedDict()
+
+    def apply(self, messages):
+        messages = list(messages or [])
+        budget = self.max_tokens
+        kept = []
+        for message in reversed(messages):
+            _, content = message_role_and_content(message)
+            cost = token_length(str(content))
+            if cost > budget:
+                break
+            kept.append(message)
+            budget -= cost
+        kept.reverse()
+
+        older = messages[:len(messages) - len(kept)]
+        if not older:
+            return kept
+        logging.info(f"History window keeps {len(kept)} messages and summarizes {len(older)} older ones")
+        summary = self.summarize(older)
+        return ([SystemMessage(content=f"Summary of the earlier conversation: {summary}")] if summary else []) + kept
+
+    def summarize(self, messages):
+        # Summaries are cached per message prefix, so each turn only folds the newly dropped
+        # messages into the previous summary instead of summarizing everything again
+        if self.summarize_chain is None:
+            return None
+        prefix_keys = []
+        key = ""
+        for role, content in map(message_role_and_content, messages):
+            key = hashlib.sha256(f"{key}\x00{role}\x00{content}".encode('utf-8')).hexdigest()
+            prefix_keys.append(key)
+        if prefix_keys[-1] in self._summaries:
+            self._summaries.move_to_end(prefix_keys[-1])
+            return self._summaries[prefix_keys[-1]]
+
+        start, previous = 0, None
+        for index in range(len(prefix_keys) - 2, -1, -1):
+            if prefix_keys[index] in self._summaries:
+                start, previous = index + 1, self._summaries[prefix_keys[index]]
+                break
+        lines = [f"Summary so far: {previous}"] if previous else []
+        lines.extend(f"{role}: {content}" for role, content in map(message_role_and_content, messages[start:]))
+        summary = self.summarize_chain.invoke({
+            "conversation": "\n".join(lines),
+            "max_words": max(20, self.summary_max_tokens * 3 // 4),
+        })
+        self._summaries[prefix_keys[-1]] = summary
+        if len(self._summaries) > self.cache_size:
+            self._summaries.popitem(last=False)
+        return summary
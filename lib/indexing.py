@@ -1,7 +1,14 @@
+import os
 import logging
+from collections import deque
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+import tiktoken
 from tqdm import tqdm
+from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from lib.config import config
+from lib.sections import split_law
 
 # Configure logging
 logging.basicConfig(level=config['logging']['level'],
@@ -10,28 +17,155 @@ logging.basicConfig(level=config['logging']['level'],
                     filemode=config['logging']['filemode'],
                     encoding='utf-8')
 
+ENCODING_NAME = "gpt2"
+SEPARATORS = ['\n', '\n\n', ',', '.']
+
+
+@lru_cache(maxsize=None)
+def get_encoder(encoding_name=ENCODING_NAME):
+    return tiktoken.get_encoding(encoding_name)
+
+
+@lru_cache(maxsize=config['indexing']['token_cache_size'])
+def token_length(text):
+    # The recursive splitter measures the same segments again on every merge attempt;
+    # caching makes each distinct segment tokenized only once per process.
+    return len(get_encoder().encode(text, allowed_special=set(), disallowed_special="all"))
+
+
+def with_token_counts(documents):
+    # Stored with each chunk so embedding requests can be packed by tokens without tokenizing again
+    for document in documents:
+        document.metadata['token_count'] = token_length(document.page_content)
+    return documents
+
+
+def split_records(records, text_splitter, structure=False):
+    # records: (page_content, metadata) pairs of one source. Laws with Section/Article headings
+    # are split section by section, anything else page by page. Returns None when the source
+    # could not be split, which is not the same as a source without any text.
+    if structure and records:
+        try:
+            splits = split_law(records, text_splitter)
+            if splits is not None:
+                return with_token_counts([Document(page_content=content, metadata=metadata)
+                                          for content, metadata in splits])
+        except Exception as e:
+            logging.error(f"Error splitting document by sections, splitting it page by page: {e}")
+    splits = []
+    for content, metadata in records:
+        try:
+            splits.extend(with_token_counts(
+                text_splitter.split_documents([Document(page_content=content, metadata=metadata)])))
+        except Exception as e:
+            logging.error(f"Error splitting document {metadata.get('source')}: {e}")
+            return None
+    return splits
+
+
+_worker_splitter = None
+_worker_structure = False
+
+
+def _init_split_worker(chunk_size, chunk_overlap, structure=False):
+    global _worker_splitter, _worker_structure
+    _worker_splitter = Indexing().create_text_splitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    _worker_structure = structure
+
+
+def _split_records(groups):
+    # Runs in a worker process on plain (page_content, metadata) records
+    results = []
+    for key, records in groups:
+        splits = split_records(records, _worker_splitter, _worker_structure) if records is not None else None
+        results.append((key, [(document.page_content, document.metadata) for document in splits]
+                        if splits is not None else None))
+    return results
+
+
 class Indexing:
-    def __init__(self):
-        pass
-    
+    def __init__(self, max_workers=config['indexing']['max_workers'], task_chunksize=config['indexing']['task_chunksize'],
+                 structure=config['indexing']['structure']):
+        self.max_workers = max_workers or os.cpu_count()
+        self.task_chunksize = task_chunksize
+        # Law PDFs are split at their Section/Article headings first, see lib/sections.py
+        self.structure = structure
+        self.chunk_size = config['pdf_processing']['chunk_size']
+        self.chunk_overlap = config['pdf_processing']['chunk_overlap']
+
     def create_text_splitter(self, chunk_size=config['pdf_processing']['chunk_size'], chunk_overlap=config['pdf_processing']['chunk_overlap']):
-        return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-            separators=['\n', '\n\n', ',', '.'],
+        # Same splitting as RecursiveCharacterTextSplitter.from_tiktoken_encoder, with a cached length function
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        return RecursiveCharacterTextSplitter(
+            separators=SEPARATORS,
             chunk_size=chunk_size,
             chunk_overlap=chunk_overlap,
+            length_function=token_length,
         )
-    
+
+    def groups(self, documents):
+        # With structure a law is split as a whole, so its consecutive pages form one group
+        groups = []
+        for document in documents:
+            if self.structure and groups and groups[-1][1][0].metadata.get('source') == document.metadata.get('source'):
+                groups[-1][1].append(document)
+            else:
+                groups.append((len(groups), [document]))
+        return groups
+
     def split_documents(self, documents, text_splitter):
+        if self.max_workers <= 1 or len(documents) < self.task_chunksize * 2:
+            return self._split_serial(documents, text_splitter)
+
+        all_splits = []
+        groups = self.groups(documents)
+        with tqdm(total=len(documents), desc="Splitting documents") as progress_bar:
+            for key, splits in self.iter_split(groups):
+                all_splits.extend(splits or [])
+                progress_bar.update(len(groups[key][1]))
+        return all_splits
+
+    def _split_serial(self, documents, text_splitter):
         total_docs = len(documents)
         all_splits = []
-        
+
         with tqdm(total=total_docs, desc="Splitting documents") as progress_bar:
-            for document in documents:
-                try:
-                    splits = text_splitter.split_documents([document])
-                    all_splits.extend(splits)
-                    progress_bar.update(1)
-                except Exception as e:
-                    logging.error(f"Error splitting document: {e}")
-        
+            for _, group in self.groups(documents):
+                all_splits.extend(split_records([(document.page_content, document.metadata) for document in group],
+                                                text_splitter, self.structure) or [])
+                progress_bar.update(len(group))
+
         return all_splits
+
+    def iter_split(self, groups):
+        # groups: iterable of (key, documents). Yields (key, splits) in input order while
+        # fanning the work out over a process pool with a bounded number of tasks in flight.
+        def task_chunks():
+            chunk = []
+            for key, documents in groups:
+                # None: the source could not be read, it stays None
+                chunk.append((key, [(document.page_content, document.metadata) for document in documents]
+                              if documents is not None else None))
+                if len(chunk) == self.task_chunksize:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+        with ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_split_worker,
+                                 initargs=(self.chunk_size, self.chunk_overlap, self.structure)) as executor:
+            pending = deque()
+            chunks = task_chunks()
+            while True:
+                while len(pending) < self.max_workers * 2:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    pending.append(executor.submit(_split_records, chunk))
+                if not pending:
+                    break
+                for key, splits in pending.popleft().result():
+                    # None: the group could not be split
+                    yield key, ([Document(page_content=content, metadata=metadata) for content, metadata in splits]
+                                if splits is not None else None)
@@ -0,0 +1,371 @@
+import os
+import queue
+import logging
+import threading
+from lib.config import config
+from lib.data_prep import PDFProcessor
+from lib.indexing import Indexing
+from lib.bm25 import BM25Index
+from lib.embedding_cache import CachedEmbeddings
+from lib.embedding_executor import EmbeddingExecutor
+from lib.sections import SectionIndex
+from lib.shards import ShardedVectorStore
+from lib.manifest import IngestionManifest, file_sha256, text_sha256, chunk_ids_for
+from lib.vectorstore import add_embeddings, index_paths, load_vectorstore, new_vectorstore, read_meta, remove_ids, save_vectorstore
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+_DONE = object()
+
+
+def list_pdfs(pdf_folder_path=config['pdf_processing']['pdf_folder_path']):
+    return [os.path.join(pdf_folder_path, file) for file in sorted(os.listdir(pdf_folder_path)) if file.endswith('.pdf')]
+
+
+class _Stage(threading.Thread):
+    # Runs a generator stage in its own thread: items from the inbox queue are fed to
+    # the generator and its output is pushed into a bounded outbox queue.
+    def __init__(self, name, func, inbox, outbox, stop_event):
+        super().__init__(name=name, daemon=True)
+        self.func = func
+        self.inbox = inbox
+        self.outbox = outbox
+        self.stop_event = stop_event
+        self.error = None
+
+    def run(self):
+        try:
+            items = self.func(drain(self.inbox, self.stop_event)) if self.inbox is not None else self.func()
+            for item in items:
+                put(self.outbox, item, self.stop_event)
+        except BaseException as e:
+            logging.error(f"Ingestion stage {self.name} failed: {e}")
+            self.error = e
+            self.stop_event.set()
+        finally:
+            put(self.outbox, _DONE, self.stop_event)
+
+
+def put(q, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def drain(q, stop_event):
+    while not stop_event.is_set():
+        try:
+            item = q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _DONE:
+            return
+        yield item
+
+
+class IncrementalIngestor:
+    # download -> clean -> split -> embed -> add-to-index, each stage connected by a
+    # bounded queue so memory stays flat and embedding overlaps with PDF parsing.
+    def __init__(self, embeddings, db_folder_path=config['ingestion']['db_folder_path'],
+                 index_name=config['ingestion']['index_name'], manifest=None,
+                 batch_size=config['pdf_processing']['batch_size'],
+                 queue_size=config['pdf_processing']['queue_size'],
+                 index_type=config['index']['type'], index_config=config['index'],
+                 checkpoint_every=config['ingestion']['checkpoint_every'],
+                 num_shards=config['shards']['count'], shard_by=config['shards']['by']):
+        self.embeddings = embeddings
+        self.db_folder_path = db_folder_path
+        self.index_name = index_name
+        self.manifest = manifest or IngestionManifest()
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.index_type = index_type
+        self.index_config = index_config
+        self.checkpoint_every = checkpoint_every
+        self.num_shards = num_shards
+        self.shard_by = shard_by
+        # IVF indexes are trained on the first train_size vectors before anything is added
+        self.train_size = config['index']['train_size'] if index_type in ('ivf_flat', 'ivf_pq') else 0
+        self.indexing = Indexing()
+        self.db = None
+        self.bm25 = None
+        self.sections = None
+        self.source_hashes = {}
+        self.pending_sources = {}
+        self.removed_ids = []
+        self.removed = 0
+        # Sources that could not be read or split keep their indexed chunks and manifest entry
+        self.failed_sources = []
+        # Chunks of each pending source that still have to reach the index
+        self.remaining_chunks = {}
+        self.chunk_sources = {}
+        self.indexed_ids = set()
+        self._sources_lock = threading.Lock()
+        self._train_buffer = []
+
+    def load_vectorstore(self):
+        paths = index_paths(self.db_folder_path, self.index_name)
+        meta = read_meta(self.db_folder_path, self.index_name)
+        sharded = bool(meta and meta.get('sharded'))
+        if not os.path.exists(paths['index']) and not sharded:
+            logging.info(f"No vector store found at {paths['index']}, a new one will be built")
+            return None
+        if meta and meta['index_type'] != self.index_type:
+            logging.warning(f"Existing index is {meta['index_type']} but {self.index_type} is configured, "
+                            f"delete {self.db_folder_path} to rebuild it")
+            self.index_type = meta['index_type']
+        storage = (meta.get('storage', 'float32'), meta.get('dimensions')) if meta else ('float32', None)
+        if storage != (self.index_config['storage'], self.index_config['dimensions']):
+            logging.warning(f"Existing index stores {storage[0]} vectors on {storage[1] or 'all'} dimensions but "
+                            f"{self.index_config['storage']} on {self.index_config['dimensions'] or 'all'} is "
+                            f"configured, delete {self.db_folder_path} to rebuild it")
+            self.index_config = {**self.index_config, 'storage': storage[0], 'dimensions': storage[1]}
+        num_shards, shard_by = (meta['num_shards'], meta['shard_by']) if sharded else (1, None)
+        if (num_shards, shard_by) != (self.num_shards, self.shard_by if self.num_shards > 1 else None):
+            logging.warning(f"Existing index has {num_shards} shards but {self.num_shards} are configured, "
+                            f"delete {self.db_folder_path} to rebuild it")
+            self.num_shards, self.shard_by = num_shards, shard_by
+        return load_vectorstore(self.db_folder_path, self.embeddings, self.index_name, read_only=False)
+
+    def load_bm25(self):
+        # The sparse index follows the vector store chunk for chunk; indexes built before it
+        # existed get one from the stored chunks
+        path = index_paths(self.db_folder_path, self.index_name)['bm25']
+        if self.db is None:
+            return BM25Index()
+        if os.path.exists(path):
+            return BM25Index.load(path)
+        logging.info(f"No BM25 index found at {path}, building it from the vector store")
+        bm25 = BM25Index()
+        chunk_ids = list(self.db.index_to_docstore_id.values())
+        bm25.add(chunk_ids, [self.db.docstore.search(chunk_id).page_content for chunk_id in chunk_ids])
+        return bm25
+
+    def load_sections(self):
+        # (law code, section) -> chunk IDs, rebuilt from the stored chunk metadata when missing
+        path = index_paths(self.db_folder_path, self.index_name)['sections']
+        if self.db is None:
+            return SectionIndex()
+        if os.path.exists(path):
+            return SectionIndex.load(path)
+        sections = SectionIndex()
+        chunk_ids = list(self.db.index_to_docstore_id.values())
+        sections.add(chunk_ids, [self.db.docstore.search(chunk_id).metadata for chunk_id in chunk_ids])
+        return sections
+
+    def changed_pdfs(self, pdf_paths):
+        for path in pdf_paths:
+            content_hash = file_sha256(path)
+            self.source_hashes[path] = content_hash
+            if self.manifest.is_changed(path, content_hash):
+                yield path
+
+    def clean(self, changed_pdf_paths, extra_sources):
+        # Unreadable PDFs are passed on with None pages, split() skips them
+        for source, documents in extra_sources.items():
+            content_hash = text_sha256("\n".join(document.page_content for document in documents))
+            self.source_hashes[source] = content_hash
+            if self.manifest.is_changed(source, content_hash):
+                yield source, documents
+        yield from PDFProcessor(changed_pdf_paths).iter_pdfs()
+
+    def split(self, cleaned_sources):
+        batch_documents, batch_ids = [], []
+        for source, splits in self.indexing.iter_split(cleaned_sources):
+            if splits is None:
+                # Not recorded in the manifest, so the source is retried on the next run
+                logging.error(f"Could not process {source}, keeping its indexed chunks")
+                self.failed_sources.append(source)
+                continue
+            ids = chunk_ids_for(splits)
+            old_ids = set(self.manifest.chunk_ids(source))
+            # Chunks saved by an interrupted run's checkpoint are in the index but not yet in the manifest
+            new_ids = [chunk_id for chunk_id in ids if chunk_id not in old_ids and chunk_id not in self.indexed_ids]
+            with self._sources_lock:
+                self.pending_sources[source] = (ids, old_ids - set(ids))
+                self.remaining_chunks[source] = len(new_ids)
+                self.chunk_sources.update((chunk_id, source) for chunk_id in new_ids)
+            new_ids = set(new_ids)
+            for split, chunk_id in zip(splits, ids):
+                if chunk_id not in new_ids:
+                    continue
+                split.metadata['chunk_id'] = chunk_id
+                batch_documents.append(split)
+                batch_ids.append(chunk_id)
+                if len(batch_documents) >= self.batch_size:
+                    yield batch_documents, batch_ids
+                    batch_documents, batch_ids = [], []
+        if batch_documents:
+            yield batch_documents, batch_ids
+
+    def embed(self, batches):
+        for documents, ids in batches:
+            texts = [document.page_content for document in documents]
+            if isinstance(self.embeddings, (CachedEmbeddings, EmbeddingExecutor)):
+                # Counted while splitting, the executor packs its requests with them
+                token_counts = [document.metadata.get('token_count') for document in documents]
+                vectors = self.embeddings.embed_documents(texts, token_counts=token_counts)
+            else:
+                vectors = self.embeddings.embed_documents(texts)
+            yield documents, ids, vectors
+
+    def add_to_index(self, documents, ids, vectors):
+        self.bm25.add(ids, [document.page_content for document in documents])
+        self.sections.add(ids, [document.metadata for document in documents])
+        with self._sources_lock:
+            for chunk_id in ids:
+                self.remaining_chunks[self.chunk_sources.pop(chunk_id)] -= 1
+        if self.db is None:
+            self._train_buffer.append((documents, ids, vectors))
+            if sum(len(batch_ids) for _, batch_ids, _ in self._train_buffer) >= self.train_size:
+                self.flush_train_buffer()
+            return
+        if isinstance(self.db, ShardedVectorStore):
+            self.db.add_embeddings(documents, vectors, ids)
+        else:
+            add_embeddings(self.db, documents, vectors, ids)
+
+    def flush_train_buffer(self):
+        if not self._train_buffer:
+            return
+        buffered, self._train_buffer = self._train_buffer, []
+        if self.num_shards > 1:
+            # Every shard is created from, and IVF shards trained on, its own part of the buffer
+            self.db = ShardedVectorStore(self.embeddings, {}, num_shards=self.num_shards, shard_by=self.shard_by,
+                                         index_type=self.index_type, index_config=self.index_config)
+            self.db.add_embeddings([document for documents, _, _ in buffered for document in documents],
+                                   [vector for _, _, vectors in buffered for vector in vectors],
+                                   [chunk_id for _, ids, _ in buffered for chunk_id in ids])
+            return
+        self.db = new_vectorstore(self.embeddings, [vector for _, _, vectors in buffered for vector in vectors],
+                                  index_type=self.index_type, index_config=self.index_config)
+        for documents, ids, vectors in buffered:
+            add_embeddings(self.db, documents, vectors, ids)
+
+    def ingest(self, pdf_paths, extra_sources=None):
+        # pdf_paths may be a generator (e.g. LawScraper.iter_download_pdfs), extra_sources maps
+        # a source name to already loaded documents (e.g. the laws list CSV)
+        extra_sources = extra_sources or {}
+        self.db = self.load_vectorstore()
+        if self.db is None:
+            # Without a vector store the manifest is meaningless, start over
+            self.manifest.sources = {}
+        self.bm25 = self.load_bm25()
+        self.sections = self.load_sections()
+        self.indexed_ids = set(self.db.index_to_docstore_id.values()) if self.db is not None else set()
+
+        stop_event = threading.Event()
+        pdf_queue = queue.Queue(maxsize=self.queue_size)
+        cleaned_queue = queue.Queue(maxsize=self.queue_size)
+        batch_queue = queue.Queue(maxsize=self.queue_size)
+        embedded_queue = queue.Queue(maxsize=self.queue_size)
+        stages = [
+            _Stage("download", lambda: self.changed_pdfs(pdf_paths), None, pdf_queue, stop_event),
+            _Stage("clean", lambda paths: self.clean(paths, extra_sources), pdf_queue, cleaned_queue, stop_event),
+            _Stage("split", self.split, cleaned_queue, batch_queue, stop_event),
+            _Stage("embed", self.embed, batch_queue, embedded_queue, stop_event),
+        ]
+        for stage in stages:
+            stage.start()
+
+        added = unsaved = 0
+        try:
+            for documents, ids, vectors in drain(embedded_queue, stop_event):
+                self.add_to_index(documents, ids, vectors)
+                added += len(ids)
+                unsaved += len(ids)
+                logging.info(f"Added {added} chunks to the index so far")
+                if self.checkpoint_every and unsaved >= self.checkpoint_every and self.checkpoint():
+                    unsaved = 0
+        except BaseException:
+            stop_event.set()
+            raise
+        finally:
+            for stage in stages:
+                stage.join()
+
+        errors = [stage.error for stage in stages if stage.error is not None]
+        if errors:
+            raise errors[0]
+        self.flush_train_buffer()
+
+        for source in self.manifest.stale_sources(self.source_hashes):
+            self.removed_ids.extend(self.manifest.remove_source(source))
+            logging.info(f"Source removed since last ingestion: {source}")
+        self.commit_sources()
+        if self.db is not None and not self.pending_sources:
+            # Left behind by an interrupted run whose source changed again since
+            referenced = {chunk_id for entry in self.manifest.sources.values() for chunk_id in entry['chunks']}
+            self.removed_ids.extend(set(self.db.index_to_docstore_id.values()) - referenced - set(self.removed_ids))
+
+        paths = index_paths(self.db_folder_path, self.index_name)
+        if self.db is not None and (unsaved or self.removed_ids or not os.path.exists(paths['bm25'])
+                                    or not os.path.exists(paths['sections'])):
+            self.remove_from_index(self.removed_ids)
+            self.save()
+        self.manifest.save()
+        if self.failed_sources:
+            logging.warning(f"{len(self.failed_sources)} sources could not be processed and are retried on the next "
+                            f"run: {', '.join(map(str, self.failed_sources))}")
+        logging.info(f"Ingestion finished: {added} chunks embedded, {self.removed} chunks removed")
+        return self.db
+
+    def commit_sources(self):
+        # A source goes into the manifest once all of its new chunks are in the index, its
+        # outdated chunks are removed with the next save
+        with self._sources_lock:
+            complete = [source for source, remaining in self.remaining_chunks.items() if remaining == 0]
+            for source in complete:
+                del self.remaining_chunks[source]
+        for source in complete:
+            ids, outdated_ids = self.pending_sources.pop(source)
+            self.removed_ids.extend(outdated_ids)
+            self.manifest.update_source(source, self.source_hashes[source], ids)
+        return complete
+
+    def checkpoint(self):
+        # Persists the completed sources so an interrupted run does not embed them again
+        if self.db is None or self._train_buffer:
+            return False
+        complete = self.commit_sources()
+        self.remove_from_index(self.removed_ids)
+        self.save(checkpoint=True)
+        self.manifest.save()
+        logging.info(f"Checkpoint saved with {len(complete)} more sources complete")
+        return True
+
+    def save(self, checkpoint=False):
+        # The side indexes are saved before the vector store, whose new meta version makes servers reload all.
+        # Checkpoints keep the served version, servers reload once the ingestion is complete.
+        os.makedirs(self.db_folder_path, exist_ok=True)
+        paths = index_paths(self.db_folder_path, self.index_name)
+        self.bm25.save(paths['bm25'])
+        self.sections.save(paths['sections'])
+        if isinstance(self.db, ShardedVectorStore):
+            # Only the shards touched since the last save are written
+            self.db.save(self.db_folder_path, self.index_name, checkpoint=checkpoint)
+        else:
+            save_vectorstore(self.db, self.db_folder_path, self.index_name, index_type=self.index_type,
+                             index_config=self.index_config, checkpoint=checkpoint)
+        logging.info(f"Vector store saved to {self.db_folder_path}")
+
+    def remove_from_index(self, removed_ids):
+        if self.db is None or not removed_ids:
+            return
+        # A chunk can be queued twice, e.g. by a changed source and by the leftover sweep
+        removed_ids = list(set(removed_ids) & set(self.db.index_to_docstore_id.values()))
+        self.bm25.remove(removed_ids)
+        self.sections.remove(removed_ids)
+        if removed_ids and isinstance(self.db, ShardedVectorStore):
+            self.db.remove_ids(removed_ids)
+        elif removed_ids:
+            self.db = remove_ids(self.db, removed_ids, index_type=self.index_type, index_config=self.index_config)
+        self.removed += len(removed_ids)
+        self.removed_ids = []
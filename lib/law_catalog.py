@@ -0,0 +1,65 @@
+import re
+import json
+import logging
+from lib.config import config
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+TOKEN_PATTERN = re.compile(r"[A-Za-zÄÖÜäöüß][\w\-/]*")
+# Very short codes such as "AO" or "GG" are only matched case-sensitively, so ordinary
+# words in a question are not mistaken for law codes
+MIN_CASE_INSENSITIVE_CODE_LENGTH = 4
+MIN_TITLE_LENGTH = 12
+
+
+class LawCatalog:
+    def __init__(self, json_filepath=config['scraper']['json_filepath'], max_laws=config['law_catalog']['max_laws']):
+        self.json_filepath = json_filepath
+        self.max_laws = max_laws
+        self.laws = []
+        self.by_code = {}
+        self.by_code_lower = {}
+        self.titles = []
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.json_filepath, 'r', encoding='utf-8') as f:
+                self.laws = json.load(f)
+        except FileNotFoundError:
+            logging.warning(f"Law catalog {self.json_filepath} not found, law lookup is disabled")
+            self.laws = []
+        for law in self.laws:
+            code = law['Law code']
+            self.by_code[code] = law
+            if len(code) >= MIN_CASE_INSENSITIVE_CODE_LENGTH:
+                self.by_code_lower[code.lower()] = law
+            title = law.get('Law Title', '').strip().lower()
+            if len(title) >= MIN_TITLE_LENGTH:
+                self.titles.append((title, law))
+        logging.info(f"Law catalog loaded with {len(self.laws)} laws")
+
+    def get(self, code):
+        return self.by_code.get(code) or self.by_code_lower.get(code.lower())
+
+    def find(self, text):
+        found = []
+        for token in TOKEN_PATTERN.findall(text):
+            law = self.by_code.get(token) or self.by_code_lower.get(token.lower())
+            if law is not None and law not in found:
+                found.append(law)
+        lowered = text.lower()
+        for title, law in self.titles:
+            if title in lowered and law not in found:
+                found.append(law)
+        return found[:self.max_laws]
+
+    def describe(self, text):
+        laws = self.find(text)
+        if not laws:
+            return "None"
+        return "\n".join(f"Law code: {law['Law code']}\nLaw Title: {law['Law Title']}\nLink: {law['Link']}" for law in laws)
@@ -0,0 +1,81 @@
+import logging
+from contextvars import ContextVar
+import numpy as np
+from lib.config import config
+from lib.sections import law_code_for, normalize_code
+from lib.shards import ShardedIndex
+from lib.vectorstore import scoped_search_params
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+# The LawScope of the query being retrieved, set by LawScopedRetriever and read by the
+# dense and BM25 searches below it
+current_scope = ContextVar("current_scope", default=None)
+
+
+class LawScope:
+    # The part of the index a query is restricted to: the chunks of some laws plus the shared
+    # chunks that belong to no law (e.g. the laws list)
+    def __init__(self, law_codes, labels, chunk_ids):
+        self.law_codes = law_codes
+        self.labels = labels
+        self.chunk_ids = chunk_ids
+        self._params = None
+
+    def search_params(self, index):
+        if self._params is None:
+            if isinstance(index, ShardedIndex):
+                # One parameter set per shard holding any of the labels
+                self._params = (index.scoped_params(self.labels),)
+            else:
+                self._params = scoped_search_params(index, self.labels)
+        return self._params[0]
+
+    def bm25_mask(self, bm25):
+        mask = np.zeros(len(bm25.chunk_ids), dtype=bool)
+        positions = [bm25.positions[chunk_id] for chunk_id in self.chunk_ids if chunk_id in bm25.positions]
+        mask[positions] = True
+        return mask
+
+
+class LawPartitions:
+    # Law code -> FAISS labels of its chunks. Built from the chunk sources, since law PDFs are
+    # saved as <law code>.pdf; sources that are not a known law are searched with every scope.
+    def __init__(self, labels_by_law, shared_labels, index_to_docstore_id):
+        self.labels_by_law = labels_by_law
+        self.shared_labels = shared_labels
+        self.index_to_docstore_id = index_to_docstore_id
+
+    def __len__(self):
+        return len(self.labels_by_law)
+
+    @classmethod
+    def from_vectorstore(cls, db, law_catalog):
+        if hasattr(db.docstore, 'metadata_values'):
+            sources = db.docstore.metadata_values('source')
+        else:
+            sources = {label: db.docstore.search(chunk_id).metadata.get('source')
+                       for label, chunk_id in db.index_to_docstore_id.items()}
+        known = {normalize_code(law['Law code']) for law in law_catalog.laws}
+        labels_by_law, shared_labels = {}, []
+        for label, source in sources.items():
+            code = normalize_code(law_code_for(source or ''))
+            if code in known:
+                labels_by_law.setdefault(code, []).append(label)
+            else:
+                shared_labels.append(label)
+        logging.info(f"Law partitions: {len(labels_by_law)} laws, {len(shared_labels)} shared chunks")
+        return cls({code: np.array(labels, dtype=np.int64) for code, labels in labels_by_law.items()},
+                   np.array(shared_labels, dtype=np.int64), db.index_to_docstore_id)
+
+    def scope(self, laws):
+        codes = [code for code in dict.fromkeys(normalize_code(law['Law code']) for law in laws)
+                 if code in self.labels_by_law]
+        if not codes:
+            return None
+        labels = np.concatenate([self.labels_by_law[code] for code in codes] + [self.shared_labels])
+        return LawScope(codes, labels, [self.index_to_docstore_id[int(label)] for label in labels])
@@ -0,0 +1,90 @@
+import os
+import json
+import hashlib
+import logging
+from lib.config import config
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+
+def file_sha256(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def text_sha256(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def chunk_ids_for(documents):
+    # A chunk is identified by its source, page and text. Repeated chunks inside
+    # the same source (e.g. "(repealed)") get an ordinal so the IDs stay unique.
+    ids = []
+    seen = {}
+    for document in documents:
+        key = "\x00".join([
+            str(document.metadata.get('source', '')),
+            str(document.metadata.get('page', document.metadata.get('row', ''))),
+            document.page_content,
+        ])
+        chunk_id = text_sha256(key)
+        seen[chunk_id] = seen.get(chunk_id, 0) + 1
+        if seen[chunk_id] > 1:
+            chunk_id = f"{chunk_id}#{seen[chunk_id]}"
+        ids.append(chunk_id)
+    return ids
+
+
+class IngestionManifest:
+    def __init__(self, manifest_path=config['ingestion']['manifest_path']):
+        self.manifest_path = manifest_path
+        self.sources = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.manifest_path):
+            logging.info(f"No ingestion manifest found at {self.manifest_path}, starting fresh")
+            return
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.sources = data.get('sources', {})
+            logging.info(f"Loaded ingestion manifest with {len(self.sources)} sources")
+        except Exception as e:
+            logging.error(f"Error loading ingestion manifest: {e}")
+            raise
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.manifest_path) or '.', exist_ok=True)
+        tmp_path = f"{self.manifest_path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'sources': self.sources}, f, ensure_ascii=False, indent=4)
+            os.replace(tmp_path, self.manifest_path)
+            logging.info(f"Ingestion manifest saved to {self.manifest_path}")
+        except Exception as e:
+            logging.error(f"Error saving ingestion manifest: {e}")
+            raise
+
+    def is_changed(self, source, content_hash):
+        return self.sources.get(source, {}).get('sha256') != content_hash
+
+    def chunk_ids(self, source):
+        return list(self.sources.get(source, {}).get('chunks', []))
+
+    def update_source(self, source, content_hash, chunk_ids):
+        self.sources[source] = {'sha256': content_hash, 'chunks': list(chunk_ids)}
+
+    def remove_source(self, source):
+        entry = self.sources.pop(source, {})
+        return list(entry.get('chunks', []))
+
+    def stale_sources(self, current_sources):
+        return [source for source in self.sources if source not in current_sources]
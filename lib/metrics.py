@@ -0,0 +1,234 @@
+import time
+import bisect
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from langchain_core.callbacks import BaseCallbackHandler
+from lib.config import config
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (10, 50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+CHUNK_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    # Cumulative Prometheus-style buckets plus a window of recent values for exact percentiles
+    def __init__(self, buckets, window=config['metrics']['window']):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def percentile(self, q):
+        return float(np.percentile(self.recent, q)) if self.recent else 0.0
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, value, buckets=SECONDS_BUCKETS, **labels):
+        key = self.key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        key = self.key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            histograms = [{
+                'name': name, 'labels': dict(labels), 'count': histogram.count, 'sum': histogram.sum,
+                'p50': histogram.percentile(50), 'p95': histogram.percentile(95), 'p99': histogram.percentile(99),
+            } for (name, labels), histogram in sorted(self.histograms.items())]
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+        return {'histograms': histograms, 'counters': counters}
+
+    def render_prometheus(self):
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}" if pairs else ""
+
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{label_text(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{label_text(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{label_text(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{label_text(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+_metrics = MetricsRegistry()
+
+
+def get_metrics():
+    return _metrics
+
+
+@contextmanager
+def stage_timer(stage, metrics=None):
+    # For work that does not emit LangChain callbacks: embedding, FAISS search, MMR, BM25, rerank
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        (metrics or get_metrics()).observe("rag_stage_seconds", time.perf_counter() - start, stage=stage)
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    # Times the named stages of the RAG chain and attributes LLM token usage and retrieved
+    # chunk counts to them. Runs are matched by run_id, parents are followed to find the stage.
+    STAGES = ("contextualize_question", "generate_answer")
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics or get_metrics()
+        self._runs = {}
+        self._lock = threading.Lock()
+
+    def _start(self, run_id, parent_run_id, stage):
+        with self._lock:
+            self._runs[run_id] = (parent_run_id, stage, time.perf_counter())
+
+    def _finish(self, run_id, error=False):
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+        if run is None or run[1] is None:
+            return None
+        _, stage, start = run
+        self.metrics.observe("rag_stage_seconds", time.perf_counter() - start, stage=stage)
+        if error:
+            self.metrics.increment("rag_stage_errors_total", stage=stage)
+        return stage
+
+    def _enclosing_stage(self, run_id):
+        with self._lock:
+            while run_id in self._runs:
+                parent_run_id, stage, _ = self._runs[run_id]
+                if stage is not None:
+                    return stage
+                run_id = parent_run_id
+        return None
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+        name = kwargs.get('name')
+        self._start(run_id, parent_run_id, name if name in self.STAGES else None)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id, error=True)
+
+    def on_retriever_start(self, serialized, query, *, run_id, parent_run_id=None, **kwargs):
+        # Nested retrievers (dense inside hybrid inside rerank) are part of the outer stage
+        nested = self._enclosing_stage(parent_run_id) == "retrieve"
+        self._start(run_id, parent_run_id, None if nested else "retrieve")
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        if self._finish(run_id) == "retrieve":
+            self.metrics.observe("rag_retrieved_chunks", len(documents), buckets=CHUNK_BUCKETS)
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id, error=True)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, **kwargs):
+        self._start(run_id, parent_run_id, None)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs):
+        self._start(run_id, parent_run_id, None)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        stage = self._enclosing_stage(run_id) or "llm"
+        with self._lock:
+            self._runs.pop(run_id, None)
+        prompt_tokens, completion_tokens = token_usage(response)
+        if prompt_tokens or completion_tokens:
+            self.metrics.observe("rag_tokens", prompt_tokens, buckets=TOKEN_BUCKETS, stage=stage, kind="prompt")
+            self.metrics.observe("rag_tokens", completion_tokens, buckets=TOKEN_BUCKETS, stage=stage, kind="completion")
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        with self._lock:
+            self._runs.pop(run_id, None)
+
+
+def token_usage(response):
+    # Non-streaming calls report usage in llm_output, streamed ones on the message (stream_usage=True)
+    usage = (response.llm_output or {}).get('token_usage') or {}
+    if usage:
+        return usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+    for generations in response.generations:
+        for generation in generations:
+            metadata = getattr(getattr(generation, 'message', None), 'usage_metadata', None)
+            if metadata:
+                return metadata.get('input_tokens', 0), metadata.get('output_tokens', 0)
+    return 0, 0
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip('/') != '/metrics':
+            self.send_error(404)
+            return
+        body = get_metrics().render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port=config['metrics']['port'], host=config['metrics']['host']):
+    # Serves /metrics in a daemon thread, once per process
+    global _server
+    if not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+            except OSError as e:
+                logging.warning(f"Could not start metrics server on {host}:{port}: {e}")
+                return None
+            threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+            logging.info(f"Metrics served on http://{host}:{port}/metrics")
+    return _server
@@ -0,0 +1,63 @@
+import logging
+import numpy as np
+from lib.config import config
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+
+def normalize_rows(vectors, dimensions=None):
+    # text-embedding-3 vectors may be truncated to their first dimensions (Matryoshka) and
+    # renormalised, cosine similarity then becomes a plain dot product
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dimensions:
+        vectors = vectors[..., :dimensions]
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def maximal_marginal_relevance(query, candidates, k=4, lambda_mult=0.5, dimensions=None):
+    # Same selection as langchain_community.vectorstores.utils.maximal_marginal_relevance, but
+    # the candidate similarity matrix is computed once and each greedy step is one vector op
+    candidates = np.asarray(candidates, dtype=np.float32)
+    k = min(k, len(candidates))
+    if k <= 0:
+        return []
+    query = normalize_rows(np.asarray(query, dtype=np.float32).reshape(-1), dimensions)
+    candidates = normalize_rows(candidates, dimensions)
+    similarity_to_query = candidates @ query
+    similarity_matrix = candidates @ candidates.T
+
+    selected = [int(np.argmax(similarity_to_query))]
+    redundancy = similarity_matrix[selected[0]].copy()
+    relevance = lambda_mult * similarity_to_query
+    while len(selected) < k:
+        scores = relevance - (1 - lambda_mult) * redundancy
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        np.maximum(redundancy, similarity_matrix[best], out=redundancy)
+    return selected
+
+
+def batch_search_with_vectors(index, queries, fetch_k, params=None):
+    # One FAISS call for all query rows returns the candidates together with their stored
+    # vectors, (nq, fetch_k) arrays padded with label -1 like index.search
+    queries = np.asarray(queries, dtype=np.float32).reshape(-1, index.d)
+    try:
+        return index.search_and_reconstruct(queries, fetch_k, params=params)
+    except RuntimeError:
+        scores, labels = index.search(queries, fetch_k, params=params)
+        vectors = np.stack([np.vstack([index.reconstruct(int(label)) if label != -1
+                                       else np.zeros(index.d, dtype=np.float32) for label in row])
+                            for row in labels])
+        return scores, labels, vectors
+
+
+def search_with_vectors(index, query, fetch_k, params=None):
+    scores, labels, vectors = batch_search_with_vectors(index, query, fetch_k, params)
+    valid = labels[0] != -1
+    return scores[0][valid], labels[0][valid], vectors[0][valid]
@@ -0,0 +1,92 @@
+import time
+import logging
+from functools import lru_cache
+from typing import Any, List
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from lib.config import config
+from lib.indexing import token_length
+from lib.metrics import get_metrics
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+
+@lru_cache(maxsize=None)
+def get_cross_encoder(model=config['rerank']['model'], max_length=config['rerank']['max_length']):
+    # Optional dependency, only needed when rerank.enabled is set
+    from sentence_transformers import CrossEncoder
+    logging.info(f"Loading cross-encoder {model}")
+    return CrossEncoder(model, max_length=max_length, device='cpu')
+
+
+class CrossEncoderReranker:
+    def __init__(self, cross_encoder, top_n=config['rerank']['top_n'], max_tokens=config['rerank']['max_tokens'],
+                 batch_size=config['rerank']['batch_size'], timeout_ms=config['rerank']['timeout_ms']):
+        self.cross_encoder = cross_encoder
+        self.top_n = top_n
+        self.max_tokens = max_tokens
+        self.batch_size = batch_size
+        self.timeout_ms = timeout_ms
+
+    def score(self, query, documents, deadline=None):
+        # Returns None when the deadline passes before every candidate is scored
+        scores = []
+        for start in range(0, len(documents), self.batch_size):
+            if deadline is not None and time.perf_counter() > deadline:
+                return None
+            batch = documents[start:start + self.batch_size]
+            scores.extend(float(score) for score in self.cross_encoder.predict(
+                [(query, document.page_content) for document in batch], batch_size=self.batch_size,
+                show_progress_bar=False))
+        return scores
+
+    def within_budget(self, documents):
+        # Best first, stop at top_n or when the next chunk would exceed the token budget
+        kept, tokens = [], 0
+        for document in documents[:self.top_n]:
+            cost = document.metadata.get('token_count') or token_length(document.page_content)
+            if kept and self.max_tokens and tokens + cost > self.max_tokens:
+                break
+            kept.append(document)
+            tokens += cost
+        return kept
+
+    def rerank(self, query, documents):
+        if not documents:
+            return []
+        started = time.perf_counter()
+        deadline = started + self.timeout_ms / 1000 if self.timeout_ms else None
+        scores = self.score(query, documents, deadline)
+        get_metrics().observe("rag_stage_seconds", time.perf_counter() - started, stage="rerank")
+        if scores is None:
+            get_metrics().increment("rag_rerank_timeouts_total")
+            logging.warning(f"Reranking {len(documents)} chunks exceeded {self.timeout_ms} ms, keeping dense order")
+            return self.within_budget(documents)
+
+        order = sorted(range(len(documents)), key=lambda position: scores[position], reverse=True)
+        ranked = [Document(page_content=documents[position].page_content,
+                           metadata={**documents[position].metadata, 'rerank_score': scores[position]})
+                  for position in order]
+        kept = self.within_budget(ranked)
+        logging.info(f"Reranked {len(documents)} chunks in {(time.perf_counter() - started) * 1000:.0f} ms, "
+                     f"kept {len(kept)}")
+        return kept
+
+
+class RerankingRetriever(BaseRetriever):
+    # Retrieves a larger candidate set and keeps the chunks the cross-encoder ranks highest
+    vectorstore: Any
+    base_retriever: BaseRetriever
+    reranker: Any
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        documents = self.base_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        return self.reranker.rerank(query, documents)
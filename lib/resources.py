@@ -0,0 +1,103 @@
+import os
+import logging
+import threading
+from langchain_openai import ChatOpenAI
+from lib.config import config
+from lib.answer_cache import AnswerCache
+from lib.chain import ConversationalRAG, build_conversational_chain
+from lib.embeddings import get_embeddings
+from lib.history import HistoryWindow
+from lib.law_catalog import LawCatalog
+from lib.metrics import MetricsCallbackHandler, start_metrics_server
+from lib.retrieval import FAISSRetriever
+from lib.session_history import get_history_store
+from lib.vectorstore import read_meta
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+
+class ResourceRegistry:
+    # Process-wide holder for the retriever and chains. They are built once and rebuilt
+    # only when a new index version has been saved to disk by the ingestion.
+    def __init__(self, db_folder_path=config['ingestion']['db_folder_path'],
+                 index_name=config['ingestion']['index_name'],
+                 laws_json_path=config['scraper']['json_filepath']):
+        self.db_folder_path = db_folder_path
+        self.index_name = index_name
+        self.laws_json_path = laws_json_path
+        self.index_version = None
+        self.retriever = None
+        self.vectorstore = None
+        self.chat_model = None
+        self.rag_chain = None
+        self.conversational_rag_chain = None
+        self.history_store = None
+        self.answer_cache = None
+        self.law_catalog = None
+        self.history_window = None
+        self.metrics_handler = MetricsCallbackHandler()
+        self._lock = threading.Lock()
+        start_metrics_server()
+
+    def current_index_version(self):
+        meta = read_meta(self.db_folder_path, self.index_name)
+        if meta is not None:
+            return meta.get('version')
+        index_file = os.path.join(self.db_folder_path, f"{self.index_name}.faiss")
+        return os.path.getmtime(index_file) if os.path.exists(index_file) else None
+
+    def load(self, index_version):
+        logging.info(f"Loading serving resources for index version {index_version}")
+        self.law_catalog = LawCatalog(self.laws_json_path)
+
+        retriever_instance = FAISSRetriever(db_folder_path=self.db_folder_path, index_name=self.index_name,
+                                            law_catalog=self.law_catalog)
+        self.retriever = retriever_instance.get_retriever()
+        self.vectorstore = retriever_instance.db
+        if self.chat_model is None:
+            # stream_usage: token counts are reported for streamed answers too
+            self.chat_model = ChatOpenAI(model=config['openai']['model'], temperature=config['openai']['temperature'],
+                                         stream_usage=True)
+            self.history_window = HistoryWindow(self.chat_model)
+        if config['answer_cache']['enabled']:
+            if self.answer_cache is None:
+                self.answer_cache = AnswerCache(get_embeddings())
+            self.answer_cache.set_index_version(index_version)
+        self.rag_chain = ConversationalRAG(self.chat_model, self.retriever, answer_cache=self.answer_cache,
+                                           law_catalog=self.law_catalog, history_window=self.history_window,
+                                           callbacks=[self.metrics_handler])
+        if self.history_store is None:
+            self.history_store = get_history_store()
+        self.conversational_rag_chain = build_conversational_chain(self.rag_chain, self.history_store)
+        self.index_version = index_version
+
+    def refresh(self):
+        # Cheap enough to call on every request: one small file read when nothing changed
+        index_version = self.current_index_version()
+        if index_version is None:
+            raise ValueError(f"No index found in {self.db_folder_path}, run ingest.py first")
+        if index_version != self.index_version:
+            with self._lock:
+                if index_version != self.index_version:
+                    self.load(index_version)
+        return self
+
+    def get_rag_chain(self):
+        return self.refresh().rag_chain
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ResourceRegistry()
+    return _registry
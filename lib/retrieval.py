@@ -1,7 +1,24 @@
+import os
+import asyncio
 import logging
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores import FAISS
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from typing import Any, List, Optional
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from lib.bm25 import BM25Index
 from lib.config import config
+from lib.embeddings import get_embeddings
+from lib.law_scope import LawPartitions, current_scope
+from lib.metrics import get_metrics, stage_timer
+from lib.mmr import batch_search_with_vectors, maximal_marginal_relevance, search_with_vectors
+from lib.sections import SectionIndex
+from lib.shards import ShardedVectorStore
+from lib.rerank import CrossEncoderReranker, RerankingRetriever, get_cross_encoder
+from lib.vectorstore import index_paths, load_vectorstore
 
 logging.basicConfig(level=config['logging']['level'],
                     format=config['logging']['format'],
@@ -9,12 +26,240 @@ logging.basicConfig(level=config['logging']['level'],
                     filemode=config['logging']['filemode'],
                     encoding='utf-8')
 
+# The PrefetchedSearch of the batch being answered, set by BatchAnswerer
+prefetched = ContextVar("prefetched", default=None)
+
+
+class PrefetchedSearch:
+    # Query vectors and dense candidates of a batch of questions: one embedding call for all
+    # questions and one FAISS search over the query matrix. Chunks are fetched from the
+    # docstore once, however many questions retrieve them.
+    def __init__(self, vectorstore, questions, fetch_k=config['retrieval']['fetch_k']):
+        self.fetch_k = fetch_k
+        self.candidates = {}
+        self.documents = {}
+        self._lock = threading.Lock()
+        questions = list(dict.fromkeys(questions))
+        if not questions or vectorstore.index is None:
+            return
+        with stage_timer("embed_query"):
+            query_vectors = np.asarray(vectorstore.embedding_function.embed_documents(questions), dtype=np.float32)
+        with stage_timer("faiss_search"):
+            scores, labels, vectors = batch_search_with_vectors(vectorstore.index, query_vectors, fetch_k)
+        for row, question in enumerate(questions):
+            valid = labels[row] != -1
+            self.candidates[question] = (query_vectors[row], labels[row][valid], vectors[row][valid])
+        logging.info(f"Prefetched dense candidates of {len(questions)} questions")
+
+    def search(self, query, fetch_k):
+        if fetch_k > self.fetch_k or query not in self.candidates:
+            return None
+        query_vector, labels, vectors = self.candidates[query]
+        return query_vector, labels[:fetch_k], vectors[:fetch_k]
+
+    def documents_by_id(self, docstore, doc_ids):
+        with self._lock:
+            missing = [doc_id for doc_id in dict.fromkeys(doc_ids) if doc_id not in self.documents]
+        if missing:
+            found = fetch_documents(docstore, missing)
+            with self._lock:
+                self.documents.update(found)
+        return {doc_id: self.documents[doc_id] for doc_id in doc_ids if doc_id in self.documents}
+
+
+def fetch_documents(docstore, doc_ids):
+    if hasattr(docstore, 'search_many'):
+        return docstore.search_many(doc_ids)
+    return {doc_id: docstore.search(doc_id) for doc_id in doc_ids}
+
+
+def documents_by_id(docstore, doc_ids):
+    batch = prefetched.get()
+    if batch is not None:
+        return batch.documents_by_id(docstore, doc_ids)
+    return fetch_documents(docstore, doc_ids)
+
+
+class MMRRetriever(BaseRetriever):
+    # Fetches fetch_k candidates with their stored vectors in one FAISS call and runs MMR on them,
+    # optionally on Matryoshka-truncated vectors
+    vectorstore: Any
+    k: int = config['retrieval']['k']
+    fetch_k: int = config['retrieval']['fetch_k']
+    lambda_mult: float = config['retrieval']['lambda_mult']
+    dimensions: Optional[int] = config['retrieval']['mmr_dimensions']
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        scope = current_scope.get()
+        batch = prefetched.get()
+        # Law-scoped searches need their own search parameters and are not prefetched
+        hit = batch.search(query, self.fetch_k) if batch is not None and scope is None else None
+        if hit is not None:
+            query_vector, labels, vectors = hit
+        else:
+            with stage_timer("embed_query"):
+                query_vector = self.vectorstore.embedding_function.embed_query(query)
+            params = scope.search_params(self.vectorstore.index) if scope is not None else None
+            with stage_timer("faiss_search"):
+                _, labels, vectors = search_with_vectors(self.vectorstore.index, query_vector, self.fetch_k, params)
+        with stage_timer("mmr"):
+            selected = maximal_marginal_relevance(query_vector, vectors, k=self.k, lambda_mult=self.lambda_mult,
+                                                  dimensions=self.dimensions)
+        doc_ids = [self.vectorstore.index_to_docstore_id[int(labels[position])] for position in selected]
+        with stage_timer("docstore"):
+            documents = documents_by_id(self.vectorstore.docstore, doc_ids)
+        return [documents[doc_id] for doc_id in doc_ids if isinstance(documents.get(doc_id), Document)]
+
+
+# BM25 runs here while the dense search runs in the calling thread
+_bm25_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="bm25")
+
+
+class HybridRetriever(BaseRetriever):
+    # Dense and BM25 retrieval run concurrently and are fused with weighted reciprocal rank fusion
+    vectorstore: Any
+    dense_retriever: BaseRetriever
+    bm25: Any
+    k: int = config['retrieval']['k']
+    bm25_k: int = config['retrieval']['bm25_k']
+    dense_weight: float = config['retrieval']['dense_weight']
+    bm25_weight: float = config['retrieval']['bm25_weight']
+    rrf_k: int = config['retrieval']['rrf_k']
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        # The scope is read here, executor threads do not see the caller's context
+        sparse_future = _bm25_executor.submit(self.bm25_search, query, current_scope.get())
+        dense = self.dense_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        return self.fuse(dense, sparse_future.result())
+
+    async def _aget_relevant_documents(self, query: str, *,
+                                       run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        dense, sparse = await asyncio.gather(
+            self.dense_retriever.ainvoke(query, config={"callbacks": run_manager.get_child()}),
+            asyncio.get_running_loop().run_in_executor(_bm25_executor, self.bm25_search, query, current_scope.get()),
+        )
+        return self.fuse(dense, sparse)
+
+    def bm25_search(self, query, scope=None):
+        with stage_timer("bm25_search"):
+            return self.bm25.search(query, self.bm25_k, mask=scope.bm25_mask(self.bm25) if scope is not None else None)
+
+    def fuse(self, dense, sparse):
+        scores = {}
+        documents = {}
+        for rank, document in enumerate(dense):
+            key = document.metadata.get('chunk_id', document.page_content)
+            documents.setdefault(key, document)
+            scores[key] = scores.get(key, 0.0) + self.dense_weight / (self.rrf_k + rank + 1)
+        for rank, (chunk_id, _) in enumerate(sparse):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + self.bm25_weight / (self.rrf_k + rank + 1)
+
+        ranked = sorted(scores, key=scores.get, reverse=True)[:self.k]
+        missing = [key for key in ranked if key not in documents]
+        if missing:
+            documents.update(documents_by_id(self.vectorstore.docstore, missing))
+        return [documents[key] for key in ranked if isinstance(documents.get(key), Document)]
+
+
+class LawScopedRetriever(BaseRetriever):
+    # Questions naming laws search only the chunks of those laws. Questions naming none, and
+    # scoped searches that find nothing, search the whole index.
+    vectorstore: Any
+    base_retriever: BaseRetriever
+    partitions: Any
+    law_catalog: Any
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def scope_for(self, query):
+        scope = self.partitions.scope(self.law_catalog.find(query))
+        if scope is not None:
+            logging.info(f"Retrieval scoped to {', '.join(scope.law_codes)} ({len(scope.labels)} chunks)")
+        return scope
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        scope = self.scope_for(query)
+        if scope is not None:
+            token = current_scope.set(scope)
+            try:
+                documents = self.base_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+            finally:
+                current_scope.reset(token)
+            get_metrics().increment("rag_law_scope_total", result="scoped" if documents else "fallback")
+            if documents:
+                return documents
+        else:
+            get_metrics().increment("rag_law_scope_total", result="global")
+        return self.base_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+
+    async def _aget_relevant_documents(self, query: str, *,
+                                       run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        scope = self.scope_for(query)
+        if scope is not None:
+            token = current_scope.set(scope)
+            try:
+                documents = await self.base_retriever.ainvoke(query, config={"callbacks": run_manager.get_child()})
+            finally:
+                current_scope.reset(token)
+            get_metrics().increment("rag_law_scope_total", result="scoped" if documents else "fallback")
+            if documents:
+                return documents
+        else:
+            get_metrics().increment("rag_law_scope_total", result="global")
+        return await self.base_retriever.ainvoke(query, config={"callbacks": run_manager.get_child()})
+
+
+class SectionLookupRetriever(BaseRetriever):
+    # A question naming a section of a known law ("Section 22 BDSG") gets the chunks of that
+    # section from the section index; everything else goes to the base retriever
+    vectorstore: Any
+    base_retriever: BaseRetriever
+    sections: Any
+    law_catalog: Any
+    k: int = config['retrieval']['k']
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def lookup(self, query):
+        with stage_timer("section_lookup"):
+            chunk_ids = self.sections.resolve(query, self.law_catalog)[:self.k]
+            documents = documents_by_id(self.vectorstore.docstore, chunk_ids) if chunk_ids else {}
+        get_metrics().increment("rag_section_lookup_total", result="hit" if documents else "miss")
+        return [documents[chunk_id] for chunk_id in chunk_ids if isinstance(documents.get(chunk_id), Document)]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.lookup(query) or self.base_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+
+    async def _aget_relevant_documents(self, query: str, *,
+                                       run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        documents = self.lookup(query)
+        if documents:
+            return documents
+        return await self.base_retriever.ainvoke(query, config={"callbacks": run_manager.get_child()})
+
+
 class FAISSRetriever:
-    def __init__(self, db_folder_path, embeddings_model="text-embedding-3-large", index_name="faiss_db"):
+    def __init__(self, db_folder_path, embeddings_model=config['embeddings']['model'], index_name="faiss_db",
+                 embeddings=None, law_catalog=None, rescore_factor=config['index']['rescore_factor']):
         logging.info("Initializing FAISSRetriever")
         self.db_folder_path = db_folder_path
         self.embeddings_model = embeddings_model
+        self.embeddings = embeddings
         self.index_name = index_name
+        # Needed to recognise law codes for the section lookup
+        self.law_catalog = law_catalog
+        # Only used by compact (fp16/sq8 or truncated) indexes, 0 keeps the first-stage ranking
+        self.rescore_factor = rescore_factor
+        self.db = None
+        self.bm25 = None
         self.retriever = None
         self.load_retriever()
         logging.info("FAISSRetriever initialized successfully")
@@ -22,14 +267,79 @@ class FAISSRetriever:
     def load_retriever(self):
         logging.info(f"Loading retriever with model: {self.embeddings_model}, index: {self.index_name}")
         try:
-            embeddings = OpenAIEmbeddings(model=self.embeddings_model)
-            db = FAISS.load_local(folder_path=self.db_folder_path, embeddings=embeddings, index_name=self.index_name, allow_dangerous_deserialization=True)
-            self.retriever = db.as_retriever(search_type="mmr", search_kwargs={"k": 10})
+            embeddings = self.embeddings if self.embeddings is not None else get_embeddings(self.embeddings_model)
+            db = load_vectorstore(folder_path=self.db_folder_path, embeddings=embeddings, index_name=self.index_name,
+                                  rescore_factor=self.rescore_factor)
+            self.db = db
+            self.retriever = self.with_section_lookup(db, self.with_law_scope(db, self.build_retriever(db)))
             logging.info("Retriever loaded successfully")
         except Exception as e:
             logging.error(f"Failed to load retriever: {e}")
             raise
 
+    def dense_retriever(self, db, k, retrieval_config=config['retrieval']):
+        if retrieval_config['search_type'] == 'mmr':
+            return MMRRetriever(vectorstore=db, k=k, fetch_k=retrieval_config['fetch_k'],
+                                lambda_mult=retrieval_config['lambda_mult'],
+                                dimensions=retrieval_config['mmr_dimensions'])
+        if isinstance(db, ShardedVectorStore):
+            # Not a langchain VectorStore; with lambda_mult 1 MMR keeps the k most similar
+            return MMRRetriever(vectorstore=db, k=k, fetch_k=k, lambda_mult=1.0)
+        return db.as_retriever(search_type=retrieval_config['search_type'], search_kwargs={"k": k})
+
+    def build_retriever(self, db, retrieval_config=config['retrieval'], rerank_config=config['rerank']):
+        if rerank_config['enabled']:
+            try:
+                cross_encoder = get_cross_encoder(rerank_config['model'], rerank_config['max_length'])
+            except ImportError:
+                logging.warning("Reranking is enabled but sentence-transformers is not installed, skipping it")
+            else:
+                base_retriever = self.build_retriever(db, {**retrieval_config, 'k': rerank_config['candidates']},
+                                                      {**rerank_config, 'enabled': False})
+                reranker = CrossEncoderReranker(cross_encoder, top_n=rerank_config['top_n'],
+                                                max_tokens=rerank_config['max_tokens'],
+                                                batch_size=rerank_config['batch_size'],
+                                                timeout_ms=rerank_config['timeout_ms'])
+                return RerankingRetriever(vectorstore=db, base_retriever=base_retriever, reranker=reranker)
+
+        bm25_path = index_paths(self.db_folder_path, self.index_name)['bm25']
+        if not retrieval_config['hybrid']:
+            return self.dense_retriever(db, retrieval_config['k'], retrieval_config)
+        if not os.path.exists(bm25_path):
+            logging.warning(f"No BM25 index at {bm25_path}, using dense retrieval only (run ingest.py to build it)")
+            return self.dense_retriever(db, retrieval_config['k'], retrieval_config)
+
+        if self.bm25 is None:
+            self.bm25 = BM25Index.load(bm25_path)
+            self.bm25.build_postings()
+        return HybridRetriever(vectorstore=db, dense_retriever=self.dense_retriever(db, retrieval_config['dense_k'],
+                                                                                   retrieval_config),
+                               bm25=self.bm25, k=retrieval_config['k'], bm25_k=retrieval_config['bm25_k'],
+                               dense_weight=retrieval_config['dense_weight'],
+                               bm25_weight=retrieval_config['bm25_weight'], rrf_k=retrieval_config['rrf_k'])
+
+    def with_law_scope(self, db, retriever, retrieval_config=config['retrieval']):
+        if not retrieval_config['law_scope'] or self.law_catalog is None or not self.law_catalog.laws:
+            return retriever
+        if retrieval_config['search_type'] != 'mmr' and not isinstance(db, ShardedVectorStore):
+            logging.warning("Law scoping needs search_type mmr, searching the whole index")
+            return retriever
+        partitions = LawPartitions.from_vectorstore(db, self.law_catalog)
+        if not partitions:
+            return retriever
+        return LawScopedRetriever(vectorstore=db, base_retriever=retriever, partitions=partitions,
+                                  law_catalog=self.law_catalog)
+
+    def with_section_lookup(self, db, retriever, retrieval_config=config['retrieval']):
+        sections_path = index_paths(self.db_folder_path, self.index_name)['sections']
+        if not retrieval_config['section_lookup'] or self.law_catalog is None:
+            return retriever
+        if not os.path.exists(sections_path):
+            logging.warning(f"No section index at {sections_path}, section lookup is disabled (run ingest.py to build it)")
+            return retriever
+        return SectionLookupRetriever(vectorstore=db, base_retriever=retriever, sections=SectionIndex.load(sections_path),
+                                      law_catalog=self.law_catalog, k=retrieval_config['k'])
+
     def get_retriever(self):
         if self.retriever:
             logging.info("Retriever is ready to be returned")
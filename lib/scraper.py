@@ -6,8 +6,8 @@ import re
 from tqdm import tqdm
 import logging
 import validators
-import time
 from lib.config import config
+from lib.downloader import PDFDownloader
 
 # Configure logging
 logging.basicConfig(level=config['logging']['level'],
@@ -98,10 +98,21 @@ class LawScraper:
     def get_laws_list(self):
         html_content = self.fetch_laws_page(self.laws_url)
         laws = self.parse_laws(html_content)
+        self.keep_download_validators(laws)
         self.save_laws_to_json(laws)
         print("Laws have been saved to", self.json_filepath)
         # self.print_laws(laws)
 
+    def keep_download_validators(self, laws):
+        if not os.path.exists(self.json_filepath):
+            return
+        previous = {law['pdf_url']: law for law in self.load_laws_from_json()}
+        for law in laws:
+            old = previous.get(law['pdf_url'], {})
+            for key in ('etag', 'last_modified', 'partial_etag'):
+                if old.get(key):
+                    law[key] = old[key]
+
     def load_laws_from_json(self):
         try:
             with open(self.json_filepath, 'r', encoding='utf-8') as f:
@@ -129,30 +140,41 @@ class LawScraper:
             logging.error(f"Error deleting existing PDFs: {e}")
             raise
 
-    def download_pdfs(self, laws):
-        self.delete_existing_pdfs()
+    def remove_stale_pdfs(self, laws):
+        expected = {f"{self.sanitize_filename(law['Law code'])}.pdf" for law in laws}
+        try:
+            for pdf_file in os.listdir(self.pdf_dir):
+                if pdf_file.endswith('.pdf') and pdf_file not in expected:
+                    os.remove(os.path.join(self.pdf_dir, pdf_file))
+                    logging.info(f"Removed PDF of law no longer listed: {pdf_file}")
+        except Exception as e:
+            logging.error(f"Error removing stale PDFs: {e}")
+            raise
+
+    def _download_jobs(self, laws):
         os.makedirs(self.pdf_dir, exist_ok=True)
-        for law in tqdm(laws, desc="Downloading PDFs"):
-            pdf_url = law['pdf_url']
+        self.remove_stale_pdfs(laws)
+        jobs = []
+        for law in laws:
             pdf_title = self.sanitize_filename(law['Law code'])
             pdf_path = os.path.join(self.pdf_dir, f"{pdf_title}.pdf")
-            try:
-                self.download_with_retries(pdf_url, pdf_path, pdf_title)
-            except Exception as e:
-                logging.error(f"Failed to download {pdf_title}: {e}")
-                tqdm.write(f"Failed to download {pdf_title}: {e}")
-
-    def download_with_retries(self, url, path, title, retries=3, delay=5):
-        for attempt in range(retries):
-            try:
-                response = requests.get(url)
-                response.raise_for_status()
-                with open(path, 'wb') as pdf_file:
-                    pdf_file.write(response.content)
-                logging.info(f"Downloaded: {title}")
-                tqdm.write(f"Downloaded: {title}")
-                return
-            except requests.exceptions.RequestException as e:
-                logging.error(f"Attempt {attempt + 1} failed for {title}: {e}")
-                time.sleep(delay)
-        raise Exception(f"Failed to download {title} after {retries} attempts")
+            jobs.append((law, law['pdf_url'], pdf_path, pdf_title))
+        return jobs
+
+    def download_pdfs(self, laws):
+        try:
+            return PDFDownloader().download_all(self._download_jobs(laws))
+        finally:
+            # Persist ETag/Last-Modified (and partial download state) for the next run
+            self.save_laws_to_json(laws)
+
+    def iter_download_pdfs(self, laws):
+        # Yields the path of every available PDF as soon as its download is settled,
+        # so parsing can start before the last law has been fetched
+        try:
+            for job, status in PDFDownloader().iter_download(self._download_jobs(laws)):
+                pdf_path = job[2]
+                if os.path.exists(pdf_path):
+                    yield pdf_path
+        finally:
+            self.save_laws_to_json(laws)
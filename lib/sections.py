@@ -0,0 +1,149 @@
+import os
+import re
+import json
+import bisect
+import logging
+from lib.config import config
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+# In the gesetze-im-internet translations a heading is a line of its own ("Section 9a",
+# "Article 5"), the title follows on the next line. References inside sentences continue
+# on the same line and are not headings.
+HEADING_PATTERN = re.compile(r"^[ \t]*(Section|Article|§)[ \t]+(\d+[a-z]*)[ \t]*$", re.MULTILINE)
+REFERENCE_PATTERN = re.compile(r"(?:\bsections?\b|\bsec\.|§|\barticles?\b|\bart\.)\s*(\d+[a-z]?)\b", re.IGNORECASE)
+MAX_TITLE_LENGTH = 200
+
+
+def law_code_for(source):
+    # Law PDFs are saved as <law code>.pdf by the scraper
+    return os.path.splitext(os.path.basename(source))[0]
+
+
+def normalize_code(law_code):
+    # Same replacement as LawScraper.sanitize_filename, so catalog codes match file names
+    return re.sub(r'[\\/*?:"<>|]', "_", law_code).lower()
+
+
+def section_label(metadata):
+    if not metadata.get('section'):
+        return None
+    label = f"{metadata.get('law_code', '')} {metadata.get('section_kind', 'Section')} {metadata['section']}".strip()
+    return f"{label} ({metadata['section_title']})" if metadata.get('section_title') else label
+
+
+def split_sections(records):
+    # records: the (page_content, metadata) pages of one law. Returns the page start offsets in
+    # the joined text and (text, start, metadata) per section; text before the first heading
+    # has no section metadata. None when the law has no headings at all.
+    text = "\n".join(content for content, _ in records)
+    headings = list(HEADING_PATTERN.finditer(text))
+    if not headings:
+        return None
+    page_starts, offset = [], 0
+    for content, _ in records:
+        page_starts.append(offset)
+        offset += len(content) + 1
+
+    law_code = law_code_for(records[0][1].get('source', ''))
+    sections = []
+    if text[:headings[0].start()].strip():
+        sections.append((text[:headings[0].start()], 0, {}))
+    for position, heading in enumerate(headings):
+        end = headings[position + 1].start() if position + 1 < len(headings) else len(text)
+        title = next((line.strip() for line in text[heading.end():end].splitlines() if line.strip()), "")
+        sections.append((text[heading.start():end], heading.start(), {
+            'law_code': law_code,
+            'section_kind': 'Section' if heading.group(1) == '§' else heading.group(1),
+            'section': heading.group(2),
+            'section_title': title[:MAX_TITLE_LENGTH],
+        }))
+    return page_starts, sections
+
+
+def split_law(records, text_splitter):
+    # Chunks never cross a section boundary and carry the section they belong to; each chunk
+    # keeps the metadata of the page it starts on
+    structure = split_sections(records)
+    if structure is None:
+        return None
+    page_starts, sections = structure
+    splits = []
+    for section_text, start, section_metadata in sections:
+        cursor = 0
+        for chunk in text_splitter.split_text(section_text):
+            found = section_text.find(chunk, cursor)
+            offset = start + (found if found != -1 else cursor)
+            cursor = found + 1 if found != -1 else cursor
+            page = bisect.bisect_right(page_starts, offset) - 1
+            splits.append((chunk, {**records[page][1], **section_metadata}))
+    return splits
+
+
+class SectionIndex:
+    # (law code, section number) -> chunk IDs in document order, so a question naming a
+    # section gets its text without a vector search
+    def __init__(self):
+        self.sections = {}
+        self.chunk_keys = {}
+
+    def __len__(self):
+        return len(self.sections)
+
+    @staticmethod
+    def key(law_code, section):
+        return f"{normalize_code(law_code)} {section.lower()}"
+
+    def add(self, chunk_ids, metadatas):
+        for chunk_id, metadata in zip(chunk_ids, metadatas):
+            if not metadata.get('section') or chunk_id in self.chunk_keys:
+                continue
+            key = self.key(metadata.get('law_code', ''), metadata['section'])
+            self.sections.setdefault(key, []).append(chunk_id)
+            self.chunk_keys[chunk_id] = key
+
+    def remove(self, chunk_ids):
+        for chunk_id in chunk_ids:
+            key = self.chunk_keys.pop(chunk_id, None)
+            if key is None:
+                continue
+            remaining = [other for other in self.sections[key] if other != chunk_id]
+            if remaining:
+                self.sections[key] = remaining
+            else:
+                del self.sections[key]
+
+    def lookup(self, law_code, section):
+        return self.sections.get(self.key(law_code, section), [])
+
+    def resolve(self, text, law_catalog):
+        # Every section number in the text is tried with every law the catalog finds in it
+        numbers = list(dict.fromkeys(match.group(1) for match in REFERENCE_PATTERN.finditer(text)))
+        if not numbers or law_catalog is None:
+            return []
+        chunk_ids = []
+        for law in law_catalog.find(text):
+            for number in numbers:
+                chunk_ids.extend(self.lookup(law['Law code'], number))
+        return list(dict.fromkeys(chunk_ids))
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.sections, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        logging.info(f"Saved section index with {len(self.sections)} sections to {path}")
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with open(path, 'r', encoding='utf-8') as f:
+            index.sections = json.load(f)
+        index.chunk_keys = {chunk_id: key for key, chunk_ids in index.sections.items() for chunk_id in chunk_ids}
+        logging.info(f"Loaded section index with {len(index.sections)} sections from {path}")
+        return index
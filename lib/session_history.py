@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from typing import List, Sequence
+from langchain_community.chat_message_histories import ChatMessageHistory
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+from lib.config import config
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+
+class SessionHistoryStore:
+    # Histories kept in this process only, lost on restart
+    def __init__(self):
+        self.store = {}
+        self._lock = threading.Lock()
+
+    def get_session_history(self, session_id: str) -> BaseChatMessageHistory:
+        with self._lock:
+            if session_id not in self.store:
+                self.store[session_id] = ChatMessageHistory()
+            return self.store[session_id]
+
+    def clear(self, session_id):
+        with self._lock:
+            self.store.pop(session_id, None)
+
+
+class SQLiteChatMessageHistory(BaseChatMessageHistory):
+    def __init__(self, store, session_id):
+        self.store = store
+        self.session_id = session_id
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        return self.store.read(self.session_id)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self.store.write(self.session_id, messages)
+
+    def clear(self) -> None:
+        self.store.clear(self.session_id)
+
+
+class SQLiteSessionHistoryStore:
+    # Histories shared by all server processes on this machine and kept across restarts.
+    # Only the newest max_messages per session are read, the chain trims them further.
+    def __init__(self, path=config['api']['history_path'], max_messages=config['api']['history_max_messages']):
+        self.path = path
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, "
+            "message TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, id)")
+        self._conn.commit()
+        logging.info(f"Session history store opened at {self.path}")
+
+    def get_session_history(self, session_id: str) -> BaseChatMessageHistory:
+        return SQLiteChatMessageHistory(self, session_id)
+
+    def read(self, session_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT message FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                (session_id, self.max_messages or -1)
+            ).fetchall()
+        return messages_from_dict([json.loads(message) for message, in reversed(rows)])
+
+    def write(self, session_id, messages):
+        now = time.time()
+        rows = [(session_id, json.dumps(message_to_dict(message), ensure_ascii=False), now) for message in messages]
+        with self._lock:
+            self._conn.executemany("INSERT INTO messages (session_id, message, created) VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+
+    def clear(self, session_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_history_store(kind=config['api']['history_store']):
+    if kind == 'sqlite':
+        return SQLiteSessionHistoryStore()
+    if kind == 'memory':
+        return SessionHistoryStore()
+    raise ValueError(f"Unknown history store: {kind}")
@@ -0,0 +1,246 @@
+import os
+import json
+import zlib
+import heapq
+import logging
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+import faiss
+import numpy as np
+from lib.config import config
+from lib.mmr import batch_search_with_vectors
+from lib.sections import law_code_for
+from lib.vectorstore import (add_embeddings, index_paths, index_version, load_vectorstore, new_vectorstore,
+                             remove_ids, save_vectorstore, scoped_search_params)
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+# Global labels carry the shard number in their upper bits, so a label alone identifies
+# the shard and the label inside it
+SHARD_BITS = 40
+LOCAL_MASK = (1 << SHARD_BITS) - 1
+
+# FAISS releases the GIL while searching, so shards are searched in parallel threads
+_shard_executor = ThreadPoolExecutor(max_workers=config['shards']['max_workers'] or os.cpu_count(),
+                                     thread_name_prefix="shard")
+
+
+def shard_name(index_name, shard):
+    return f"{index_name}.shard{shard:03d}"
+
+
+def global_label(shard, label):
+    return (shard << SHARD_BITS) | int(label)
+
+
+def shard_for(chunk_id, metadata, num_shards, shard_by):
+    # By law, all chunks of a law share a shard and updating the law rewrites only that shard
+    key = law_code_for(metadata.get('source', '')) if shard_by == 'law' else chunk_id
+    return zlib.crc32(key.encode('utf-8')) % num_shards
+
+
+class ShardedIndex:
+    # Searches every shard index and merges the per-shard top k, the subset of the faiss
+    # Index interface the retrievers use
+    def __init__(self, indexes):
+        self.indexes = indexes
+        first = next(iter(indexes.values()))
+        self.d = first.d
+        self.metric_type = first.metric_type
+
+    @property
+    def ntotal(self):
+        return sum(index.ntotal for index in self.indexes.values())
+
+    def scoped_params(self, labels):
+        # shard -> (SearchParameters, selector) for the shards holding any of the labels
+        labels = np.asarray(labels, dtype=np.int64)
+        shards = labels >> SHARD_BITS
+        return {int(shard): scoped_search_params(self.indexes[int(shard)], labels[shards == shard] & LOCAL_MASK)
+                for shard in np.unique(shards) if int(shard) in self.indexes}
+
+    def search_and_reconstruct(self, queries, k, params=None):
+        # params: the output of scoped_params, only those shards are searched
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.d)
+        shards = list(params) if params is not None else list(self.indexes)
+
+        def search(shard):
+            return shard, batch_search_with_vectors(self.indexes[shard], queries, k,
+                                                    params[shard][0] if params is not None else None)
+
+        results = list(_shard_executor.map(search, shards)) if len(shards) > 1 else [search(shard) for shard in shards]
+        descending = self.metric_type == faiss.METRIC_INNER_PRODUCT
+        scores = np.full((len(queries), k), -np.inf if descending else np.inf, dtype=np.float32)
+        labels = np.full((len(queries), k), -1, dtype=np.int64)
+        vectors = np.zeros((len(queries), k, self.d), dtype=np.float32)
+        for row in range(len(queries)):
+            # Every shard returns its hits best first, a k-way heap merge keeps the global best k
+            hits = [[(float(score), global_label(shard, label), vector)
+                     for score, label, vector in zip(shard_scores[row], shard_labels[row], shard_vectors[row])
+                     if label != -1]
+                    for shard, (shard_scores, shard_labels, shard_vectors) in results]
+            for position, (score, label, vector) in enumerate(
+                    islice(heapq.merge(*hits, key=lambda hit: hit[0], reverse=descending), k)):
+                scores[row, position], labels[row, position], vectors[row, position] = score, label, vector
+        return scores, labels, vectors
+
+    def search(self, query, k, params=None):
+        scores, labels, _ = self.search_and_reconstruct(query, k, params=params)
+        return scores, labels
+
+    def reconstruct(self, label):
+        return self.indexes[label >> SHARD_BITS].reconstruct(label & LOCAL_MASK)
+
+
+class ShardedDocstore:
+    # Routes chunk IDs to the docstore of the shard holding them
+    def __init__(self, store):
+        self.store = store
+
+    def search(self, search):
+        shard = self.store.chunk_shards.get(search)
+        if shard is None:
+            return f"ID {search} not found."
+        return self.store.shards[shard].docstore.search(search)
+
+    def search_many(self, ids):
+        by_shard = {}
+        for chunk_id in ids:
+            if chunk_id in self.store.chunk_shards:
+                by_shard.setdefault(self.store.chunk_shards[chunk_id], []).append(chunk_id)
+        found = {}
+        for shard, chunk_ids in by_shard.items():
+            docstore = self.store.shards[shard].docstore
+            if hasattr(docstore, 'search_many'):
+                found.update(docstore.search_many(chunk_ids))
+            else:
+                found.update((chunk_id, docstore.search(chunk_id)) for chunk_id in chunk_ids)
+        return found
+
+    def metadata_values(self, key):
+        values = {}
+        for shard, db in self.store.shards.items():
+            if hasattr(db.docstore, 'metadata_values'):
+                shard_values = db.docstore.metadata_values(key)
+            else:
+                shard_values = {label: db.docstore.search(chunk_id).metadata.get(key)
+                                for label, chunk_id in db.index_to_docstore_id.items()}
+            values.update((global_label(shard, label), value) for label, value in shard_values.items())
+        return values
+
+    def close(self):
+        for db in self.store.shards.values():
+            if hasattr(db.docstore, 'close'):
+                db.docstore.close()
+
+
+class ShardedVectorStore:
+    # One FAISS vector store per shard, each saved as <index_name>.shardNNN next to a common
+    # meta file. Only shards changed since the last save are written again.
+    def __init__(self, embeddings, shards, num_shards=config['shards']['count'], shard_by=config['shards']['by'],
+                 index_type=config['index']['type'], index_config=config['index']):
+        self.embedding_function = embeddings
+        self.shards = shards
+        self.num_shards = num_shards
+        self.shard_by = shard_by
+        self.index_type = index_type
+        self.index_config = index_config
+        self.dirty = set()
+        self.docstore = ShardedDocstore(self)
+        self.chunk_shards = {chunk_id: shard for shard, db in shards.items()
+                             for chunk_id in db.index_to_docstore_id.values()}
+        self._index = None
+        self._index_to_docstore_id = None
+
+    @property
+    def index(self):
+        if self._index is None and self.shards:
+            self._index = ShardedIndex({shard: db.index for shard, db in self.shards.items()})
+        return self._index
+
+    @property
+    def index_to_docstore_id(self):
+        if self._index_to_docstore_id is None:
+            self._index_to_docstore_id = {global_label(shard, label): chunk_id for shard, db in self.shards.items()
+                                          for label, chunk_id in db.index_to_docstore_id.items()}
+        return self._index_to_docstore_id
+
+    def changed(self, shards):
+        self.dirty.update(shards)
+        self._index = None
+        self._index_to_docstore_id = None
+
+    def add_embeddings(self, documents, vectors, ids):
+        groups = {}
+        for document, vector, chunk_id in zip(documents, vectors, ids):
+            shard = shard_for(chunk_id, document.metadata, self.num_shards, self.shard_by)
+            groups.setdefault(shard, ([], [], []))
+            groups[shard][0].append(document)
+            groups[shard][1].append(vector)
+            groups[shard][2].append(chunk_id)
+        for shard, (shard_documents, shard_vectors, shard_ids) in groups.items():
+            if shard not in self.shards:
+                # IVF shards are trained on the vectors that create them
+                self.shards[shard] = new_vectorstore(self.embedding_function, shard_vectors, index_type=self.index_type,
+                                                     index_config=self.index_config)
+            add_embeddings(self.shards[shard], shard_documents, shard_vectors, shard_ids)
+            self.chunk_shards.update((chunk_id, shard) for chunk_id in shard_ids)
+        self.changed(groups)
+
+    def remove_ids(self, removed_ids):
+        groups = {}
+        for chunk_id in removed_ids:
+            shard = self.chunk_shards.pop(chunk_id, None)
+            if shard is not None:
+                groups.setdefault(shard, []).append(chunk_id)
+        for shard, shard_ids in groups.items():
+            db = remove_ids(self.shards[shard], shard_ids, index_type=self.index_type, index_config=self.index_config)
+            if db is None or db.index.ntotal == 0:
+                del self.shards[shard]
+            else:
+                self.shards[shard] = db
+        self.changed(groups)
+        return self
+
+    def save(self, folder_path, index_name, checkpoint=False):
+        os.makedirs(folder_path, exist_ok=True)
+        for shard in sorted(self.dirty):
+            if shard in self.shards:
+                save_vectorstore(self.shards[shard], folder_path, shard_name(index_name, shard),
+                                 index_type=self.index_type, index_config=self.index_config, checkpoint=checkpoint)
+            else:
+                for path in index_paths(folder_path, shard_name(index_name, shard)).values():
+                    if os.path.exists(path):
+                        os.remove(path)
+        logging.info(f"Saved {len(self.dirty)} of {len(self.shards)} shards")
+        self.dirty.clear()
+
+        # Written last: its new version makes servers reload the shards, a checkpoint keeps the old one
+        meta = {'index_type': self.index_type, 'storage': self.index_config['storage'],
+                'dimensions': self.index_config['dimensions'], 'sharded': True, 'num_shards': self.num_shards,
+                'shard_by': self.shard_by, 'shards': sorted(self.shards), 'ntotal': sum(
+                    db.index.ntotal for db in self.shards.values()),
+                'dim': next(iter(self.shards.values())).index.d if self.shards else None,
+                'version': index_version(folder_path, index_name, checkpoint), 'checkpoint': checkpoint}
+        meta_path = index_paths(folder_path, index_name)['meta']
+        with open(f"{meta_path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(meta, f, indent=4)
+        os.replace(f"{meta_path}.tmp", meta_path)
+        return meta
+
+
+def load_sharded_vectorstore(folder_path, embeddings, index_name, meta, mmap=config['index']['mmap'], read_only=True,
+                             rescore_factor=config['index']['rescore_factor']):
+    def load(shard):
+        return shard, load_vectorstore(folder_path, embeddings, shard_name(index_name, shard), mmap=mmap,
+                                       read_only=read_only, rescore_factor=rescore_factor)
+
+    shards = dict(_shard_executor.map(load, meta['shards']))
+    logging.info(f"Loaded {len(shards)} shards ({meta['shard_by']}) from {folder_path}")
+    index_config = {**config['index'], 'storage': meta.get('storage', 'float32'), 'dimensions': meta.get('dimensions')}
+    return ShardedVectorStore(embeddings, shards, num_shards=meta['num_shards'], shard_by=meta['shard_by'],
+                              index_type=meta['index_type'], index_config=index_config)
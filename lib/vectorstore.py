@@ -0,0 +1,432 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from lib.config import config
+from lib.mmr import normalize_rows
+
+logging.basicConfig(level=config['logging']['level'],
+                    format=config['logging']['format'],
+                    filename=config['logging']['filename'],
+                    filemode=config['logging']['filemode'],
+                    encoding='utf-8')
+
+INDEX_TYPES = ('flat', 'ivf_flat', 'hnsw', 'ivf_pq')
+STORAGE_TYPES = {'float32': None, 'fp16': "SQfp16", 'sq8': "SQ8"}
+# Rough minimum number of training vectors per IVF centroid / PQ codebook entry
+MIN_POINTS_PER_CENTROID = 39
+
+
+class SQLiteDocstore(Docstore, AddableMixin):
+    # Documents are fetched lazily from SQLite, so a process only pays for the chunks it
+    # actually returns and several processes share the file through the OS page cache.
+    def __init__(self, path, read_only=True):
+        self.path = path
+        self.read_only = read_only
+        self._lock = threading.Lock()
+        uri = f"file:{path}?mode=ro" if read_only else f"file:{path}"
+        self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        if not read_only:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "id TEXT PRIMARY KEY, position INTEGER, page_content TEXT NOT NULL, metadata TEXT NOT NULL)"
+            )
+            self._conn.commit()
+
+    def search(self, search):
+        with self._lock:
+            row = self._conn.execute("SELECT page_content, metadata FROM documents WHERE id = ?", (search,)).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        return Document(page_content=row[0], metadata=json.loads(row[1]))
+
+    def search_many(self, ids):
+        found = {}
+        with self._lock:
+            for start in range(0, len(ids), 500):
+                batch = list(ids[start:start + 500])
+                placeholders = ",".join("?" * len(batch))
+                for doc_id, content, metadata in self._conn.execute(
+                        f"SELECT id, page_content, metadata FROM documents WHERE id IN ({placeholders})", batch):
+                    found[doc_id] = Document(page_content=content, metadata=json.loads(metadata))
+        return found
+
+    def add(self, texts):
+        if self.read_only:
+            raise ValueError("Docstore was opened read-only")
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO documents (id, page_content, metadata) VALUES (?, ?, ?)",
+                [(doc_id, doc.page_content, json.dumps(doc.metadata, ensure_ascii=False)) for doc_id, doc in texts.items()]
+            )
+            self._conn.commit()
+
+    def delete(self, ids):
+        if self.read_only:
+            raise ValueError("Docstore was opened read-only")
+        with self._lock:
+            self._conn.executemany("DELETE FROM documents WHERE id = ?", [(doc_id,) for doc_id in ids])
+            self._conn.commit()
+
+    def metadata_values(self, key):
+        # {position: metadata[key]} without decoding every stored document
+        with self._lock:
+            return dict(self._conn.execute(
+                "SELECT position, json_extract(metadata, ?) FROM documents WHERE position IS NOT NULL", (f"$.{key}",)))
+
+    def index_to_docstore_id(self):
+        with self._lock:
+            return {position: doc_id for doc_id, position in
+                    self._conn.execute("SELECT id, position FROM documents WHERE position IS NOT NULL")}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def index_paths(folder_path, index_name):
+    return {
+        'index': os.path.join(folder_path, f"{index_name}.faiss"),
+        'docstore': os.path.join(folder_path, f"{index_name}.docstore.sqlite"),
+        'meta': os.path.join(folder_path, f"{index_name}.meta.json"),
+        'bm25': os.path.join(folder_path, f"{index_name}.bm25.npz"),
+        'sections': os.path.join(folder_path, f"{index_name}.sections.json"),
+        'vectors': os.path.join(folder_path, f"{index_name}.vectors.npy"),
+        'legacy_docstore': os.path.join(folder_path, f"{index_name}.pkl"),
+    }
+
+
+class RescoringIndex:
+    # A compact first-stage index over scalar-quantized and/or Matryoshka-truncated vectors,
+    # with the full float32 vectors in a side array (row = label) that is memory-mapped when
+    # serving. rescore_factor times more candidates are fetched and re-scored exactly with
+    # the full vectors, which are also what MMR gets back.
+    def __init__(self, index, vectors, dimensions=None, rescore_factor=config['index']['rescore_factor']):
+        self.index = index
+        self.vectors = vectors
+        self.rows = len(vectors)
+        self.dimensions = dimensions
+        self.rescore_factor = rescore_factor
+
+    @property
+    def d(self):
+        return self.vectors.shape[1]
+
+    @property
+    def ntotal(self):
+        return self.index.ntotal
+
+    @property
+    def metric_type(self):
+        return self.index.metric_type
+
+    def first_stage(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return normalize_rows(vectors, self.dimensions) if self.dimensions else vectors
+
+    def store(self, vectors, labels):
+        end = int(labels.max()) + 1
+        if end > len(self.vectors):
+            grown = np.empty((max(end, 2 * len(self.vectors)), self.d), dtype=np.float32)
+            grown[:self.rows] = self.vectors[:self.rows]
+            self.vectors = grown
+        self.vectors[labels] = vectors
+        self.rows = max(self.rows, end)
+
+    def add(self, vectors):
+        self.store(vectors, np.arange(self.index.ntotal, self.index.ntotal + len(vectors)))
+        self.index.add(self.first_stage(vectors))
+
+    def add_with_ids(self, vectors, labels):
+        self.store(vectors, labels)
+        self.index.add_with_ids(self.first_stage(vectors), labels)
+
+    def remove_ids(self, labels):
+        removed = self.index.remove_ids(labels)
+        if not is_ivf(self.index):
+            # Flat and SQ indexes renumber the remaining vectors, the rows follow
+            keep = np.ones(self.rows, dtype=bool)
+            keep[labels] = False
+            self.vectors = self.vectors[:self.rows][keep]
+            self.rows = len(self.vectors)
+        return removed
+
+    def reconstruct(self, label):
+        return np.array(self.vectors[label], dtype=np.float32)
+
+    def search_and_reconstruct(self, queries, k, params=None):
+        # Same (nq, k) results as a faiss index, padded with label -1
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.d)
+        fetch_k = k * self.rescore_factor if self.rescore_factor else k
+        candidate_scores, candidate_labels = self.index.search(self.first_stage(queries), fetch_k, params=params)
+        descending = self.metric_type == faiss.METRIC_INNER_PRODUCT
+        scores = np.full((len(queries), k), -np.inf if descending else np.inf, dtype=np.float32)
+        labels = np.full((len(queries), k), -1, dtype=np.int64)
+        vectors = np.zeros((len(queries), k, self.d), dtype=np.float32)
+        for row, query in enumerate(queries):
+            valid = candidate_labels[row] != -1
+            row_scores, row_labels = candidate_scores[row][valid], candidate_labels[row][valid]
+            row_vectors = np.asarray(self.vectors[row_labels], dtype=np.float32)
+            if self.rescore_factor:
+                row_scores = row_vectors @ query if descending else ((row_vectors - query) ** 2).sum(axis=1)
+                order = np.argsort(-row_scores if descending else row_scores, kind='stable')[:k]
+                row_scores, row_labels, row_vectors = row_scores[order], row_labels[order], row_vectors[order]
+            found = len(row_labels)
+            scores[row, :found], labels[row, :found], vectors[row, :found] = row_scores, row_labels, row_vectors
+        return scores, labels, vectors
+
+    def search(self, query, k, params=None):
+        scores, labels, _ = self.search_and_reconstruct(query, k, params=params)
+        return scores, labels
+
+
+def base_index(index):
+    return index.index if isinstance(index, RescoringIndex) else index
+
+
+def is_compact(index_config=config['index']):
+    # Compact indexes keep the full vectors in a side file for re-scoring
+    return index_config['storage'] != 'float32' or bool(index_config['dimensions'])
+
+
+def index_factory_string(index_type, num_vectors, index_config=config['index']):
+    if index_config['storage'] not in STORAGE_TYPES:
+        raise ValueError(f"Unknown index storage: {index_config['storage']}, expected one of {tuple(STORAGE_TYPES)}")
+    # Scalar quantization: 2 (fp16) or 1 (sq8) bytes per dimension instead of 4
+    storage = STORAGE_TYPES[index_config['storage']]
+    if index_type == 'flat':
+        return storage or "Flat"
+    if index_type == 'hnsw':
+        return f"HNSW{index_config['hnsw_m']}" + (f"_{storage}" if storage else "")
+    # IVF needs enough training vectors per centroid; shrink nlist for small corpora
+    nlist = max(1, min(index_config['nlist'], num_vectors // MIN_POINTS_PER_CENTROID))
+    if index_type == 'ivf_flat':
+        return f"IVF{nlist},{storage or 'Flat'}"
+    if index_type == 'ivf_pq':
+        if num_vectors < MIN_POINTS_PER_CENTROID * (1 << index_config['pq_nbits']):
+            logging.warning(f"Only {num_vectors} vectors to train IVF-PQ, falling back to IVF-Flat")
+            return f"IVF{nlist},{storage or 'Flat'}"
+        return f"IVF{nlist},PQ{index_config['pq_m']}x{index_config['pq_nbits']}"
+    raise ValueError(f"Unknown index type: {index_type}, expected one of {INDEX_TYPES}")
+
+
+def create_index(index_type, training_vectors, index_config=config['index']):
+    training_vectors = np.asarray(training_vectors, dtype=np.float32)
+    dim = training_vectors.shape[1]
+    dimensions = index_config['dimensions'] if index_config['dimensions'] and index_config['dimensions'] < dim else None
+    if dimensions:
+        # Matryoshka: text-embedding-3 vectors keep most of their quality in the leading dimensions
+        training_vectors = normalize_rows(training_vectors, dimensions)
+    factory = index_factory_string(index_type, len(training_vectors), index_config)
+    index = faiss.index_factory(training_vectors.shape[1], factory)
+    if index_type == 'hnsw':
+        index.hnsw.efConstruction = index_config['ef_construction']
+    if not index.is_trained:
+        logging.info(f"Training {factory} index on {len(training_vectors)} vectors")
+        index.train(training_vectors)
+    if factory.startswith("IVF"):
+        # Needed for reconstruct() (MMR) and remove_ids() on IVF indexes
+        faiss.extract_index_ivf(index).set_direct_map_type(faiss.DirectMap.Hashtable)
+    logging.info(f"Created FAISS index: {factory}" + (f" on {dimensions} dimensions" if dimensions else ""))
+    if is_compact(index_config):
+        return RescoringIndex(index, np.empty((0, dim), dtype=np.float32), dimensions=dimensions,
+                              rescore_factor=index_config['rescore_factor'])
+    return index
+
+
+def apply_search_params(index, index_config=config['index']):
+    index = base_index(index)
+    parameter_space = faiss.ParameterSpace()
+    if 'IVF' in type(index).__name__:
+        parameter_space.set_index_parameter(index, "nprobe", index_config['nprobe'])
+    if 'HNSW' in type(index).__name__:
+        parameter_space.set_index_parameter(index, "efSearch", index_config['ef_search'])
+
+
+def scoped_search_params(index, labels, index_config=config['index']):
+    # Restricts a search to the given labels. The selector must outlive the parameters,
+    # both are returned. IVF visits more cells, since most of the nearest cells may hold
+    # no selected vector at all.
+    selector = faiss.IDSelectorBatch(np.asarray(labels, dtype=np.int64))
+    index = base_index(index)
+    if 'IVF' in type(index).__name__:
+        nprobe = min(faiss.extract_index_ivf(index).nlist, max(index_config['nprobe'], index_config['scoped_nprobe']))
+        return faiss.SearchParametersIVF(sel=selector, nprobe=nprobe), selector
+    if 'HNSW' in type(index).__name__:
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=index_config['ef_search']), selector
+    return faiss.SearchParameters(sel=selector), selector
+
+
+def new_vectorstore(embeddings, training_vectors, index_type=config['index']['type'], index_config=config['index']):
+    index = create_index(index_type, training_vectors, index_config)
+    return FAISS(embedding_function=embeddings, index=index, docstore=InMemoryDocstore(), index_to_docstore_id={})
+
+
+def read_meta(folder_path, index_name):
+    meta_path = index_paths(folder_path, index_name)['meta']
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def index_version(folder_path, index_name, checkpoint=False):
+    # Servers reload when the version changes. Checkpoints of a running ingestion keep the
+    # version already served (None for a first build), only the final save bumps it.
+    if not checkpoint:
+        return time.time_ns()
+    meta = read_meta(folder_path, index_name)
+    return meta.get('version') if meta else None
+
+
+def save_vectorstore(db, folder_path, index_name, index_type=config['index']['type'], index_config=config['index'],
+                     checkpoint=False):
+    # Every file is written next to its target and swapped in with os.replace, readers that
+    # still have the previous version open keep working until they reload.
+    os.makedirs(folder_path, exist_ok=True)
+    paths = index_paths(folder_path, index_name)
+
+    tmp_index = f"{paths['index']}.tmp"
+    faiss.write_index(base_index(db.index), tmp_index)
+    tmp_vectors = f"{paths['vectors']}.tmp"
+    if isinstance(db.index, RescoringIndex):
+        with open(tmp_vectors, 'wb') as f:
+            np.save(f, np.asarray(db.index.vectors[:db.index.rows], dtype=np.float32))
+
+    tmp_docstore = f"{paths['docstore']}.tmp"
+    if os.path.exists(tmp_docstore):
+        os.remove(tmp_docstore)
+    docstore = SQLiteDocstore(tmp_docstore, read_only=False)
+    with docstore._lock:
+        rows = []
+        for position, doc_id in db.index_to_docstore_id.items():
+            document = db.docstore.search(doc_id)
+            rows.append((doc_id, position, document.page_content, json.dumps(document.metadata, ensure_ascii=False)))
+        docstore._conn.executemany("INSERT INTO documents VALUES (?, ?, ?, ?)", rows)
+        docstore._conn.commit()
+    docstore.close()
+
+    meta = {'index_type': index_type, 'ntotal': db.index.ntotal, 'dim': db.index.d,
+            'version': index_version(folder_path, index_name, checkpoint), 'checkpoint': checkpoint}
+    if isinstance(db.index, RescoringIndex):
+        meta.update({'storage': index_config['storage'], 'dimensions': db.index.dimensions})
+    tmp_meta = f"{paths['meta']}.tmp"
+    with open(tmp_meta, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=4)
+
+    os.replace(tmp_index, paths['index'])
+    os.replace(tmp_docstore, paths['docstore'])
+    if isinstance(db.index, RescoringIndex):
+        os.replace(tmp_vectors, paths['vectors'])
+    elif os.path.exists(paths['vectors']):
+        os.remove(paths['vectors'])
+    os.replace(tmp_meta, paths['meta'])
+    if os.path.exists(paths['legacy_docstore']):
+        os.remove(paths['legacy_docstore'])
+    logging.info(f"Saved {meta['ntotal']} vectors ({index_type}) to {folder_path}")
+    return meta
+
+
+def load_vectorstore(folder_path, embeddings, index_name, mmap=config['index']['mmap'], read_only=True,
+                     rescore_factor=config['index']['rescore_factor']):
+    # read_only: lazy SQLite docstore and (optionally) a memory-mapped index for serving.
+    # Otherwise everything is loaded into memory so the store can be updated and saved again.
+    meta = read_meta(folder_path, index_name)
+    if meta and meta.get('sharded'):
+        # Imported here, lib.shards builds on this module
+        from lib.shards import load_sharded_vectorstore
+        return load_sharded_vectorstore(folder_path, embeddings, index_name, meta, mmap=mmap, read_only=read_only,
+                                        rescore_factor=rescore_factor)
+
+    paths = index_paths(folder_path, index_name)
+    if not os.path.exists(paths['docstore']) and os.path.exists(paths['legacy_docstore']):
+        logging.warning(f"Loading legacy pickle docstore from {paths['legacy_docstore']}, it is converted on next save")
+        return FAISS.load_local(folder_path=folder_path, embeddings=embeddings, index_name=index_name,
+                                allow_dangerous_deserialization=True)
+
+    io_flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if read_only and mmap else 0
+    index = faiss.read_index(paths['index'], io_flags)
+    if meta and 'storage' in meta:
+        # Only the re-scored candidates' rows of the full vectors are ever read
+        vectors = np.load(paths['vectors'], mmap_mode='r' if read_only and mmap else None)
+        index = RescoringIndex(index, vectors, dimensions=meta['dimensions'], rescore_factor=rescore_factor)
+    apply_search_params(index)
+
+    sqlite_docstore = SQLiteDocstore(paths['docstore'], read_only=True)
+    index_to_docstore_id = sqlite_docstore.index_to_docstore_id()
+    if read_only:
+        docstore = sqlite_docstore
+    else:
+        docstore = InMemoryDocstore(sqlite_docstore.search_many(list(index_to_docstore_id.values())))
+        sqlite_docstore.close()
+
+    logging.info(f"Loaded {index.ntotal} vectors from {paths['index']} (mmap={bool(io_flags)})")
+    return FAISS(embedding_function=embeddings, index=index, docstore=docstore, index_to_docstore_id=index_to_docstore_id)
+
+
+def is_ivf(index):
+    return 'IVF' in type(base_index(index)).__name__
+
+
+def add_embeddings(db, documents, vectors, ids):
+    # IVF indexes keep their labels after remove_ids(), so new vectors get explicit labels
+    # past the highest one in use. Flat indexes compact on removal and use sequential labels.
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if is_ivf(db.index):
+        start = max(db.index_to_docstore_id, default=-1) + 1
+        labels = np.arange(start, start + len(ids), dtype=np.int64)
+        db.index.add_with_ids(vectors, labels)
+    else:
+        start = db.index.ntotal
+        labels = range(start, start + len(ids))
+        db.index.add(vectors)
+    db.docstore.add(dict(zip(ids, documents)))
+    db.index_to_docstore_id.update({int(label): doc_id for label, doc_id in zip(labels, ids)})
+
+
+def remove_ids(db, removed_ids, index_type=config['index']['type'], index_config=config['index']):
+    removed = set(removed_ids)
+    positions = [position for position, doc_id in db.index_to_docstore_id.items() if doc_id in removed]
+    if not positions:
+        return db
+    if 'HNSW' in type(base_index(db.index)).__name__:
+        # HNSW graphs do not support removal: rebuild from the stored vectors
+        logging.info("HNSW index does not support removal, rebuilding it")
+        return rebuild_without(db, removed, index_type=index_type, index_config=index_config)
+
+    db.index.remove_ids(np.array(positions, dtype=np.int64))
+    db.docstore.delete([db.index_to_docstore_id[position] for position in positions])
+    if is_ivf(db.index):
+        for position in positions:
+            del db.index_to_docstore_id[position]
+    else:
+        remaining = [doc_id for _, doc_id in sorted(db.index_to_docstore_id.items()) if doc_id not in removed]
+        db.index_to_docstore_id = dict(enumerate(remaining))
+    return db
+
+
+def rebuild_without(db, removed_ids, index_type=config['index']['type'], index_config=config['index']):
+    removed = set(removed_ids)
+    keep = [(position, doc_id) for position, doc_id in sorted(db.index_to_docstore_id.items()) if doc_id not in removed]
+    if not keep:
+        # Nothing to rebuild from: keep the trained index, emptied, so the store can still be saved
+        base_index(db.index).reset()
+        if isinstance(db.index, RescoringIndex):
+            db.index.vectors = np.empty((0, db.index.d), dtype=np.float32)
+            db.index.rows = 0
+        return FAISS(embedding_function=db.embedding_function, index=db.index, docstore=InMemoryDocstore(),
+                     index_to_docstore_id={})
+    vectors = np.vstack([db.index.reconstruct(position) for position, _ in keep])
+    index = create_index(index_type, vectors, index_config)
+    index.add(vectors)
+    documents = {doc_id: db.docstore.search(doc_id) for _, doc_id in keep}
+    return FAISS(embedding_function=db.embedding_function, index=index, docstore=InMemoryDocstore(documents),
+                 index_to_docstore_id={position: doc_id for position, (_, doc_id) in enumerate(keep)})
@@ -1,149 +1,91 @@
-import csv
-from dotenv import load_dotenv
-from langchain_openai import ChatOpenAI
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.chat_message_histories import ChatMessageHistory
-from langchain_core.chat_history import BaseChatMessageHistory
-from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_community.document_loaders.csv_loader import CSVLoader
-from langchain.chains import create_history_aware_retriever
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.chains import create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_community.vectorstores import FAISS
-from lib.retrieval import FAISSRetriever
-from lib.data_prep import load_and_process_pdfs
-from lib.scraper import LawScraper
-from lib.indexing import Indexing
 from lib.config import config
-from evaluation import run_evaluation
+import os
+import json
+import uuid
+import requests
 import streamlit as st
-from langchain_core.messages import BaseMessage
-import time
-from openai import RateLimitError
-from langchain.globals import set_verbose
 
-set_verbose(True)
-
-
-
-def stream_data(response):
-    for word in response.split(" "):
-        yield word + " "
-        time.sleep(0.02)
-
-
-store = {}
-
-
-def get_session_history(session_id: str) -> BaseChatMessageHistory:
-    if session_id not in store:
-        store[session_id] = ChatMessageHistory()
-        store[session_id].add_message(BaseMessage(role="assistant", content=laws_list_str))
-    return store[session_id]
+# The chain runs in the API service (api.py), this script is only its chat UI
+API_URL = config['api']['url']
+
+
+class APIError(Exception):
+    pass
+
+
+def server_events(response):
+    # Minimal server-sent events parser: yields (event, data) pairs
+    event, data = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            if data:
+                yield event, json.loads("\n".join(data))
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data.append(line[len("data:"):].strip())
+
+
+def stream_chat(prompt, session_id):
+    response = requests.post(f"{API_URL}/chat/stream", json={"input": prompt, "session_id": session_id},
+                             stream=True, timeout=(5, config['api']['request_timeout']))
+    if response.status_code != 200:
+        raise APIError(response.text)
+    response.encoding = 'utf-8'
+    return server_events(response)
+
+
+def answer_tokens(events):
+    for event, data in events:
+        if event == "token":
+            yield data["text"]
+        elif event == "error":
+            raise APIError(data["message"])
+
+
+def show_sources(context):
+    sources = []
+    for document in context:
+        source = os.path.basename(document["metadata"].get("source", ""))
+        page = document["metadata"].get("page")
+        label = f"{source}, page {page + 1}" if isinstance(page, int) else source
+        if document["metadata"].get("section"):
+            label = f'{label}, {document["metadata"].get("section_kind", "Section")} {document["metadata"]["section"]}'
+        if label and label not in sources:
+            sources.append(label)
+    if sources:
+        with st.expander("Sources"):
+            for label in sources:
+                st.markdown(f"- {label}")
+
+
+def show_metrics():
+    try:
+        snapshot = requests.get(f"{API_URL}/stats", timeout=2).json()
+    except requests.exceptions.RequestException:
+        st.write("The API is not reachable.")
+        return
+    stages = [{"stage": h["labels"]["stage"], "count": h["count"], "p50 ms": round(h["p50"] * 1000, 1),
+               "p95 ms": round(h["p95"] * 1000, 1)}
+              for h in snapshot["histograms"] if h["name"] == "rag_stage_seconds"]
+    tokens = [{"stage": h["labels"]["stage"], "kind": h["labels"]["kind"], "total": int(h["sum"]),
+               "p50": int(h["p50"])}
+              for h in snapshot["histograms"] if h["name"] == "rag_tokens"]
+    counters = {f'{c["name"]} {",".join(f"{k}={v}" for k, v in c["labels"].items())}'.strip(): c["value"]
+                for c in snapshot["counters"]}
+    with st.expander("Performance"):
+        if not stages:
+            st.write("No requests yet.")
+            return
+        st.dataframe(stages, hide_index=True)
+        if tokens:
+            st.dataframe(tokens, hide_index=True)
+        st.json(counters, expanded=False)
 
 
 if __name__ == "__main__":
-    ## - RUN FIRST TIME ONLY - comment it out after first run until line 63
-    scraper = LawScraper(
-        url_base=config['scraper']['url_base'],
-        laws_url=config['scraper']['laws_url'],
-        json_filepath=config['scraper']['json_filepath'],
-        pdf_dir=config['scraper']['pdf_dir']
-    )
-
-    scraper.get_laws_list()
-
-    laws_from_json = scraper.load_laws_from_json()
-
-    with open('data/laws_list.csv', mode='w', newline='', encoding='utf-8') as myFile:
-        writer = csv.DictWriter(myFile, fieldnames=["Law code", "Law Title", "Link", "pdf_url"])
-        writer.writeheader()
-        writer.writerows(laws_from_json)
-
-    loader = CSVLoader(file_path='data/laws_list.csv', encoding='latin1')
-    laws_list = loader.load()
-    laws_list_str = ",\n".join(str(law) for law in laws_list)
-
-
-    ## - RUN FIRST TIME ONLY - comment it out after first run until line 78
-    scraper.download_pdfs(laws_from_json)
-    cleaned_documents = load_and_process_pdfs(config['pdf_processing']['pdf_folder_path'])
-    documents = cleaned_documents + laws_list
-
-    indexing = Indexing()
-    text_splitter = indexing.create_text_splitter()
-
-    splitted_text = indexing.split_documents(documents, text_splitter)
-    # #
-
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-large")
-
-    # # - RUN FIRST TIME ONLY - comment it out after first run
-    db = FAISS.from_documents(splitted_text, embedding=embeddings)
-    db.save_local(folder_path="faiss_vectorstore", index_name="faiss_db")
-    # #
-
-    retriever_instance = FAISSRetriever(db_folder_path="faiss_vectorstore")
-    retriever = retriever_instance.get_retriever()
-
-    chat_model =ChatOpenAI(model="gpt-4o", temperature=0)
-
-    contextualize_q_system_prompt = """Given a chat history and the latest user question \
-    which might reference context in the chat history, formulate a standalone question \
-    which can be understood without the chat history. Do NOT answer the question, \
-    just reformulate it if needed and otherwise return it as is."""
-    contextualize_q_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", contextualize_q_system_prompt),
-            MessagesPlaceholder("chat_history"),
-            ("human", "{input}"),
-        ]
-    )
-
-    history_aware_retriever = create_history_aware_retriever(
-        chat_model, retriever, contextualize_q_prompt
-    )
-
-
-    qa_system_prompt = """
-    You are a professional lawyer. Answer accurately and precisely based only on the provided context. \
-    Always reference the laws and sections exactly as used in your answer. Include the relevant sentence or paragraph. \
-    Do not mention anywhere that you have been provided context' \
-    If the answer is not in the given context or you don't know it, state that you don't know the answer. \
-    Create a scenario to explain the law if necessary. \
-    At the end, only for law and legal related question user asked mention the source by naming the laws and the sections. \
-    Always print the links in listed format.
-    Context: 
-
-    {context} 
-    """
-    qa_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", qa_system_prompt),
-            MessagesPlaceholder("chat_history"),
-            ("human", "{input}"),
-        ]
-    )
-
-
-    question_answer_chain = create_stuff_documents_chain(chat_model, qa_prompt)
-
-    # # - RUN FIRST TIME ONLY - comment it out to use after first run
-    run_evaluation()
-    # #
-
-    rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
-
-
-    conversational_rag_chain = RunnableWithMessageHistory(
-        rag_chain,
-        get_session_history,
-        input_messages_key="input",
-        history_messages_key="chat_history",
-        output_messages_key="answer",
-    )
-
+    # Building the index is done by ingest.py, answering by api.py
     st.set_page_config(
         page_title="RAG - Rouhollah Ghobadinezhad",
         initial_sidebar_state="collapsed"
@@ -185,12 +127,17 @@ if __name__ == "__main__":
             st.write("")
             st.header("Acknowledgement")
             st.info("This Chatbot can make mistakes, check important informations.", icon="ℹ️")
+        with st.container():
+            show_metrics()
             
             
 
 
     if "messages" not in st.session_state:
         st.session_state.messages = []
+    if "session_id" not in st.session_state:
+        # The API keeps the conversation history under this id
+        st.session_state.session_id = uuid.uuid4().hex
 
 
     for message in st.session_state.messages:
@@ -209,17 +156,23 @@ if __name__ == "__main__":
 
 
         try:
-            response = rag_chain.invoke({"input": prompt, "chat_history": [{"role": "assistant", "content": laws_list_str}] + st.session_state.messages})
-            
-            response_content = response["answer"]
+            # The API trims the history to a token budget and looks up referenced laws itself
             with st.chat_message("assistant", avatar="🦖"):
                 with st.spinner("Thinking..."):
-                    st.write_stream(stream_data(response_content))
-            
+                    events = stream_chat(prompt, st.session_state.session_id)
+                    # The first event carries the retrieved context, the answer tokens follow
+                    first = next(events, None)
+                    if first is None:
+                        raise APIError("The answer stream closed before any event")
+                    event, data = first
+                    if event == "error":
+                        raise APIError(data["message"])
+                show_sources(data.get("context", []))
+                response_content = st.write_stream(answer_tokens(events))
 
             st.session_state.messages.append({"role": "assistant", "content": response_content})
-        except RateLimitError:
-            with st.chat_message("assistant", avatar="🦖"): 
-                st.write("Something went wrong with OpenAI. Please try again later.")
+        except (APIError, requests.exceptions.RequestException) as e:
+            with st.chat_message("assistant", avatar="🦖"):
+                st.write(f"Something went wrong, please try again later. ({e})")
         
         
\ No newline at end of file
@@ -0,0 +1,61 @@
+import pytest
+import lib.indexing
+from langchain_core.documents import Document
+from lib.embeddings import HashEmbeddings
+from lib.ingestion import IncrementalIngestor
+from lib.manifest import IngestionManifest
+
+
+class WordEncoder:
+    # Stands in for the tiktoken encoding, whose vocabulary is downloaded on first use
+    def encode(self, text, **kwargs):
+        return text.split()
+
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    # Split workers are forked and inherit the patched encoder
+    lib.indexing.token_length.cache_clear()
+    monkeypatch.setattr(lib.indexing, "get_encoder", lambda encoding_name=None: WordEncoder())
+    yield
+    lib.indexing.token_length.cache_clear()
+
+
+@pytest.fixture
+def make_ingestor(tmp_path):
+    def make(**kwargs):
+        return IncrementalIngestor(HashEmbeddings(), db_folder_path=str(tmp_path / "vectorstore"),
+                                   manifest=IngestionManifest(str(tmp_path / "manifest.json")), **kwargs)
+    return make
+
+
+def law(source, paragraphs):
+    return [Document(page_content=text, metadata={"source": source, "page": page})
+            for page, text in enumerate(paragraphs)]
+
+
+def write_pdf(path, pages):
+    # Minimal PDF with one line of Helvetica text per page, enough for PyPDFLoader
+    page_ids = [3 + 2 * position for position in range(len(pages))]
+    objects = {1: "<< /Type /Catalog /Pages 2 0 R >>",
+               2: f"<< /Type /Pages /Kids [{' '.join(f'{page_id} 0 R' for page_id in page_ids)}] /Count {len(pages)} >>"}
+    font = 3 + 2 * len(pages)
+    for page_id, text in zip(page_ids, pages):
+        stream = f"BT /F1 12 Tf 72 712 Td ({text}) Tj ET"
+        objects[page_id] = (f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                            f"/Resources << /Font << /F1 {font} 0 R >> >> /Contents {page_id + 1} 0 R >>")
+        objects[page_id + 1] = f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream"
+    objects[font] = "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+
+    content = b"%PDF-1.4\n"
+    offsets = {}
+    for number in sorted(objects):
+        offsets[number] = len(content)
+        content += f"{number} 0 obj\n{objects[number]}\nendobj\n".encode("latin-1")
+    xref = len(content)
+    content += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    content += "".join(f"{offsets[number]:010d} 00000 n \n" for number in sorted(objects)).encode("latin-1")
+    content += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    with open(path, "wb") as f:
+        f.write(content)
+    return str(path)
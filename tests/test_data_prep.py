@@ -0,0 +1,25 @@
+from conftest import write_pdf
+from lib.data_prep import PDFProcessor, extract_pdf
+
+
+def test_extract_pdf_returns_the_cleaned_pages(tmp_path):
+    path = write_pdf(tmp_path / "BDSG.pdf", ["Personal data may only be processed on a legal basis."])
+    pages, _ = extract_pdf(path)
+    assert len(pages) == 1
+    assert "legal basis" in pages[0][0]
+
+
+def test_unreadable_pdf_is_not_an_empty_pdf(tmp_path):
+    path = tmp_path / "BDSG.pdf"
+    path.write_bytes(b"%PDF-1.4\nnot really a pdf")
+    pages, _ = extract_pdf(str(path))
+    assert pages is None
+
+
+def test_iter_pdfs_passes_unreadable_pdfs_on(tmp_path):
+    good = write_pdf(tmp_path / "GmbHG.pdf", ["A limited liability company may be formed."])
+    bad = tmp_path / "BDSG.pdf"
+    bad.write_bytes(b"garbage")
+    results = dict(PDFProcessor([good, str(bad)], max_workers=1).iter_pdfs())
+    assert len(results[good]) == 1
+    assert results[str(bad)] is None
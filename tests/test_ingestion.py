@@ -0,0 +1,93 @@
+import os
+import lib.indexing
+from conftest import WordEncoder, law, write_pdf
+from lib.vectorstore import index_paths
+
+
+SOURCES = {
+    "BDSG.pdf": law("BDSG.pdf", ["Personal data may only be processed on a legal basis.",
+                                 "The controller informs the data subject about the processing."]),
+    "GmbHG.pdf": law("GmbHG.pdf", ["A limited liability company may be formed for any lawful purpose.",
+                                   "The share capital must be at least twenty five thousand euros."]),
+}
+
+
+def indexed_sources(db):
+    return {db.docstore.search(chunk_id).metadata['source'] for chunk_id in db.index_to_docstore_id.values()}
+
+
+def test_first_build_creates_the_index_folder(tmp_path, make_ingestor):
+    ingestor = make_ingestor()
+    db = ingestor.ingest([], extra_sources=SOURCES)
+
+    paths = index_paths(str(tmp_path / "vectorstore"), ingestor.index_name)
+    for key in ('index', 'docstore', 'meta', 'bm25', 'sections'):
+        assert os.path.exists(paths[key]), key
+    assert indexed_sources(db) == set(SOURCES)
+    assert set(ingestor.manifest.sources) == set(SOURCES)
+
+
+def test_first_build_checkpoints_into_a_new_folder(make_ingestor):
+    db = make_ingestor(batch_size=1, checkpoint_every=1).ingest([], extra_sources=SOURCES)
+    assert indexed_sources(db) == set(SOURCES)
+
+
+def test_source_that_fails_to_split_keeps_its_chunks(monkeypatch, make_ingestor):
+    make_ingestor().ingest([], extra_sources=SOURCES)
+    hashes = {source: entry['sha256'] for source, entry in make_ingestor().manifest.sources.items()}
+    changed = {**SOURCES, "BDSG.pdf": law("BDSG.pdf", ["Personal data may be processed with consent."])}
+
+    def unavailable(encoding_name=None):
+        raise ConnectionError("encoding not available")
+
+    lib.indexing.token_length.cache_clear()
+    monkeypatch.setattr(lib.indexing, "get_encoder", unavailable)
+    ingestor = make_ingestor()
+    db = ingestor.ingest([], extra_sources=changed)
+    assert ingestor.failed_sources == ["BDSG.pdf"]
+    assert ingestor.removed == 0
+    assert indexed_sources(db) == set(SOURCES)
+    assert {source: entry['sha256'] for source, entry in ingestor.manifest.sources.items()} == hashes
+
+    # Retried once splitting works again
+    lib.indexing.token_length.cache_clear()
+    monkeypatch.setattr(lib.indexing, "get_encoder", lambda encoding_name=None: WordEncoder())
+    db = make_ingestor().ingest([], extra_sources=changed)
+    contents = {db.docstore.search(chunk_id).page_content for chunk_id in db.index_to_docstore_id.values()}
+    assert "Personal data may be processed with consent." in contents
+    assert not any("legal basis" in content for content in contents)
+
+
+def test_first_build_from_pdfs_into_an_empty_folder(tmp_path, make_ingestor):
+    pdfs = [write_pdf(tmp_path / "BDSG.pdf", ["Personal data may only be processed on a legal basis."]),
+            write_pdf(tmp_path / "GmbHG.pdf", ["A limited liability company may be formed for any lawful purpose."])]
+    ingestor = make_ingestor(batch_size=1, checkpoint_every=1)
+    db = ingestor.ingest(iter(pdfs))
+    assert indexed_sources(db) == set(pdfs)
+    assert set(make_ingestor().manifest.sources) == set(pdfs)
+
+
+def test_pdf_whose_extraction_fails_keeps_its_chunks(tmp_path, make_ingestor):
+    bdsg = write_pdf(tmp_path / "BDSG.pdf", ["Personal data may only be processed on a legal basis."])
+    gmbhg = write_pdf(tmp_path / "GmbHG.pdf", ["A limited liability company may be formed for any lawful purpose."])
+    make_ingestor().ingest([bdsg, gmbhg])
+    entry = make_ingestor().manifest.sources[bdsg]
+
+    # A truncated download: the file changed, but cannot be read
+    with open(bdsg, "wb") as f:
+        f.write(b"%PDF-1.4\ntruncated")
+    ingestor = make_ingestor()
+    db = ingestor.ingest([bdsg, gmbhg])
+    assert ingestor.failed_sources == [bdsg]
+    assert ingestor.removed == 0
+    assert indexed_sources(db) == {bdsg, gmbhg}
+    assert make_ingestor().manifest.sources[bdsg] == entry
+
+    # Retried once the file can be read again
+    write_pdf(bdsg, ["Personal data may be processed with consent."])
+    ingestor = make_ingestor()
+    db = ingestor.ingest([bdsg, gmbhg])
+    assert ingestor.failed_sources == []
+    contents = {db.docstore.search(chunk_id).page_content for chunk_id in db.index_to_docstore_id.values()}
+    assert any("consent" in content for content in contents)
+    assert not any("legal basis" in content for content in contents)